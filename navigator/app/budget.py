@@ -0,0 +1,196 @@
+"""
+Per-request latency budgets and quality tiers for Arch-Circare v2.
+
+Search endpoints accept ``quality`` (fast / balanced / precise) and/or
+``budget_ms``. A tier fixes how the request is served -- the index's search
+knob (nprobe or efSearch), candidate depth, whether plan features are
+computed and whether patch reranking runs and over how many candidates.
+With a budget the planner starts at the requested tier (balanced by default)
+and steps down -- first shrinking or dropping the rerank pool, then tier by
+tier -- until the predicted cost fits. Predictions come from an EWMA of each stage's
+recent per-unit cost, fed by the stage executors and ``run_search``.
+"""
+
+import math
+import threading
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, Optional, Tuple
+
+TIERS = ("fast", "balanced", "precise")
+
+# How each tier changes the request relative to what the client asked for
+TIER_PROFILES: Dict[str, Dict[str, Any]] = {
+    # Slider drags: a quarter of the probes, one search round, no plan or rerank work
+    "fast": {"knob_scale": 0.25, "depth_scale": 1.0, "max_rounds": 1,
+             "rerank": False, "rerank_scale": 0.0, "spatial": False},
+    # Exactly the request as given (the behaviour without quality/budget)
+    "balanced": {"knob_scale": 1.0, "depth_scale": 1.0, "max_rounds": None,
+                 "rerank": None, "rerank_scale": 1.0, "spatial": None},
+    # Final selections: 4x probes, twice the depth, rerank on over twice the pool
+    "precise": {"knob_scale": 4.0, "depth_scale": 2.0, "max_rounds": None,
+                "rerank": True, "rerank_scale": 2.0, "spatial": None},
+}
+
+# Cost priors (ms per unit) used until a stage has been observed
+COST_PRIORS: Dict[str, float] = {
+    "embed": 80.0,     # per query embedding (cache hits included once observed)
+    "spatial": 250.0,  # per plan analysis
+    "search": 0.05,    # per unit of the search knob (nprobe / efSearch; 1 for flat)
+    "fuse": 0.01,      # per fused candidate
+    "rerank": 2.0,     # per reranked candidate
+}
+
+# Spatial fusion looks this many times deeper than top_k (see app.search_depth)
+SPATIAL_DEPTH = 5
+
+
+class CostModel:
+    """Exponentially weighted per-unit cost of each request stage."""
+
+    def __init__(self, alpha: float = 0.2, priors: Optional[Dict[str, float]] = None):
+        self.alpha = min(1.0, max(0.01, float(alpha)))
+        self._priors = dict(COST_PRIORS if priors is None else priors)
+        self._ewma: Dict[str, float] = {}
+        self._count: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, ms: float, units: float = 1.0):
+        """Record one call of ``stage`` that took ``ms`` for ``units`` of work."""
+        if units <= 0:
+            return
+        per_unit = max(0.0, float(ms)) / float(units)
+        with self._lock:
+            prev = self._ewma.get(stage)
+            self._ewma[stage] = per_unit if prev is None else prev + self.alpha * (per_unit - prev)
+            self._count[stage] = self._count.get(stage, 0) + 1
+
+    def predict(self, stage: str, units: float = 1.0) -> float:
+        per_unit = self._ewma.get(stage, self._priors.get(stage, 0.0))
+        return per_unit * max(0.0, float(units))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            stages = set(self._priors) | set(self._ewma)
+            return {
+                s: {"ms_per_unit": round(self._ewma.get(s, self._priors.get(s, 0.0)), 4),
+                    "observations": self._count.get(s, 0)}
+                for s in sorted(stages)
+            }
+
+
+@dataclass
+class QueryPlan:
+    """How one request is served; ``balanced`` without a budget is the request as given."""
+    tier: str = "balanced"
+    budget_ms: Optional[float] = None
+    search_params: Dict[str, int] = field(default_factory=dict)
+    depth_scale: float = 1.0
+    max_rounds: Optional[int] = None
+    spatial: bool = False
+    rerank: bool = False
+    re_topk: int = 0
+    predicted_ms: Dict[str, float] = field(default_factory=dict)
+    over_budget: bool = False
+
+    def debug(self) -> Dict[str, Any]:
+        out = asdict(self)
+        out["predicted_ms"] = {k: round(v, 2) for k, v in self.predicted_ms.items()}
+        out["predicted_total_ms"] = round(sum(self.predicted_ms.values()), 2)
+        return out
+
+
+def knob_units(knob: Optional[Tuple[str, int, int]], params: Dict[str, int]) -> float:
+    """Units of search work: the knob value in effect, 1 for exact indexes."""
+    if knob is None:
+        return 1.0
+    name, base, _ = knob
+    return float(params.get(name, base))
+
+
+def _tier_plan(tier: str, knob: Optional[Tuple[str, int, int]], top_k: int, rerank: bool,
+               re_topk: int, spatial: bool, rerank_available: bool) -> QueryPlan:
+    prof = TIER_PROFILES[tier]
+    params: Dict[str, int] = {}
+    if knob is not None and prof["knob_scale"] != 1.0:
+        name, base, upper = knob
+        params[name] = int(max(1, min(upper, round(base * prof["knob_scale"]))))
+    do_rerank = rerank_available and (rerank if prof["rerank"] is None else prof["rerank"])
+    do_spatial = spatial and prof["spatial"] is not False
+    return QueryPlan(
+        tier=tier,
+        search_params=params,
+        depth_scale=prof["depth_scale"],
+        max_rounds=prof["max_rounds"],
+        spatial=do_spatial,
+        rerank=do_rerank,
+        re_topk=(re_topk if prof["rerank_scale"] == 1.0 else max(top_k, int(re_topk * prof["rerank_scale"])))
+        if do_rerank else 0,
+    )
+
+
+def _predict(plan: QueryPlan, model: CostModel, knob, top_k: int, embed: bool) -> Dict[str, float]:
+    depth = max(top_k * (SPATIAL_DEPTH if plan.spatial else 1), plan.re_topk) * plan.depth_scale
+    cost = {
+        "search": model.predict("search", knob_units(knob, plan.search_params)),
+        "fuse": model.predict("fuse", depth),
+    }
+    if embed:
+        cost["embed"] = model.predict("embed")
+    if plan.spatial:
+        cost["spatial"] = model.predict("spatial")
+    if plan.rerank:
+        cost["rerank"] = model.predict("rerank", plan.re_topk)
+    return cost
+
+
+def plan_query(quality: Optional[str], budget_ms: Optional[float],
+               knob: Optional[Tuple[str, int, int]], top_k: int, *, rerank: bool = False,
+               re_topk: int = 0, spatial: bool = False, embed: bool = False,
+               rerank_available: bool = True, model: Optional[CostModel] = None) -> QueryPlan:
+    """Choose the richest plan at or below ``quality`` that fits ``budget_ms``.
+
+    ``knob`` is the snapshot's ``(name, current value, upper bound)`` search
+    knob, or None for exact indexes. If nothing fits, the fast plan is
+    returned with ``over_budget`` set.
+    """
+    if quality is not None and quality not in TIERS:
+        raise ValueError(f"quality must be one of {', '.join(TIERS)}")
+    if budget_ms is not None and budget_ms <= 0:
+        raise ValueError("budget_ms must be positive")
+    model = model or get_cost_model()
+    ceiling = quality or "balanced"
+    plan = None
+    for tier in reversed(TIERS[:TIERS.index(ceiling) + 1]):
+        plan = _tier_plan(tier, knob, top_k, rerank, re_topk, spatial, rerank_available)
+        plan.budget_ms = budget_ms
+        plan.predicted_ms = _predict(plan, model, knob, top_k, embed)
+        if budget_ms is None:
+            return plan
+        if plan.rerank and sum(plan.predicted_ms.values()) > budget_ms:
+            # Shrink the rerank pool before giving up on rerank or the tier
+            rest = sum(v for k, v in plan.predicted_ms.items() if k != "rerank")
+            per_candidate = model.predict("rerank")
+            fit = int(math.floor((budget_ms - rest) / per_candidate)) if per_candidate > 0 else plan.re_topk
+            if fit >= top_k:
+                plan.re_topk = min(plan.re_topk, fit)
+            else:
+                plan.rerank, plan.re_topk = False, 0
+            plan.predicted_ms = _predict(plan, model, knob, top_k, embed)
+        if sum(plan.predicted_ms.values()) <= budget_ms:
+            return plan
+    plan.over_budget = True
+    return plan
+
+
+_cost_model: Optional[CostModel] = None
+_cost_model_lock = threading.Lock()
+
+
+def get_cost_model() -> CostModel:
+    global _cost_model
+    if _cost_model is None:
+        with _cost_model_lock:
+            if _cost_model is None:
+                from app.config import settings
+                _cost_model = CostModel(alpha=settings.budget_ewma_alpha)
+    return _cost_model
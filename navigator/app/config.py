@@ -7,8 +7,9 @@ class Settings(BaseSettings):
     """Application settings loaded from environment variables."""
     
     # Model settings
-    model_name: str = Field(default="vit_base_patch14_dinov2", env="MODEL_NAME")
-    emb_dim: int = Field(default=768, env="EMB_DIM")
+    # Default matches the bundled 384-d index and embeddings
+    model_name: str = Field(default="vit_small_patch14_dinov2", env="MODEL_NAME")
+    emb_dim: int = Field(default=384, env="EMB_DIM")
     
     # FAISS settings
     faiss_nlist: int = Field(default=4096, env="FAISS_NLIST")
@@ -17,6 +18,11 @@ class Settings(BaseSettings):
     # Search settings
     topk_default: int = Field(default=50, env="TOPK_DEFAULT")
     patch_grid: int = Field(default=4, env="PATCH_GRID")
+    # "crop" embeds each tile; "token" pools the tokens of the global forward
+    patch_mode: str = Field(default="crop", env="PATCH_MODE")
+    # Model for patch embeddings; must match the stored patch files
+    # (scripts/embed_patches.py defaults to vit_small)
+    patch_model_name: str = Field(default="vit_small_patch14_dinov2", env="PATCH_MODEL_NAME")
     
     # Data paths
     data_dir: str = Field(default="data", env="DATA_DIR")
@@ -34,6 +40,29 @@ class Settings(BaseSettings):
     max_upload_mb: int = Field(default=10, env="MAX_UPLOAD_MB")
     allow_pdf: bool = Field(default=True, env="ALLOW_PDF")
     upload_tmp_dir: str = Field(default="/tmp", env="UPLOAD_TMP_DIR")
+
+    # Query embedding cache (keyed by upload bytes + model name)
+    embed_cache_size: int = Field(default=256, env="EMBED_CACHE_SIZE")
+    embed_cache_dir: str | None = Field(default=None, env="EMBED_CACHE_DIR")
+
+    # Micro-batching of concurrent query embeddings (max batch <= 1 disables it)
+    embed_batch_max: int = Field(default=8, env="EMBED_BATCH_MAX")
+    embed_batch_wait_ms: float = Field(default=5.0, env="EMBED_BATCH_WAIT_MS")
+
+    # Query embedding backend: "torch" or "onnx" (exported by scripts/export_onnx.py)
+    embed_backend: str = Field(default="torch", env="EMBED_BACKEND")
+    onnx_dir: str | None = Field(default=None, env="ONNX_DIR")  # default: {data_dir}/models
+    onnx_quantized: bool = Field(default=False, env="ONNX_QUANTIZED")
+    onnx_intra_threads: int = Field(default=0, env="ONNX_INTRA_THREADS")  # 0 = runtime default
+    onnx_inter_threads: int = Field(default=1, env="ONNX_INTER_THREADS")
+
+    # Worker limits for CPU-bound upload stages (kept off the event loop)
+    embed_workers: int = Field(default=2, env="EMBED_WORKERS")
+    spatial_workers: int = Field(default=2, env="SPATIAL_WORKERS")  # processes
+    rerank_workers: int = Field(default=2, env="RERANK_WORKERS")
+
+    # Smoothing of the per-stage cost model behind budget_ms / quality plans
+    budget_ewma_alpha: float = Field(default=0.2, env="BUDGET_EWMA_ALPHA")
     
     class Config:
         env_file = ".env"
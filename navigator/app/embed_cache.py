@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """Bounded LRU of L2-normalized query vectors keyed by upload content hash.
+
+    Users tend to re-upload the same reference image with different weights
+    and filters; a hit skips image decode and the model forward entirely.
+    With ``persist_dir`` set, vectors are also written to disk and survive
+    restarts (the on-disk copy is not size-bounded).
+    """
+
+    def __init__(self, max_items: int = 256, persist_dir: Optional[str] = None):
+        self.max_items = max_items
+        self.persist_dir = persist_dir
+        self._items: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    @staticmethod
+    def key(content: bytes, model_name: str) -> str:
+        """Cache key: the embedding depends on both the bytes and the model."""
+        h = hashlib.sha256(model_name.encode("utf-8"))
+        h.update(b"\0")
+        h.update(content)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.persist_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vec = self._items.get(key)
+            if vec is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return vec
+        if self.persist_dir and os.path.exists(self._path(key)):
+            try:
+                vec = np.load(self._path(key)).astype("float32")
+            except Exception as e:
+                logging.warning(f"Failed to read cached embedding {key}: {e}")
+            else:
+                self._remember(key, vec)
+                with self._lock:
+                    self.hits += 1
+                return vec
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, vec: np.ndarray):
+        vec = np.asarray(vec, dtype="float32")
+        vec.setflags(write=False)
+        self._remember(key, vec)
+        if self.persist_dir:
+            try:
+                tmp = self._path(key) + ".tmp.npy"
+                np.save(tmp, vec)
+                os.replace(tmp, self._path(key))
+            except Exception as e:
+                logging.warning(f"Failed to persist embedding {key}: {e}")
+
+    def _remember(self, key: str, vec: np.ndarray):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = vec
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._items), "max_items": self.max_items,
+                    "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,109 @@
+"""
+Bounded executors for CPU-bound request stages.
+
+The upload endpoints are ``async def``; decoding, the model forward, plan
+analysis and patch re-ranking used to run directly on the event loop and
+stalled every other request while they did. Each stage now has its own
+pool with its own concurrency limit -- threads for torch (which releases the
+GIL), a spawned process pool for skimage (which mostly does not) -- and
+records how long each call queued before a worker picked it up.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _timed_call(fn: Callable, args: tuple, kwargs: dict) -> Tuple[Any, float, float]:
+    """Run ``fn`` and return ``(result, wall-clock start, run seconds)``.
+
+    Module-level so process pools can pickle it; wall-clock time is used
+    because it is comparable across processes.
+    """
+    started = time.time()
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, started, time.perf_counter() - t0
+
+
+class StageExecutor:
+    """One named stage backed by a thread or process pool of ``max_workers``."""
+
+    def __init__(self, name: str, max_workers: int, kind: str = "thread"):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, int(max_workers))
+        self._pool: Executor = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.calls = 0
+        self.inflight = 0
+        self.wait_ms_total = 0.0
+        self.run_ms_total = 0.0
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    if self.kind == "process":
+                        # Spawn, not fork: the server process holds torch and batcher threads
+                        self._pool = ProcessPoolExecutor(
+                            max_workers=self.max_workers,
+                            mp_context=multiprocessing.get_context("spawn"),
+                        )
+                    else:
+                        self._pool = ThreadPoolExecutor(
+                            max_workers=self.max_workers, thread_name_prefix=self.name
+                        )
+        return self._pool
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Tuple[Any, Dict[str, float]]:
+        """Run ``fn(*args, **kwargs)`` on the pool without blocking the loop.
+
+        Returns ``(result, timing)`` where timing has ``wait_ms`` (queued
+        behind other calls of this stage) and ``run_ms``.
+        """
+        submitted = time.time()
+        with self._stats_lock:
+            self.inflight += 1
+        try:
+            fut = self._get_pool().submit(_timed_call, fn, args, kwargs)
+            result, started, run_s = await asyncio.wrap_future(fut)
+        finally:
+            with self._stats_lock:
+                self.inflight -= 1
+        timing = {
+            "wait_ms": max(0.0, (started - submitted) * 1000.0),
+            "run_ms": run_s * 1000.0,
+        }
+        with self._stats_lock:
+            self.calls += 1
+            self.wait_ms_total += timing["wait_ms"]
+            self.run_ms_total += timing["run_ms"]
+        return result, timing
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            n = max(1, self.calls)
+            return {
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "inflight": self.inflight,
+                "calls": self.calls,
+                "mean_wait_ms": self.wait_ms_total / n,
+                "mean_run_ms": self.run_ms_total / n,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
@@ -1,82 +1,389 @@
-import os, json, time, threading
+import os, json, time, threading, hashlib
 from typing import List, Dict, Any, Tuple, Optional
 import numpy as np
 import faiss
 import pandas as pd
+from app.vectors import load_vectors, rows as vector_rows
+from app.search_depth import CorpusStats
+from app.idmap import IdMap, load_id_map, source_fingerprint
+from app.metadata import ProjectMetadata, get_project_metadata
 
 def l2n(x: np.ndarray) -> np.ndarray:
     n = np.linalg.norm(x, axis=1, keepdims=True) + 1e-12
     return x / n
 
-class FaissStore:
-    def __init__(self, data_dir: str = "data"):
-        self.data_dir = data_dir
-        self.emb_dir = os.path.join(data_dir, "embeddings", "image")
-        self.index_path = os.path.join(data_dir, "embeddings", "index.faiss")
-        self.idmap_path = os.path.join(data_dir, "embeddings", "id_map.json")
-        self.meta_csv  = os.path.join(data_dir, "metadata", "projects.csv")
-        self.spatial_csv = os.path.join(data_dir, "metadata", "spatial.csv")
-        self._lock = threading.RLock()
-        self._index = None
-        self._idmap: Dict[str, Dict[str, str]] = {}
-        self._projects = None
-        self._spatial_features: Dict[str, List[float]] = {}
-        self._spatial_normalizers: Dict[str, Tuple[float, float]] = {}
-        self.reload()
+# Precomputed corpus kNN graph (scripts/build_knn_graph.py)
+KNN_IDS_FILE = "knn_ids.npy"
+KNN_DIST_FILE = "knn_dist.npy"
+KNN_META_FILE = "knn_graph.json"
 
-    def _is_ivf(self, index) -> bool:
-        # Works across faiss wrapper types
-        return any("IndexIVF" in c.__name__ for c in type(index).mro())
+def mmap_enabled() -> bool:
+    return os.getenv("FAISS_MMAP", "true").lower() == "true"
 
-    def _load_spatial_features(self):
-        """Load and normalize spatial features from CSV."""
-        self._spatial_features = {}
-        if not os.path.exists(self.spatial_csv):
-            return
-        
+def read_index(path: str, mmap: Optional[bool] = None):
+    """Read a FAISS index, memory-mapping it read-only when enabled.
+
+    With IO_FLAG_MMAP the inverted lists (and, on FAISS builds that have
+    IO_FLAG_MMAP_IFC, flat codes) stay in the OS page cache instead of each
+    process's heap, so N workers share one copy. IVF indexes reject
+    IO_FLAG_MMAP_IFC ("mmap only supported for File objects"), so each flag
+    set is tried in turn before reading into memory. Writers must replace the
+    file atomically (write + rename) rather than truncating it in place.
+    """
+    if mmap is None:
+        mmap = mmap_enabled()
+    if not mmap:
+        return faiss.read_index(path)
+    attempts = [faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY]
+    if getattr(faiss, "IO_FLAG_MMAP_IFC", 0):
+        attempts.insert(0, attempts[0] | faiss.IO_FLAG_MMAP_IFC)
+    err = None
+    for flags in attempts:
         try:
-            df = pd.read_csv(self.spatial_csv)
-            
-            # Store raw features
-            for _, row in df.iterrows():
-                project_id = row['project_id']
-                self._spatial_features[project_id] = [
-                    float(row['elongation']),
-                    float(row['convexity']),
-                    float(row['room_count']),
-                    float(row['corridor_ratio'])
-                ]
-            
-            # Compute normalization parameters
-            if len(df) > 0:
-                # elongation: log1p then min-max
-                elongations = np.log1p(df['elongation'].values)
-                self._spatial_normalizers['elongation'] = (elongations.min(), elongations.max())
-                
-                # convexity: already in [0,1], no normalization needed
-                self._spatial_normalizers['convexity'] = (0.0, 1.0)
-                
-                # room_count: log1p then min-max
-                room_counts = np.log1p(df['room_count'].values)
-                self._spatial_normalizers['room_count'] = (room_counts.min(), room_counts.max())
-                
-                # corridor_ratio: min-max
-                corridor_ratios = df['corridor_ratio'].values
-                self._spatial_normalizers['corridor_ratio'] = (corridor_ratios.min(), corridor_ratios.max())
-                
-        except Exception as e:
-            print(f"Warning: Failed to load spatial features: {e}")
+            return faiss.read_index(path, flags)
+        except RuntimeError as e:
+            err = e
+    print(f"Warning: mmap load failed for {path} ({err}); reading into memory")
+    return faiss.read_index(path)
+
+def load_npy(path: str, mmap: Optional[bool] = None) -> np.ndarray:
+    """np.load a float32 array, memory-mapped read-only when enabled."""
+    if mmap is None:
+        mmap = mmap_enabled()
+    arr = np.load(path, mmap_mode="r" if mmap else None)
+    # asarray keeps the mapping when the file is already float32
+    return np.asarray(arr, dtype="float32")
+
+# Project attributes copied onto every hydrated hit
+PROJECT_COLUMNS = ("title", "country", "typology", "climate_bin", "massing_type")
+# Attributes that strict filters can push down into the index
+FILTER_COLUMNS = ("typology", "climate_bin", "massing_type")
+
+# Build spec and tuned search parameters, written next to index.faiss
+INDEX_META_FILE = "index_meta.json"
+
+def index_meta_path(index_path: str) -> str:
+    return os.path.join(os.path.dirname(index_path), INDEX_META_FILE)
+
+def read_index_meta(index_path: str) -> Dict[str, Any]:
+    """``index_meta.json`` beside the index, or {} if absent/unreadable."""
+    path = index_meta_path(index_path)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Warning: Failed to read {path}: {e}")
+        return {}
+
+def write_index_meta(index_path: str, meta: Dict[str, Any]) -> str:
+    path = index_meta_path(index_path)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+# Sharded layout (scripts/build_faiss.py --shards): one IndexIDMap per shard
+# holding global faiss ids, listed in a manifest
+SHARDS_DIR = "index_shards"
+SHARDS_MANIFEST = "shards.json"
+
+def shards_enabled() -> bool:
+    return os.getenv("FAISS_SHARDS", "false").lower() == "true"
+
+def shards_manifest_path(emb_root: str) -> str:
+    return os.path.join(emb_root, SHARDS_DIR, SHARDS_MANIFEST)
+
+def read_shards(emb_root: str) -> Tuple[Any, Dict[str, Any]]:
+    """Load every shard into one threaded ``faiss.IndexShards``.
+
+    A search fans out to all shards in parallel (one thread per shard; FAISS
+    releases the GIL) and merges the per-shard top-k. Shards keep global
+    ids, so results hydrate through the corpus-wide id map unchanged.
+    Returns (index, manifest).
+    """
+    manifest_path = shards_manifest_path(emb_root)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"Missing shard manifest at {manifest_path}")
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    index = faiss.IndexShards(int(manifest["d"]), True, False)  # threaded, keep ids
+    for entry in manifest["shards"]:
+        # add_shard keeps a Python reference, so the shards outlive this loop
+        index.add_shard(read_index(os.path.join(emb_root, SHARDS_DIR, entry["file"])))
+    return index, manifest
+
+def first_shard(index):
+    """The first sub-index of an IndexShards (representative of all), else ``index``."""
+    if isinstance(index, faiss.IndexShards) and index.count() > 0:
+        return faiss.downcast_index(index.at(0))
+    return index
+
+def refine_factor_setting() -> int:
+    """Candidates per result re-scored exactly for lossy indexes (0/1 disables)."""
+    return max(0, int(os.getenv("FAISS_REFINE_FACTOR", "4")))
+
+def lossy_distances(index) -> bool:
+    """Whether the index returns approximate distances (PQ/SQ codes, transforms).
+
+    Flat, IVF-Flat and HNSW-over-Flat only approximate the candidate set; the
+    distances they report are already exact.
+    """
+    index = first_shard(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return lossy_distances(faiss.downcast_index(index.index))
+    if isinstance(index, faiss.IndexRefine):
+        return not isinstance(faiss.downcast_index(index.refine_index), faiss.IndexFlat)
+    if isinstance(index, (faiss.IndexFlat, faiss.IndexIVFFlat)):
+        return False
+    if isinstance(index, faiss.IndexHNSW):
+        return not isinstance(faiss.downcast_index(index.storage), faiss.IndexFlat)
+    return True
+
+def apply_search_params(index, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Set runtime knobs (nprobe, efSearch, quantizer_efSearch, k_factor, ...).
+
+    Returns the parameters that applied; ones the index does not have are
+    skipped with a warning.
+    """
+    applied = {}
+    ps = faiss.ParameterSpace()
+    for name, value in params.items():
+        try:
+            if name == "k_factor" and isinstance(index, faiss.IndexRefine):
+                index.k_factor = float(value)
+            else:
+                ps.set_index_parameter(index, name, value)
+            applied[name] = value
+        except Exception:
+            print(f"Warning: {type(index).__name__} has no search parameter {name!r}; ignored")
+    return applied
+
+def search_knob(index) -> Optional[Tuple[str, int, int]]:
+    """``(name, current value, upper bound)`` of the index's speed/recall knob.
+
+    None for exact indexes, which have nothing to trade.
+    """
+    if isinstance(index, faiss.IndexShards):
+        return search_knob(first_shard(index)) if index.count() > 0 else None
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return "nprobe", int(ivf.nprobe), int(ivf.nlist)
+    if isinstance(index, faiss.IndexIDMap):
+        return search_knob(faiss.downcast_index(index.index))
+    if isinstance(index, faiss.IndexRefine):
+        return search_knob(faiss.downcast_index(index.base_index))
+    if isinstance(index, faiss.IndexPreTransform):
+        return search_knob(faiss.downcast_index(index.index))
+    if isinstance(index, faiss.IndexHNSW):
+        return "efSearch", int(index.hnsw.efSearch), max(1024, int(index.hnsw.efSearch))
+    return None
+
+def search_params(index, sel=None, overrides: Optional[Dict[str, Any]] = None):
+    """SearchParameters of the right subtype for ``index``, carrying ``sel``.
+
+    IVF indexes reject the base type, so their current nprobe is copied over;
+    HNSW keeps its efSearch, and refine/pre-transform wrappers pass the
+    parameters of the index they wrap (shards all share the first shard's
+    layout). ``overrides`` ({"nprobe": n}, {"efSearch": e}, {"k_factor": f})
+    replace the index's values for this call only.
+    """
+    overrides = overrides or {}
+    if isinstance(index, faiss.IndexShards):
+        return search_params(first_shard(index), sel, overrides)
+    if isinstance(index, faiss.IndexIDMap):
+        # IndexIDMap translates ``sel`` to its inner ids itself
+        return search_params(faiss.downcast_index(index.index), sel, overrides)
+    if isinstance(index, faiss.IndexRefine):
+        base = search_params(faiss.downcast_index(index.base_index), sel, overrides)
+        k_factor = float(overrides.get("k_factor", index.k_factor))
+        params = faiss.IndexRefineSearchParameters(k_factor=k_factor, base_index_params=base)
+        params.referenced = base  # keep the nested params alive
+        return params
+    if isinstance(index, faiss.IndexPreTransform):
+        return search_params(faiss.downcast_index(index.index), sel, overrides)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=sel, nprobe=int(overrides.get("nprobe", ivf.nprobe)))
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=int(overrides.get("efSearch", index.hnsw.efSearch)))
+    return faiss.SearchParameters(sel=sel)
+
+class HydrationTable:
+    """Dense, array-backed hydration columns keyed by FAISS row id.
+
+    Per-image columns (image_id, project_id, thumb) come from the binary
+    ``IdMap`` and are decoded only for the ids a request gathers; project
+    attributes stay in the shared ``ProjectMetadata`` and are reached through
+    an int32 metadata row per image, so a lookup is a couple of np.take calls
+    regardless of how many rows projects.csv has. Row ``n`` is a sentinel for
+    ids that are missing from the id map (including FAISS's -1 padding).
+    """
+
+    def __init__(self, idmap: IdMap, projects: ProjectMetadata):
+        n = idmap.n
+        self.n = n
+        self.ids = idmap
+        self.projects = projects
+
+        # Metadata row per image; row p (one past the end) means "no metadata".
+        # Id-map project codes translate through a per-project lookup.
+        p = projects.n
+        rows = projects.rows(idmap.project_id_list())
+        csv_row = np.append(np.where(rows >= 0, rows, p), p).astype(np.int32)
+        codes = np.asarray(idmap.project, dtype=np.int64)
+        self.project_code = np.full(n + 1, p, dtype=np.int32)
+        self.project_code[:n] = csv_row[np.where(codes >= 0, codes, len(csv_row) - 1)]
+        self.has_project = np.zeros(p + 1, dtype=bool)
+        self.has_project[:p] = True
+        # Attribute codes per metadata row, -1 in the sentinel row
+        self.row_codes: Dict[str, np.ndarray] = {
+            col: np.append(np.asarray(codes, dtype=np.int32), np.int32(-1)) for col, codes in projects.codes.items()
+        }
+
+        # Packed per-value id bitmaps (little bit order, as IDSelectorBitmap
+        # expects), e.g. bitmaps["typology"]["education"]
+        self.bitmaps: Dict[str, Dict[Any, np.ndarray]] = {}
+        for col in FILTER_COLUMNS:
+            if col not in projects.codes:
+                self.bitmaps[col] = {}
+                continue
+            codes = self.row_codes[col][self.project_code[:n]]
+            self.bitmaps[col] = {
+                v: np.packbits(codes == c, bitorder="little")
+                for c, v in enumerate(projects.categories[col].tolist())
+            }
+
+    def rows(self, idxs: np.ndarray) -> np.ndarray:
+        """Map faiss ids to table rows, sending unknown ids to the sentinel."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        return np.where((idxs >= 0) & (idxs < self.n), idxs, self.n)
+
+    def filter_bitmap(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """AND together the bitmaps for the given attribute == value filters.
+
+        Returns None when no filter is set; unknown values yield an empty bitmap.
+        """
+        bits = None
+        for col, value in (filters or {}).items():
+            if col not in self.bitmaps or value is None:
+                continue
+            b = self.bitmaps[col].get(value)
+            if b is None:
+                b = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+            bits = b.copy() if bits is None else np.bitwise_and(bits, b)
+        return bits
+
+    def lens_bitmap(self, lens_ids: Optional[List[str]] = None,
+                    lens_projects: Optional[List[str]] = None) -> Optional[np.ndarray]:
+        """Packed bitmap of the images inside a lens (listed images or images of
+        listed projects); None when no lens is set."""
+        if not lens_ids and not lens_projects:
+            return None
+        mask = np.zeros(self.n, dtype=bool)
+        if lens_projects:
+            wanted = set(lens_projects)
+            codes = [c for c, p in enumerate(self.ids.project_id_list()) if p in wanted]
+            if codes:
+                mask |= np.isin(np.asarray(self.ids.project, dtype=np.int64), codes)
+        rows = [r for r in (self.ids.row_of(i) for i in set(lens_ids or [])) if r is not None]
+        mask[rows] = True
+        return np.packbits(mask, bitorder="little")
+
+    def selection_bitmap(self, filters: Optional[Dict[str, Any]],
+                         lens: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        """``filter_bitmap`` ANDed with a lens bitmap (None when neither is set)."""
+        bits = self.filter_bitmap(filters)
+        if lens is None:
+            return bits
+        return lens if bits is None else np.bitwise_and(bits, lens)
+
+    def attribute_codes(self, col: str, idxs: np.ndarray) -> np.ndarray:
+        """Category codes of a project attribute for a batch of faiss ids (-1 = none)."""
+        codes = self.row_codes.get(col)
+        if codes is None:
+            return np.full(len(idxs), -1, dtype=np.int32)
+        return codes[self.project_code[self.rows(idxs)]]
+
+    def count(self, bits: np.ndarray) -> int:
+        return int(np.unpackbits(bits, count=self.n, bitorder="little").sum())
+
+    def row_of(self, image_id: str) -> Optional[int]:
+        return self.ids.row_of(image_id)
+
+    def gather(self, idxs: np.ndarray) -> Dict[str, np.ndarray]:
+        """Vectorized column gather for a batch of faiss ids."""
+        r = self.rows(idxs)
+        codes = self.project_code[r]
+        cols = {
+            "image_id": self.ids.image_ids(r),
+            "project_id": self.ids.project_ids(r),
+            "thumb_url": self.ids.thumbs(r),
+            "_has_project": self.has_project[codes],
+        }
+        for col in PROJECT_COLUMNS:
+            cols[col] = self.projects.take(col, codes)
+        return cols
+
+class ServingSnapshot:
+    """Immutable bundle of everything a search reads.
+
+    Built off to the side by ``FaissStore.reload`` and published by swapping a
+    single reference, so searches never take a lock. Request handlers should
+    grab one snapshot and use it for the whole request so that ids returned by
+    the index are always hydrated against the matching id map.
+    """
+
+    def __init__(self, index, idmap: IdMap, projects: ProjectMetadata,
+                 spatial_features: Dict[str, List[float]],
+                 spatial_normalizers: Dict[str, Tuple[float, float]], emb_dir: str,
+                 vectors: Optional[np.ndarray] = None,
+                 knn: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+                 index_meta: Optional[Dict[str, Any]] = None, refine_factor: int = 0):
+        self.index = index
+        self.idmap = idmap
+        self.projects = projects
+        self.table = HydrationTable(idmap, projects)
+        self.stats = CorpusStats(self.table)
+        self.spatial_features = spatial_features
+        self.spatial_normalizers = spatial_normalizers
+        self.emb_dir = emb_dir
+        # Consolidated (N, d) embedding matrix aligned with faiss ids, if present
+        self.vectors = vectors
+        # (ids, distances) of each corpus image's neighbours, self excluded
+        self.knn = knn
+        self.ntotal = int(index.ntotal)
+        self.loaded_at = time.time()
+        # Build spec and the search parameters applied at load (index_meta.json)
+        self.index_meta = index_meta or {}
+        # (name, served value, upper bound) of the search knob per-request plans scale
+        self.knob = search_knob(index)
+        # Lossy indexes over-fetch this many candidates per result and re-score
+        # them exactly against ``vectors`` (0 = FAISS distances as returned)
+        self.refine_factor = refine_factor if vectors is not None else 0
+        # Normalized spatial features per id-map project code; the last row
+        # stands for "no features" (see spatial_distances)
+        pids = idmap.project_id_list()
+        self.spatial_matrix = np.zeros((len(pids) + 1, 4))
+        self.has_spatial = np.zeros(len(pids) + 1, dtype=bool)
+        for c, pid in enumerate(pids):
+            feats = self.get_spatial_features(pid)
+            if feats is not None and len(feats) == 4:
+                self.spatial_matrix[c] = feats
+                self.has_spatial[c] = True
 
     def _normalize_spatial_features(self, features: List[float]) -> List[float]:
         """Normalize spatial features to comparable scales."""
-        if len(features) != 4 or not self._spatial_normalizers:
+        if len(features) != 4 or not self.spatial_normalizers:
             return features
         
         elongation, convexity, room_count, corridor_ratio = features
         
         # elongation: log1p then min-max
         elong_norm = np.log1p(elongation)
-        elong_min, elong_max = self._spatial_normalizers['elongation']
+        elong_min, elong_max = self.spatial_normalizers['elongation']
         elong_norm = (elong_norm - elong_min) / (elong_max - elong_min + 1e-12)
         
         # convexity: already in [0,1]
@@ -84,20 +391,20 @@ class FaissStore:
         
         # room_count: log1p then min-max
         room_norm = np.log1p(room_count)
-        room_min, room_max = self._spatial_normalizers['room_count']
+        room_min, room_max = self.spatial_normalizers['room_count']
         room_norm = (room_norm - room_min) / (room_max - room_min + 1e-12)
         
         # corridor_ratio: min-max
-        corr_min, corr_max = self._spatial_normalizers['corridor_ratio']
+        corr_min, corr_max = self.spatial_normalizers['corridor_ratio']
         corr_norm = (corridor_ratio - corr_min) / (corr_max - corr_min + 1e-12)
         
         return [elong_norm, convex_norm, room_norm, corr_norm]
 
     def get_spatial_features(self, project_id: str) -> Optional[List[float]]:
         """Get normalized spatial features for a project."""
-        if project_id not in self._spatial_features:
+        if project_id not in self.spatial_features:
             return None
-        raw_features = self._spatial_features[project_id]
+        raw_features = self.spatial_features[project_id]
         return self._normalize_spatial_features(raw_features)
 
     def spatial_distance(self, project_id1: str, project_id2: str) -> float:
@@ -110,74 +417,166 @@ class FaissStore:
         
         return np.linalg.norm(np.array(features1) - np.array(features2))
 
-    def reload(self):
-        with self._lock:
-            if not os.path.exists(self.index_path):
-                raise FileNotFoundError(f"Missing index at {self.index_path}")
-            self._index = faiss.read_index(self.index_path)
-            # Tune nprobe if IVF
-            if self._is_ivf(self._index):
-                nprobe = int(os.getenv("FAISS_NPROBE", "8"))
-                # clamp nprobe sanely if nlist is available
-                try:
-                    nlist = int(getattr(self._index, "nlist"))
-                    nprobe = max(1, min(nprobe, max(1, nlist // 2)))
-                except Exception:
-                    pass
-                setattr(self._index, "nprobe", nprobe)
-            # Load id_map
-            with open(self.idmap_path, "r", encoding="utf-8") as f:
-                self._idmap = json.load(f)
-            # Load projects.csv for hydration
-            if os.path.exists(self.meta_csv):
-                self._projects = pd.read_csv(self.meta_csv)
-            else:
-                self._projects = pd.DataFrame([])
-            # Load spatial features
-            self._load_spatial_features()
+    def spatial_distances(self, idxs: np.ndarray, query: List[float]) -> np.ndarray:
+        """``spatial_distance`` from ``query`` to each id's project: one matrix
+        op over the projects, then a gather; 0.0 where a project has no
+        spatial features."""
+        diff = self.spatial_matrix - np.asarray(query, dtype=np.float64)
+        per_project = np.where(self.has_spatial, np.sqrt(np.einsum("ij,ij->i", diff, diff)), 0.0)
+        codes = self.table.ids.project_codes(idxs)
+        return per_project[np.where(codes >= 0, codes, len(per_project) - 1)]
 
     def _hydrate(self, idxs: List[int]) -> List[Dict[str, Any]]:
+        cols = self.table.gather(np.asarray(idxs, dtype=np.int64))
         rows = []
-        idmap = self._idmap
-        prj = self._projects
-        for i in idxs:
-            meta = idmap.get(str(i), {})
-            pid = meta.get("project_id")
-            row = {"image_id": meta.get("image_id"),
-                   "project_id": pid,
-                   "thumb_url": meta.get("thumb")}
-            if prj is not None and not prj.empty and pid is not None:
-                hit = prj[prj["project_id"] == pid]
-                if not hit.empty:
-                    r = hit.iloc[0].to_dict()
-                    row.update({
-                        "title": r.get("title"),
-                        "country": r.get("country"),
-                        "typology": r.get("typology"),
-                        "climate_bin": r.get("climate_bin"),
-                        "massing_type": r.get("massing_type"),
-                    })
+        for j in range(len(idxs)):
+            row = {"image_id": cols["image_id"][j],
+                   "project_id": cols["project_id"][j],
+                   "thumb_url": cols["thumb_url"][j]}
+            if cols["_has_project"][j]:
+                row.update({c: cols[c][j] for c in PROJECT_COLUMNS})
             rows.append(row)
         return rows
 
-    def search(self, q: np.ndarray, top_k: int = 12) -> Tuple[np.ndarray, np.ndarray]:
-        q = q.astype("float32")
-        if q.ndim == 1:
-            q = q[None, :]
-        q = l2n(q)
-        with self._lock:
-            D, I = self._index.search(q, top_k)
-        return D[0], I[0]
+    def search_batch(self, Q: np.ndarray, top_k: int = 12,
+                     filters: Optional[Dict[str, Any]] = None,
+                     overrides: Optional[Dict[str, Any]] = None,
+                     stats: Optional[Dict[str, Any]] = None,
+                     lens: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Nearest neighbours for every row of ``Q`` in one FAISS call.
+
+        ``filters`` ({attribute: value}) and ``lens`` (a ``lens_bitmap``)
+        restrict the search to eligible ids via an IDSelectorBitmap, so the
+        index only visits those vectors.
+        ``overrides`` sets search knobs (nprobe, efSearch) for this call only.
+        With a lossy index, ``refine_factor * top_k`` candidates are fetched
+        and re-ranked by exact distance; the refine cost is accumulated into
+        ``stats["refine"]`` when a dict is passed.
+        Returns (nq, top_k) matrices; short rows keep FAISS's -1 padding.
+        """
+        Q = Q.astype("float32")
+        if Q.ndim == 1:
+            Q = Q[None, :]
+        Q = l2n(Q)
+        bits = self.table.selection_bitmap(filters, lens)
+        if self.refine_factor <= 1:
+            return self._search_index(Q, top_k, bits, overrides)
+        k_fetch = max(top_k, min(self.ntotal, top_k * self.refine_factor))
+        D, I = self._search_index(Q, k_fetch, bits, overrides)
+        return self._refine(Q, I, top_k, stats)
+
+    def _search_index(self, Q: np.ndarray, top_k: int, bits: Optional[np.ndarray],
+                      overrides: Optional[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+        # FAISS CPU indexes are safe for concurrent read-only searches
+        if bits is None:
+            if not overrides:
+                return self.index.search(Q, top_k)
+            return self.index.search(Q, top_k, params=search_params(self.index, None, overrides))
+        sel = faiss.IDSelectorBitmap(self.table.n, faiss.swig_ptr(bits))
+        try:
+            return self.index.search(Q, top_k, params=search_params(self.index, sel, overrides))
+        except RuntimeError:
+            # Index type without selector support: over-fetch and filter
+            return self._search_post_filter(Q, top_k, bits, overrides)
+
+    def _refine(self, Q: np.ndarray, I: np.ndarray, top_k: int,
+                stats: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Re-rank candidate ids by exact squared L2 to the stored vectors.
+
+        Candidate rows are read once each, in id order, from the (memory-
+        mapped) embedding matrix; only those pages are touched.
+        """
+        t0 = time.perf_counter()
+        valid = I >= 0
+        uniq = np.unique(I[valid])
+        V = l2n(vector_rows(self.vectors, uniq)) if len(uniq) else np.zeros((0, Q.shape[1]), "float32")
+        pos = np.searchsorted(uniq, np.where(valid, I, 0))
+        exact = np.full(I.shape, np.finfo("float32").max, dtype="float32")
+        for r in range(I.shape[0]):
+            cand = V[pos[r, valid[r]]]
+            exact[r, valid[r]] = ((cand - Q[r]) ** 2).sum(axis=1)
+        order = np.argsort(exact, axis=1, kind="stable")[:, :top_k]
+        D_out = np.take_along_axis(exact, order, axis=1)
+        I_out = np.take_along_axis(I, order, axis=1)
+        if stats is not None:
+            r = stats.setdefault("refine", {"factor": self.refine_factor, "candidates": 0, "ms": 0.0})
+            r["candidates"] += int(valid.sum())
+            r["ms"] += (time.perf_counter() - t0) * 1000.0
+        return D_out, I_out
+
+    def search(self, q: np.ndarray, top_k: int = 12,
+               filters: Optional[Dict[str, Any]] = None,
+               overrides: Optional[Dict[str, Any]] = None,
+               stats: Optional[Dict[str, Any]] = None,
+               lens: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Nearest neighbours of a single query (see ``search_batch``)."""
+        D, I = self.search_batch(q, top_k, filters, overrides, stats, lens)
+        # Drop FAISS's -1 padding (k larger than what the index could return)
+        valid = I[0] >= 0
+        return D[0][valid], I[0][valid]
+
+    def _search_post_filter(self, Q: np.ndarray, top_k: int, bits: np.ndarray,
+                            overrides: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        mask = np.unpackbits(bits, count=self.table.n, bitorder="little").astype(bool)
+        k = min(self.index.ntotal, max(top_k, int(top_k * self.table.n / max(1, mask.sum()))))
+        if overrides:
+            D, I = self.index.search(Q, k, params=search_params(self.index, None, overrides))
+        else:
+            D, I = self.index.search(Q, k)
+        D_out = np.full((len(Q), top_k), np.finfo("float32").max, dtype="float32")
+        I_out = np.full((len(Q), top_k), -1, dtype="int64")
+        for r in range(len(Q)):
+            keep = (I[r] >= 0) & mask[np.clip(I[r], 0, self.table.n - 1)]
+            d, i = D[r][keep][:top_k], I[r][keep][:top_k]
+            D_out[r, :len(d)] = d
+            I_out[r, :len(i)] = i
+        return D_out, I_out
+
+    def lens_bitmap(self, lens_ids: Optional[List[str]] = None,
+                    lens_projects: Optional[List[str]] = None) -> Optional[np.ndarray]:
+        return self.table.lens_bitmap(lens_ids, lens_projects)
+
+    def filter_count(self, filters: Optional[Dict[str, Any]],
+                     lens: Optional[np.ndarray] = None) -> Optional[int]:
+        """Number of ids eligible under ``filters`` and ``lens`` (None when unfiltered)."""
+        bits = self.table.selection_bitmap(filters, lens)
+        return None if bits is None else self.table.count(bits)
+
+    def neighbors_for_image(self, image_id: str, top_k: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Answer an unfiltered corpus-image query from the kNN graph.
+
+        Returns (D, I) shaped like ``search`` (the image itself first, at
+        distance 0), or None when there is no graph, the image is not in the
+        corpus, or ``top_k`` is deeper than the graph. Graphs are built through
+        ``search_batch`` and only loaded when distances are exact (exact index
+        or refine on), so 0 is the self distance a search would report.
+        """
+        if self.knn is None:
+            return None
+        row = self.table.row_of(image_id)
+        ids, dist = self.knn
+        if row is None or top_k > ids.shape[1] + 1:
+            return None
+        I = np.concatenate(([row], ids[row, :top_k - 1])).astype("int64")
+        D = np.concatenate(([0.0], dist[row, :top_k - 1])).astype("float32")
+        valid = I >= 0
+        return D[valid], I[valid]
 
     def vector_for_image(self, image_id: str) -> np.ndarray:
+        if self.vectors is not None:
+            row = self.table.row_of(image_id)
+            if row is None:
+                raise FileNotFoundError(f"Embedding not found for {image_id}")
+            return vector_rows(self.vectors, row)
+        # Legacy layout: one .npy per image
         path = os.path.join(self.emb_dir, f"{image_id}.npy")
         if not os.path.exists(path):
             raise FileNotFoundError(f"Embedding not found for {image_id}")
-        return np.load(path).astype("float32")
+        return load_npy(path)
 
     def results_payload(self, D: np.ndarray, I: np.ndarray) -> List[Dict[str, Any]]:
         out = []
-        hydrated = self._hydrate([int(i) for i in I.tolist()])
+        hydrated = self._hydrate(I)
         for rank, (dist, idx, meta) in enumerate(zip(D.tolist(), I.tolist(), hydrated), start=1):
             out.append({
                 "rank": rank,
@@ -186,3 +585,224 @@ class FaissStore:
                 **meta
             })
         return out
+
+    def results_payload_batch(self, D: np.ndarray, I: np.ndarray) -> List[Tuple[np.ndarray, List[Dict[str, Any]]]]:
+        """Hydrate a whole (nq, k) result matrix with one gather.
+
+        Returns one ``(distances, results)`` pair per query, -1 padding removed.
+        """
+        hydrated = self._hydrate(I.ravel())
+        out = []
+        k = I.shape[1]
+        for r in range(I.shape[0]):
+            valid = I[r] >= 0
+            rows = [h for h, ok in zip(hydrated[r * k:(r + 1) * k], valid.tolist()) if ok]
+            d, ids = D[r][valid], I[r][valid]
+            out.append((d, [
+                {"rank": rank, "distance": float(dist), "faiss_id": int(idx), **meta}
+                for rank, (dist, idx, meta) in enumerate(zip(d.tolist(), ids.tolist(), rows), start=1)
+            ]))
+        return out
+
+class FaissStore:
+    def __init__(self, data_dir: str = "data"):
+        self.data_dir = data_dir
+        self.emb_dir = os.path.join(data_dir, "embeddings", "image")
+        self.index_path = os.path.join(data_dir, "embeddings", "index.faiss")
+        self.sharded = shards_enabled()
+        self.idmap_path = os.path.join(data_dir, "embeddings", "id_map.json")
+        self.meta_csv  = os.path.join(data_dir, "metadata", "projects.csv")
+        self.spatial_csv = os.path.join(data_dir, "metadata", "spatial.csv")
+        # Only serializes concurrent reloads; searches never touch it
+        self._lock = threading.Lock()
+        self._snap: Optional[ServingSnapshot] = None
+        self.reload()
+
+    def _load_spatial_features(self) -> Tuple[Dict[str, List[float]], Dict[str, Tuple[float, float]]]:
+        """Load spatial features and their normalization ranges from CSV."""
+        features: Dict[str, List[float]] = {}
+        normalizers: Dict[str, Tuple[float, float]] = {}
+        if not os.path.exists(self.spatial_csv):
+            return features, normalizers
+        
+        try:
+            df = pd.read_csv(self.spatial_csv)
+            
+            # Store raw features
+            for _, row in df.iterrows():
+                project_id = row['project_id']
+                features[project_id] = [
+                    float(row['elongation']),
+                    float(row['convexity']),
+                    float(row['room_count']),
+                    float(row['corridor_ratio'])
+                ]
+            
+            # Compute normalization parameters
+            if len(df) > 0:
+                # elongation: log1p then min-max
+                elongations = np.log1p(df['elongation'].values)
+                normalizers['elongation'] = (elongations.min(), elongations.max())
+                
+                # convexity: already in [0,1], no normalization needed
+                normalizers['convexity'] = (0.0, 1.0)
+                
+                # room_count: log1p then min-max
+                room_counts = np.log1p(df['room_count'].values)
+                normalizers['room_count'] = (room_counts.min(), room_counts.max())
+                
+                # corridor_ratio: min-max
+                corridor_ratios = df['corridor_ratio'].values
+                normalizers['corridor_ratio'] = (corridor_ratios.min(), corridor_ratios.max())
+                
+        except Exception as e:
+            print(f"Warning: Failed to load spatial features: {e}")
+        return features, normalizers
+
+    def _load_vectors(self, idmap: IdMap) -> Optional[np.ndarray]:
+        """Load the consolidated embedding matrix if it matches the id map."""
+        try:
+            loaded = load_vectors(os.path.dirname(self.emb_dir), mmap=mmap_enabled())
+        except Exception as e:
+            print(f"Warning: Failed to load embedding matrix: {e}")
+            return None
+        if loaded is None:
+            return None
+        X, ids = loaded
+        if idmap.image_ids_fingerprint() != ids:
+            print("Warning: vectors.npy is out of sync with id_map.json; using per-image files")
+            return None
+        return X
+
+    def index_hash(self) -> str:
+        """Full-content hash of the files behind the served index: index.faiss,
+        or the shard manifest plus every shard it lists."""
+        if not self.sharded:
+            return source_fingerprint(self.index_path)
+        manifest_path = shards_manifest_path(os.path.dirname(self.index_path))
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            files = [e["file"] for e in json.load(f)["shards"]]
+        h = hashlib.sha256(source_fingerprint(manifest_path).encode("utf-8"))
+        for name in files:
+            h.update(source_fingerprint(os.path.join(os.path.dirname(manifest_path), name)).encode("utf-8"))
+        return f"shards:{h.hexdigest()}"
+
+    def _load_knn(self, index, index_meta: Dict[str, Any]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Load the precomputed kNN graph if it was built against this index
+        with the search params and refine factor being served."""
+        emb_root = os.path.dirname(self.emb_dir)
+        meta_path = os.path.join(emb_root, KNN_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if (meta.get("ntotal") != index.ntotal or meta.get("d") != index.d
+                    or meta.get("index") != self.index_hash()):
+                print("Warning: knn graph was built for a different index; ignoring it")
+                return None
+            if lossy_distances(index) and index_meta["refine_factor"] <= 1:
+                print("Warning: knn graph ignored; the index returns approximate distances "
+                      "and exact re-scoring is off (FAISS_REFINE_FACTOR)")
+                return None
+            if (meta.get("refine_factor", 0) != index_meta["refine_factor"]
+                    or meta.get("search_params", {}) != index_meta["search_params"]):
+                print("Warning: knn graph was built with other search params or refine factor; "
+                      "ignoring it (rerun scripts/build_knn_graph.py)")
+                return None
+            mmap_mode = "r" if mmap_enabled() else None
+            ids = np.load(os.path.join(emb_root, KNN_IDS_FILE), mmap_mode=mmap_mode)
+            dist = np.load(os.path.join(emb_root, KNN_DIST_FILE), mmap_mode=mmap_mode)
+            return ids, dist
+        except Exception as e:
+            print(f"Warning: Failed to load knn graph: {e}")
+            return None
+
+    def _load_index(self) -> Tuple[Any, Dict[str, Any]]:
+        """(index, build meta) of the single-file or sharded (FAISS_SHARDS=true) layout."""
+        if self.sharded:
+            index, manifest = read_shards(os.path.dirname(self.index_path))
+            meta = {k: v for k, v in manifest.items() if k != "shards"}
+            meta["shards"] = [entry["ntotal"] for entry in manifest["shards"]]
+            return index, meta
+        if not os.path.exists(self.index_path):
+            raise FileNotFoundError(f"Missing index at {self.index_path}")
+        return read_index(self.index_path), read_index_meta(self.index_path)
+
+    def _build_snapshot(self) -> ServingSnapshot:
+        index, meta = self._load_index()
+        # Runtime knobs: tuned values from index_meta.json, env overrides on top
+        params = dict(meta.get("search_params") or {})
+        knob = search_knob(index)
+        if knob is not None and knob[0] == "nprobe" and ("FAISS_NPROBE" in os.environ or "nprobe" not in params):
+            nprobe = int(os.getenv("FAISS_NPROBE", "8"))
+            # clamp nprobe sanely to nlist (tuned values are used as measured)
+            params["nprobe"] = max(1, min(nprobe, max(1, knob[2] // 2)))
+        if "FAISS_EFSEARCH" in os.environ:
+            params["efSearch"] = int(os.environ["FAISS_EFSEARCH"])
+        meta["search_params"] = apply_search_params(index, params)
+        # Load id_map (binary id_map/ when current, else id_map.json)
+        idmap = load_id_map(self.idmap_path, mmap=mmap_enabled())
+        # Shared project metadata (re-read only if projects.csv changed)
+        projects = get_project_metadata(self.meta_csv, refresh=True)
+        # Load spatial features
+        spatial_features, spatial_normalizers = self._load_spatial_features()
+        vectors = self._load_vectors(idmap)
+        factor = refine_factor_setting() if lossy_distances(index) and vectors is not None else 0
+        meta["refine_factor"] = factor
+        knn = self._load_knn(index, meta)
+        return ServingSnapshot(index, idmap, projects, spatial_features,
+                               spatial_normalizers, self.emb_dir, vectors, knn, meta, factor)
+
+    def reload(self):
+        """Build the next snapshot off to the side, then publish it atomically.
+
+        In-flight searches keep using the snapshot they grabbed; the old one is
+        freed once the last of them finishes.
+        """
+        with self._lock:
+            snap = self._build_snapshot()
+            self._snap = snap
+
+    def snapshot(self) -> ServingSnapshot:
+        """Current serving snapshot (a plain reference read, no locking)."""
+        return self._snap
+
+    # Convenience accessors that always read the latest snapshot
+    @property
+    def _index(self):
+        return self._snap.index
+
+    @property
+    def _idmap(self) -> IdMap:
+        return self._snap.idmap
+
+    @property
+    def _projects(self) -> ProjectMetadata:
+        return self._snap.projects
+
+    def get_spatial_features(self, project_id: str) -> Optional[List[float]]:
+        return self._snap.get_spatial_features(project_id)
+
+    def spatial_distance(self, project_id1: str, project_id2: str) -> float:
+        return self._snap.spatial_distance(project_id1, project_id2)
+
+    def search(self, q: np.ndarray, top_k: int = 12,
+               filters: Optional[Dict[str, Any]] = None,
+               overrides: Optional[Dict[str, Any]] = None,
+               stats: Optional[Dict[str, Any]] = None,
+               lens: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        return self._snap.search(q, top_k, filters, overrides, stats, lens)
+
+    def search_batch(self, Q: np.ndarray, top_k: int = 12,
+                     filters: Optional[Dict[str, Any]] = None,
+                     overrides: Optional[Dict[str, Any]] = None,
+                     stats: Optional[Dict[str, Any]] = None,
+                     lens: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        return self._snap.search_batch(Q, top_k, filters, overrides, stats, lens)
+
+    def vector_for_image(self, image_id: str) -> np.ndarray:
+        return self._snap.vector_for_image(image_id)
+
+    def results_payload(self, D: np.ndarray, I: np.ndarray) -> List[Dict[str, Any]]:
+        return self._snap.results_payload(D, I)
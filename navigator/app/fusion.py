@@ -0,0 +1,84 @@
+"""
+Vectorized score fusion for Arch-Circare v2.
+
+``fuse_and_sort`` (app.main) scores every candidate as
+
+    w_visual * d_visual + w_spatial * d_spatial + w_attr * d_attr
+
+(lower is better). The pieces here compute each term for the whole candidate
+list at once from the serving snapshot's columns -- attribute category codes
+instead of per-row dict comparisons, one matrix op for spatial distances --
+and order the fused scores by a packed (score, position) key, partitioned
+first when only the best ``limit`` are needed. Ties keep candidate (visual)
+order, exactly like the ``list.sort`` this replaced; tools/check_fusion.py
+pins the ranking.
+"""
+
+import operator
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+def candidate_ids(results: List[dict]) -> np.ndarray:
+    """Faiss ids of hydrated candidates, in candidate order."""
+    return np.fromiter(map(operator.itemgetter("faiss_id"), results), dtype=np.int64, count=len(results))
+
+
+def attribute_distances(store: Optional[Any], ids: np.ndarray, results: List[dict],
+                        filters: Dict[str, Any]) -> np.ndarray:
+    """Fraction of the set ``filters`` each candidate fails (0 when none are set).
+
+    With a snapshot the comparison runs on attribute codes; a value that never
+    occurs, a missing cell and a candidate without metadata all count as a
+    mismatch. Without one it falls back to the hydrated values.
+    """
+    active = [(col, value) for col, value in filters.items() if value]
+    if not active:
+        return np.zeros(len(ids))
+    table = getattr(store, "table", None)
+    mismatches = np.zeros(len(ids), dtype=np.int64)
+    for col, value in active:
+        if table is not None:
+            code = table.projects.code_of(col, value)
+            match = (table.attribute_codes(col, ids) == code) & (code >= 0)
+        else:
+            vals = np.empty(len(results), dtype=object)
+            vals[:] = [r.get(col) for r in results]
+            match = vals == value
+        mismatches += ~match
+    return mismatches / len(active)
+
+
+def fused_scores(w_eff: np.ndarray, dv: np.ndarray, ds: np.ndarray, da: np.ndarray) -> np.ndarray:
+    """Weighted sum in float32, term by term as the scalar loop computed it.
+
+    Every operand is cast to float32 first, so the result does not depend on
+    NumPy 1 (value-based) vs NumPy 2 (NEP 50) scalar promotion.
+    """
+    w = np.asarray(w_eff, dtype=np.float32)
+    dv, ds, da = (np.asarray(x, dtype=np.float32) for x in (dv, ds, da))
+    return w[0] * dv + w[1] * ds + w[2] * da
+
+
+def _order_keys(scores: np.ndarray) -> np.ndarray:
+    """uint64 keys ordering like (score, position): the float32 bits mapped to
+    an order-preserving uint32 in the high half, the position in the low half.
+    Keys are unique, so an unstable sort or partition of them is exact."""
+    bits = (scores.astype(np.float32) + np.float32(0.0)).view(np.uint32).astype(np.uint64)  # -0.0 -> 0.0
+    bits = np.where(bits & 0x80000000, ~bits & 0xFFFFFFFF, bits | 0x80000000)
+    return (bits << np.uint64(32)) | np.arange(len(scores), dtype=np.uint64)
+
+
+def fused_order(scores: np.ndarray, limit: Optional[int] = None) -> np.ndarray:
+    """Positions of ``scores`` ascending, ties in input order (a stable sort).
+
+    With ``limit`` only the best ``limit`` are selected (``np.partition``)
+    and sorted; the result is the same prefix the full sort gives.
+    """
+    keys = _order_keys(scores)
+    if limit is not None and limit < len(keys):
+        if limit <= 0:
+            return np.zeros(0, dtype=np.int64)
+        keys = np.partition(keys, limit - 1)[:limit]
+    return (np.sort(keys) & np.uint64(0xFFFFFFFF)).astype(np.int64)
@@ -0,0 +1,270 @@
+"""
+Binary id map for Arch-Circare v2.
+
+``id_map.json`` maps ``str(faiss_id)`` to ``{"image_id", "project_id",
+"thumb"}``; parsing it builds several Python objects per image. The binary
+form, written next to it as a directory of .npy files (``id_map/``), stores
+the same data as integer arrays indexed by faiss id:
+
+- ``strings.npy`` (uint8) + ``offsets.npy`` (int64): one shared UTF-8 string
+  table holding every image id, thumb path and project id once;
+- ``image_id.npy`` / ``thumb.npy`` (int32): string codes per faiss id;
+- ``project.npy`` (int32): categorical project code per faiss id, indexing
+  ``project_names.npy`` (string codes of the distinct project ids);
+- ``image_order.npy`` (int64): faiss ids sorted by image id, for lookups by
+  binary search.
+
+Everything is memory-mapped, so loading is a handful of ``np.load`` calls
+and only the strings a request touches are decoded. ``meta.json`` records a
+fingerprint of the JSON it was converted from; if the JSON has changed since,
+the JSON wins.
+Convert with ``scripts/convert_id_map.py`` (``embed_images.py`` writes both).
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+IDMAP_JSON = "id_map.json"
+IDMAP_META = "meta.json"
+_ARRAYS = ("strings", "offsets", "image_id", "thumb", "project", "project_names", "image_order")
+
+
+class StringTable:
+    """Concatenated UTF-8 strings addressed by int code (-1 is None)."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get(self, code: int) -> Optional[str]:
+        if code < 0:
+            return None
+        lo, hi = int(self.offsets[code]), int(self.offsets[code + 1])
+        return bytes(self.data[lo:hi]).decode("utf-8")
+
+    def take(self, codes: np.ndarray) -> np.ndarray:
+        """Decode a batch of codes into an object array."""
+        out = np.empty(len(codes), dtype=object)
+        for j, c in enumerate(np.asarray(codes).tolist()):
+            out[j] = self.get(c)
+        return out
+
+    @staticmethod
+    def build(strings: List[str]):
+        """``(data, offsets)`` arrays for a list of distinct strings."""
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+        return data, offsets
+
+
+def _column_fingerprint(data: np.ndarray, lengths: np.ndarray) -> str:
+    """``n:sha1`` over the lengths (-1 for None) and UTF-8 bytes of a string column."""
+    h = hashlib.sha1(np.ascontiguousarray(lengths, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(data, dtype=np.uint8).tobytes())
+    return f"{len(lengths)}:{h.hexdigest()}"
+
+
+def ids_fingerprint(image_ids: List[str]) -> str:
+    """Order-sensitive identity of an image_id list; equals
+    ``IdMap.image_ids_fingerprint`` of a map with the same rows."""
+    data, offsets = StringTable.build(list(image_ids))
+    return _column_fingerprint(data, np.diff(offsets))
+
+
+class IdMap:
+    """Read-only faiss id -> image_id / project_id / thumb table."""
+
+    def __init__(self, strings: StringTable, image_id: np.ndarray, thumb: np.ndarray,
+                 project: np.ndarray, project_names: np.ndarray, image_order: np.ndarray):
+        self.strings = strings
+        self.image_id_codes = image_id
+        self.thumb_codes = thumb
+        self.project = project  # code into project_names, -1 = no project
+        self.project_names = project_names
+        self.image_order = image_order
+        self.n = len(image_id)
+
+    def __len__(self) -> int:
+        return int((self.image_id_codes >= 0).sum())
+
+    def _codes(self, codes: np.ndarray, idxs) -> np.ndarray:
+        """Codes at ``idxs``, with ids outside 0..n-1 mapped to -1."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        ok = (idxs >= 0) & (idxs < self.n)
+        return np.where(ok, codes[np.where(ok, idxs, 0)], -1)
+
+    def image_ids(self, idxs) -> np.ndarray:
+        return self.strings.take(self._codes(self.image_id_codes, idxs))
+
+    def image_ids_fingerprint(self) -> str:
+        """``ids_fingerprint`` of the image_id column in faiss-id order,
+        computed on the string table without decoding."""
+        codes = np.asarray(self.image_id_codes, dtype=np.int64)
+        ok = codes >= 0
+        safe = np.where(ok, codes, 0)
+        offsets = np.asarray(self.strings.offsets)
+        lo = offsets[safe]
+        lengths = np.where(ok, offsets[safe + 1] - lo, -1)
+        sizes = np.maximum(lengths, 0)
+        starts = np.cumsum(sizes) - sizes
+        pos = np.arange(int(sizes.sum()), dtype=np.int64) - np.repeat(starts - lo, sizes)
+        return _column_fingerprint(np.asarray(self.strings.data)[pos], lengths)
+
+    def thumbs(self, idxs) -> np.ndarray:
+        return self.strings.take(self._codes(self.thumb_codes, idxs))
+
+    def project_codes(self, idxs) -> np.ndarray:
+        return self._codes(self.project, idxs)
+
+    def project_ids(self, idxs) -> np.ndarray:
+        codes = self.project_codes(idxs)
+        names = np.append(self.project_names, -1)
+        return self.strings.take(names[np.where(codes >= 0, codes, len(self.project_names))])
+
+    def project_id_list(self) -> List[str]:
+        """Distinct project ids, in project-code order."""
+        return self.strings.take(self.project_names).tolist()
+
+    def row_of(self, image_id: str) -> Optional[int]:
+        """Faiss id of ``image_id`` (binary search over the sorted order)."""
+        lo, hi = 0, len(self.image_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = self.strings.get(int(self.image_id_codes[self.image_order[mid]]))
+            if key < image_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.image_order):
+            row = int(self.image_order[lo])
+            if self.strings.get(int(self.image_id_codes[row])) == image_id:
+                return row
+        return None
+
+    def get(self, i: int) -> Optional[Dict[str, Any]]:
+        """The ``id_map.json`` entry for faiss id ``i`` (None if absent)."""
+        if not 0 <= i < self.n or self.image_id_codes[i] < 0:
+            return None
+        return {"image_id": self.image_ids([i])[0], "project_id": self.project_ids([i])[0],
+                "thumb": self.thumbs([i])[0]}
+
+    @classmethod
+    def from_json(cls, idmap: Dict[str, Any]) -> "IdMap":
+        """Build from the parsed JSON (values may also be bare image_id strings)."""
+        n = max((int(k) for k in idmap), default=-1) + 1
+        table: Dict[str, int] = {}
+
+        def code(s: Optional[str]) -> int:
+            if s is None:
+                return -1
+            return table.setdefault(s, len(table))
+
+        image_id = np.full(n, -1, dtype=np.int32)
+        thumb = np.full(n, -1, dtype=np.int32)
+        project_str = np.full(n, -1, dtype=np.int32)
+        for k, meta in idmap.items():
+            i = int(k)
+            if isinstance(meta, str):
+                meta = {"image_id": meta}
+            image_id[i] = code(meta.get("image_id"))
+            thumb[i] = code(meta.get("thumb"))
+            project_str[i] = code(meta.get("project_id"))
+        # Categorical project codes over the distinct project-id strings
+        names, project = np.unique(project_str, return_inverse=True)
+        project = project.astype(np.int32)
+        if len(names) and names[0] == -1:
+            project -= 1
+            names = names[1:]
+        strings = StringTable(*StringTable.build(list(table)))
+        present = np.flatnonzero(image_id >= 0)
+        keys = strings.take(image_id[present])
+        image_order = present[np.argsort(keys, kind="stable")].astype(np.int64)
+        return cls(strings, image_id, thumb, project, names.astype(np.int32), image_order)
+
+    def save(self, out_dir: str, source: Optional[str] = None) -> str:
+        """Write every array atomically, then ``meta.json`` (readers check it last)."""
+        os.makedirs(out_dir, exist_ok=True)
+        arrays = {
+            "strings": self.strings.data, "offsets": self.strings.offsets,
+            "image_id": self.image_id_codes, "thumb": self.thumb_codes, "project": self.project,
+            "project_names": self.project_names, "image_order": self.image_order,
+        }
+        for name in _ARRAYS:
+            path = os.path.join(out_dir, f"{name}.npy")
+            np.save(path + ".tmp.npy", np.ascontiguousarray(arrays[name]))
+            os.replace(path + ".tmp.npy", path)
+        meta = {"version": 1, "n": self.n, "strings": len(self.strings),
+                "projects": int(len(self.project_names)), "source": source}
+        path = os.path.join(out_dir, IDMAP_META)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+        return out_dir
+
+    @classmethod
+    def load(cls, in_dir: str, mmap: bool = True) -> "IdMap":
+        with open(os.path.join(in_dir, IDMAP_META), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        a = {name: np.load(os.path.join(in_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+             for name in _ARRAYS}
+        if len(a["image_id"]) != meta["n"]:
+            raise ValueError(f"{in_dir} is incomplete: {len(a['image_id'])} ids, meta says {meta['n']}")
+        return cls(StringTable(a["strings"], a["offsets"]), a["image_id"], a["thumb"],
+                   a["project"], a["project_names"], a["image_order"])
+
+
+def binary_dir(path: str) -> str:
+    """``.../id_map.json`` -> ``.../id_map/``."""
+    return os.path.splitext(path)[0]
+
+
+def source_fingerprint(path: str) -> Optional[str]:
+    """Size plus a SHA-256 of the whole file, recorded to detect a stale
+    conversion or derived file (mtimes do not survive a git checkout or copy).
+
+    The content is streamed in 8 MB chunks, so an edit anywhere in the file
+    (same size or not) changes the fingerprint.
+    """
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 << 20), b""):
+            h.update(chunk)
+    return f"{os.path.getsize(path)}:{h.hexdigest()}"
+
+
+def convert_json(json_path: str) -> str:
+    """Write the binary form of ``json_path``; returns its directory."""
+    source = source_fingerprint(json_path)
+    with open(json_path, "r", encoding="utf-8") as f:
+        idmap = json.load(f)
+    return IdMap.from_json(idmap).save(binary_dir(json_path), source)
+
+
+def load_id_map(json_path: str, mmap: bool = True) -> IdMap:
+    """Binary id map beside ``json_path`` if it is current, else parse the JSON."""
+    bin_dir = binary_dir(json_path)
+    meta_path = os.path.join(bin_dir, IDMAP_META)
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                recorded = json.load(f).get("source")
+            current = source_fingerprint(json_path)
+            if current is None or recorded == current:
+                return IdMap.load(bin_dir, mmap)
+            print(f"Warning: {bin_dir} does not match {json_path}; "
+                  "reading the JSON (run scripts/convert_id_map.py)")
+        except Exception as e:
+            print(f"Warning: Failed to load binary id map {bin_dir}: {e}")
+    with open(json_path, "r", encoding="utf-8") as f:
+        return IdMap.from_json(json.load(f))
@@ -0,0 +1,104 @@
+"""
+Dynamic micro-batching for query embeddings.
+
+Concurrent uploads each used to run their own batch-size-1 forward. The
+MicroBatcher lets callers submit preprocessed tensors from any thread; a
+single worker thread gathers whatever arrives within a few milliseconds (up
+to ``max_batch``), runs one batched forward and resolves each caller's
+future with its row.
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Coalesce concurrent forward requests into batched calls.
+
+    ``forward`` receives a list of items and returns an array with one row
+    per item. To keep single-request latency flat, the worker only waits
+    for stragglers when it has recently seen concurrent traffic; an isolated
+    request is run as soon as it is dequeued.
+    """
+
+    def __init__(self, forward: Callable[[List[Any]], np.ndarray],
+                 max_batch: int = 8, max_wait_ms: float = 5.0, name: str = "embed"):
+        self.forward = forward
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: "queue.Queue[tuple[Any, Future, float]]" = queue.Queue()
+        self._last_batch = 1
+        self.batches = 0
+        self.items = 0
+        self._thread = threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """Queue one item; the future resolves to its output row.
+
+        The future also carries ``wait_ms`` (time queued before its batch
+        started) and ``batch_size`` once resolved.
+        """
+        fut: Future = Future()
+        self._queue.put((item, fut, time.monotonic()))
+        return fut
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        # Take whatever is already waiting without blocking
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # Under concurrent load, give stragglers a short window to join
+        if len(batch) < self.max_batch and (len(batch) > 1 or self._last_batch > 1):
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._last_batch = len(batch)
+            started = time.monotonic()
+            items = [item for item, _, _ in batch]
+            try:
+                out = self.forward(items)
+                if len(out) != len(items):
+                    raise RuntimeError(f"forward returned {len(out)} rows for {len(items)} items")
+            except Exception as e:
+                logger.exception("Batched forward failed")
+                for _, fut, _ in batch:
+                    fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for row, (_, fut, queued_at) in zip(out, batch):
+                fut.wait_ms = (started - queued_at) * 1000.0
+                fut.batch_size = len(batch)
+                fut.set_result(row)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch": (self.items / self.batches) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
@@ -8,6 +8,7 @@ import threading
 import numpy as np
 from PIL import Image
 from io import BytesIO
+from starlette.concurrency import run_in_threadpool
 
 def l2n(x: np.ndarray) -> np.ndarray:
     n = np.linalg.norm(x, axis=1, keepdims=True) + 1e-12
@@ -15,18 +16,12 @@ def l2n(x: np.ndarray) -> np.ndarray:
 from app.session import SessionStore, generate_query_id, compute_weight_nudges, apply_weight_nudges
 from app.models import Feedback, Weights
 from app.config import settings
+from app.model_registry import default_model_name, get_model, get_registry, patch_model_name
+from app.budget import QueryPlan, get_cost_model, knob_units, plan_query
+from app.fusion import attribute_distances, candidate_ids, fused_order, fused_scores
 
-# Spatial feature computation imports
-try:
-    from skimage import measure, morphology, filters, util
-    from skimage.measure import label, regionprops
-    from skimage.morphology import binary_closing, skeletonize
-    from skimage.filters import threshold_otsu
-    from scipy import ndimage
-    SPATIAL_AVAILABLE = True
-except ImportError:
-    SPATIAL_AVAILABLE = False
-    print("Warning: skimage/scipy not available, spatial features disabled")
+# Spatial feature computation (skimage/scipy are optional)
+from app.spatial import compute_spatial_features, SPATIAL_AVAILABLE
 
 DATA_DIR = settings.data_dir
 app = FastAPI(title="Design Precedent Navigator API", version="0.2.0")
@@ -50,28 +45,85 @@ if os.path.isdir(plans_dir):
 
 # ---- Lazy singletons ----
 _store: Any | None = None
-_model = None
-_transform = None
 _session_store: SessionStore | None = None
+_store_init_lock = threading.Lock()
+_embed_cache = None
+_batcher = None
+_batcher_lock = threading.Lock()
+_stages: dict = {}
+_stages_lock = threading.Lock()
 
 def get_store():
     global _store
     if _store is None:
-        from app.faiss_service import FaissStore  # lazy import to avoid loading faiss at import time
-        _store = FaissStore(DATA_DIR)
+        with _store_init_lock:
+            if _store is None:
+                from app.faiss_service import FaissStore  # lazy import to avoid loading faiss at import time
+                _store = FaissStore(DATA_DIR)
     return _store
 
+def query_model_name() -> str:
+    return default_model_name()
+
 def get_model_and_transform():
-    global _model, _transform
-    if _model is None:
-        import timm  # defer heavy import
-        model_name = os.getenv("MODEL_NAME", "vit_small_patch14_dinov2")
-        model = timm.create_model(model_name, pretrained=True)
-        model.eval(); model.reset_classifier(0)
-        cfg = timm.data.resolve_data_config({}, model=model)
-        _transform = timm.data.create_transform(**cfg, is_training=False)
-        _model = model
-    return _model, _transform
+    return get_model(query_model_name())
+
+def onnx_dir() -> str:
+    return settings.onnx_dir or os.path.join(DATA_DIR, "models")
+
+def query_backend() -> str:
+    """Backend serving query embeddings ("onnx" falls back to "torch" if unavailable)."""
+    from app.onnx_backend import resolve_backend
+    return resolve_backend(settings.embed_backend, onnx_dir(), query_model_name(), settings.onnx_quantized)
+
+def query_embed_id() -> str:
+    """Identity of query vectors for the embedding cache (model + backend)."""
+    from app.onnx_backend import backend_id
+    return backend_id(query_model_name(), query_backend(), settings.onnx_quantized)
+
+def get_query_encoder():
+    """``(forward, transform)``: forward maps a stacked pixel batch to raw features."""
+    import torch  # defer heavy import
+    if query_backend() == "onnx":
+        from app.onnx_backend import load_onnx
+        name = query_embed_id()
+        encoder, tfm = get_registry().get(name, lambda: load_onnx(
+            onnx_dir(), query_model_name(), settings.onnx_quantized,
+            settings.onnx_intra_threads, settings.onnx_inter_threads,
+        ))
+        return (lambda x: encoder(x.numpy())), tfm
+    model, tfm = get_model_and_transform()
+
+    def forward(x):
+        with torch.no_grad():
+            return model(x).cpu().numpy()
+    return forward, tfm
+
+def get_batcher():
+    """Micro-batcher around the query model (None when batching is disabled)."""
+    global _batcher
+    if settings.embed_batch_max <= 1:
+        return None
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                from app.inference import MicroBatcher
+
+                def forward(xs):
+                    import torch  # defer heavy import
+                    # Looked up per batch so an evicted model is not pinned here
+                    encode, _ = get_query_encoder()
+                    return l2n(encode(torch.stack(xs)).astype("float32"))
+
+                _batcher = MicroBatcher(forward, settings.embed_batch_max, settings.embed_batch_wait_ms)
+    return _batcher
+
+def get_embed_cache():
+    global _embed_cache
+    if _embed_cache is None:
+        from app.embed_cache import EmbeddingCache
+        _embed_cache = EmbeddingCache(settings.embed_cache_size, settings.embed_cache_dir)
+    return _embed_cache
 
 def get_session_store() -> SessionStore:
     global _session_store
@@ -93,72 +145,139 @@ def require_token(authorization: str | None = Header(None)):
     return True
 
 def embed_pil(pil: Image.Image) -> np.ndarray:
-    import torch  # defer heavy import
-    model, tfm = get_model_and_transform()
-    with torch.no_grad():
-        x = tfm(pil.convert("RGB")).unsqueeze(0)
-        feat = model(x)
-        vec = feat.cpu().numpy().astype("float32")
+    encode, tfm = get_query_encoder()
+    # Preprocess on the caller's thread; the forward is shared with
+    # whatever other requests arrive within the batching window
+    x = tfm(pil.convert("RGB"))
+    batcher = get_batcher()
+    if batcher is not None:
+        return batcher.submit(x).result()
+    vec = encode(x.unsqueeze(0)).astype("float32")
     return l2n(vec)[0]
 
-def compute_spatial_features(pil: Image.Image) -> Optional[List[float]]:
-    """Compute spatial features from a plan image."""
-    if not SPATIAL_AVAILABLE:
-        return None
-    
+class LazyUpload:
+    """Uploaded bytes whose image decode is deferred until pixels are needed.
+
+    An embedding-cache hit needs only the bytes; plan-mode spatial features
+    and patch reranking still decode through ``pil``.
+    """
+
+    def __init__(self, content: bytes, decode):
+        self.content = content
+        self._decode = decode
+        self._pil: Image.Image | None = None
+
+    @property
+    def pil(self) -> Image.Image:
+        if self._pil is None:
+            self._pil = self._decode(self.content)
+        return self._pil
+
+def decode_image(content: bytes, detail: str = "Invalid image file") -> Image.Image:
     try:
-        # Convert to grayscale
-        gray = np.array(pil.convert("L"))
-        
-        # Extract floorplate mask
-        # Simple thresholding approach
-        threshold = threshold_otsu(gray)
-        binary = gray < threshold
-        
-        # Clean up the binary image
-        binary = binary_closing(binary)
-        
-        # Find largest connected component (assumed to be the floorplate)
-        labeled = label(binary)
-        if labeled.max() == 0:
-            return None
-        
-        props = regionprops(labeled)
-        largest_comp = max(props, key=lambda x: x.area)
-        floorplate = labeled == largest_comp.label
-        
-        # Compute spatial metrics
-        # Elongation = major_axis_length / minor_axis_length
-        elongation = largest_comp.major_axis_length / largest_comp.minor_axis_length
-        
-        # Convexity = area(floorplate) / area(convex_hull)
-        hull = morphology.convex_hull_image(floorplate)
-        convexity = largest_comp.area / np.sum(hull)
-        convexity = np.clip(convexity, 0.0, 1.0)
-        
-        # Extract space mask (floorplate minus thickened walls)
-        edges = morphology.binary_dilation(floorplate) & ~floorplate
-        thickened_edges = morphology.binary_dilation(edges, morphology.disk(3))
-        space_mask = floorplate & ~thickened_edges
-        
-        # Room count = connected components with sufficient area
-        min_area = 0.002 * largest_comp.area  # 0.2% of floorplate area
-        space_labeled = label(space_mask)
-        space_props = regionprops(space_labeled)
-        room_count = sum(1 for p in space_props if p.area >= min_area)
-        
-        # Corridor ratio = skeleton density
-        if np.sum(space_mask) > 0:
-            skeleton = skeletonize(space_mask)
-            corridor_ratio = np.sum(skeleton) / np.sum(space_mask)
-        else:
-            corridor_ratio = 0.0
-        
-        return [elongation, convexity, room_count, corridor_ratio]
-        
-    except Exception as e:
-        print(f"Error computing spatial features: {e}")
-        return None
+        return Image.open(BytesIO(content))
+    except Exception:
+        raise HTTPException(status_code=400, detail=detail)
+
+def decode_pdf(content: bytes) -> Image.Image:
+    """Render the first page of a PDF."""
+    try:
+        import pypdfium2 as pdfium  # type: ignore
+        pdf = pdfium.PdfDocument(BytesIO(content))
+        page = pdf[0]
+        return page.render(scale=2).to_pil()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid PDF file")
+
+def embed_upload(upload: LazyUpload) -> tuple[np.ndarray, str]:
+    """Embed an upload, reusing the cached vector for repeated bytes.
+
+    Returns: (vector, "hit" | "miss")
+    """
+    cache = get_embed_cache()
+    key = cache.key(upload.content, query_embed_id())
+    vec = cache.get(key)
+    if vec is not None:
+        return vec, "hit"
+    vec = embed_pil(upload.pil)
+    cache.put(key, vec)
+    return vec, "miss"
+
+def get_stage(name: str):
+    """Bounded executor for one CPU-bound upload stage."""
+    if name not in _stages:
+        with _stages_lock:
+            if name not in _stages:
+                from app.executors import StageExecutor
+                workers, kind = {
+                    "embed": (settings.embed_workers, "thread"),
+                    "spatial": (settings.spatial_workers, "process"),
+                    "rerank": (settings.rerank_workers, "thread"),
+                }[name]
+                _stages[name] = StageExecutor(name, workers, kind)
+    return _stages[name]
+
+async def run_stage(name: str, timings: dict, fn, *args, units: float = 1.0):
+    """Run ``fn`` on the stage's pool and record its queue wait and run time.
+
+    The run time also feeds the budget cost model as ``units`` of work.
+    """
+    result, timing = await get_stage(name).run(fn, *args)
+    timings[name] = {k: round(v, 2) for k, v in timing.items()}
+    get_cost_model().observe(name, timing["run_ms"], units)
+    return result
+
+def make_plan(st, quality: Optional[str], budget_ms: Optional[float], top_k: int, **kwargs) -> QueryPlan:
+    """Serving plan for a request's quality tier / latency budget (400 on bad values)."""
+    try:
+        return plan_query(quality, budget_ms, st.knob, top_k, **kwargs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def embed_upload_with_patches(upload: LazyUpload, grid: int = 4) -> tuple[np.ndarray, np.ndarray | None, str]:
+    """Global vector and token patches of an upload from one forward pass.
+
+    Used for reranked queries in ``PATCH_MODE=token``. The shared pass needs
+    the torch query model to also be the patch model; otherwise, and on an
+    embedding-cache hit, the upload is embedded as usual and the patches are
+    left to ``compute_query_patches`` (patches None).
+    """
+    if query_embed_id() != patch_model_name():
+        return (*embed_upload(upload), None)
+    cache = get_embed_cache()
+    key = cache.key(upload.content, query_embed_id())
+    vec = cache.get(key)
+    if vec is not None:
+        return vec, None, "hit"
+    from app.patches import embed_global_and_patches
+    model, tfm = get_model_and_transform()
+    vec, patches = embed_global_and_patches(model, tfm, upload.pil, grid)
+    cache.put(key, vec)
+    return vec, patches, "miss"
+
+def prepare_upload(upload: LazyUpload, need_pixels: bool,
+                   rerank: bool = False) -> tuple[np.ndarray, str, Optional[np.ndarray]]:
+    """Embed an upload and, when a later stage needs them, decode its pixels.
+
+    Returns: (vector, cache status, token patches or None)
+    """
+    if rerank and settings.patch_mode == "token":
+        vec, patches, cache_status = embed_upload_with_patches(upload)
+        if patches is None:
+            upload.pil.load()
+        return vec, cache_status, patches
+    vec, cache_status = embed_upload(upload)
+    if need_pixels:
+        upload.pil.load()
+    return vec, cache_status, None
+
+def rerank_upload(upload: LazyUpload, results: List[dict], re_topk: int, top_k: int,
+                  patches: int, query_patches: Optional[np.ndarray] = None) -> tuple[List[dict], dict]:
+    from app.patches import compute_query_patches, rerank_by_patches
+    mode = settings.patch_mode
+    if query_patches is None:
+        query_patches = compute_query_patches(upload.pil, grid=4, mode=mode)
+    return rerank_by_patches(results, query_patches, re_topk, top_k, patches, DATA_DIR, mode)
 
 # Non-blocking warm-up on startup so health is instant
 @app.on_event("startup")
@@ -171,13 +290,18 @@ async def _startup_warm():
             # Optionally warm model depending on env (default disabled on low-memory plans)
             disable_model_warm = os.getenv("DISABLE_MODEL_WARMUP", "true").lower() == "true"
             if not disable_model_warm:
-                get_model_and_transform()
+                get_query_encoder()
             get_session_store()
         except Exception:
             # Avoid crashing startup on warm errors
             pass
     threading.Thread(target=_warm, daemon=True).start()
 
+@app.on_event("shutdown")
+async def _shutdown_stages():
+    for stage in list(_stages.values()):
+        stage.shutdown()
+
 # Sprint A: Updated request models
 class Filters(BaseModel):
     typology: Optional[str] = None
@@ -200,11 +324,24 @@ class SearchById(BaseModel):
     mode: Optional[str] = None
     lens_ids: Optional[List[str]] = None
     lens_projects: Optional[List[str]] = None
+    quality: Optional[str] = None  # fast | balanced | precise
+    budget_ms: Optional[float] = None
 
 class SearchByVector(BaseModel):
     vector: List[float]
     top_k: int = 12
 
+class SearchBatch(BaseModel):
+    image_ids: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    top_k: int = 12
+    weights: Weights = Weights()
+    filters: Filters = Filters()
+    strict: bool = False
+
+# Upper bound on queries per /search/batch request
+MAX_BATCH_QUERIES = 256
+
 def renorm_weights(wv: float, ws: float, wa: float, has_spatial: bool) -> np.ndarray:
     """Normalize weights, zeroing missing signals and re-normalizing to sum to 1."""
     w = np.array([wv, ws if has_spatial else 0.0, wa], dtype="float32")
@@ -212,18 +349,15 @@ def renorm_weights(wv: float, ws: float, wa: float, has_spatial: bool) -> np.nda
     s = w.sum()
     return (w / s) if s > 0 else np.array([1, 0, 0], dtype="float32")
 
-def attr_distance(row: dict, f: Filters) -> float:
-    checks: List[bool] = []
-    if f.typology:
-        checks.append(row.get("typology") == f.typology)
-    if f.climate_bin:
-        checks.append(row.get("climate_bin") == f.climate_bin)
-    if f.massing_type:
-        checks.append(row.get("massing_type") == f.massing_type)
-    if not checks:
-        return 0.0
-    mismatches = sum(1 for ok in checks if not ok)
-    return mismatches / len(checks)
+def active_filters(f: Filters) -> dict:
+    """Set filters only; None and empty strings mean "no filter", as in fusion."""
+    return {col: value for col, value in f.model_dump().items() if value}
+
+def pushdown_filters(f: Filters, strict: bool) -> Optional[dict]:
+    """Filters to push into the ANN search; only strict mode discards mismatches."""
+    if not strict:
+        return None
+    return active_filters(f) or None
 
 def apply_lens(results: List[dict], lens_ids: Optional[List[str]] = None, 
                lens_projects: Optional[List[str]] = None, top_k: int = 12) -> List[dict]:
@@ -245,15 +379,21 @@ def apply_lens(results: List[dict], lens_ids: Optional[List[str]] = None,
 
 def fuse_and_sort(results: List[dict], D: np.ndarray, weights: Weights, filters: Filters, 
                  strict: bool = False, query_spatial_features: Optional[List[float]] = None, 
-                 store: Optional[Any] = None) -> tuple[List[dict], dict]:
+                 store: Optional[Any] = None, limit: Optional[int] = None,
+                 ids: Optional[np.ndarray] = None) -> tuple[List[dict], dict]:
     """
     Fuse scores using effective weights and return results with debug info.
+    Every term is computed for all candidates at once (see app.fusion);
+    ``ids`` are the faiss ids ``results`` were hydrated from, read back from
+    the results when omitted. With ``limit`` only the best ``limit`` results
+    are ordered and returned, and ``moved`` counts rank changes within them.
     Returns: (sorted_results, debug_info)
     """
     # Normalize visual distances (FAISS distances)
     dv = np.array(D, dtype="float32")
     if dv.size > 1:
-        dv = (dv - dv.min()) / (dv.max() - dv.min() + 1e-12)
+        # float32 epsilon keeps the span float32 under NumPy 1 promotion too
+        dv = (dv - dv.min()) / (dv.max() - dv.min() + np.float32(1e-12))
     else:
         dv = np.zeros_like(dv)
 
@@ -263,28 +403,19 @@ def fuse_and_sort(results: List[dict], D: np.ndarray, weights: Weights, filters:
     # Compute effective weights
     w_eff = renorm_weights(weights.visual, weights.spatial, weights.attr, has_spatial)
     
-    # Store baseline visual-only ranking for comparison
-    baseline_ranking = [r["image_id"] for r in results[:len(dv)]]
-    
-    fused = []
-    for j, r in enumerate(results):
-        da = attr_distance(r, filters)
-        if strict and da > 0.0:
-            continue
-        
-        # Compute spatial distance if available
-        ds = 0.0
-        if has_spatial and r.get("project_id"):
-            candidate_features = store.get_spatial_features(r["project_id"])
-            if candidate_features is not None:
-                ds = np.linalg.norm(np.array(query_spatial_features) - np.array(candidate_features))
-        
-        # Fuse score (lower is better)
-        score = w_eff[0] * float(dv[j]) + w_eff[1] * float(ds) + w_eff[2] * float(da)
-        fused.append((score, r))
+    # Columnar candidate view; the visual ranking is candidate order
+    ids = candidate_ids(results) if ids is None else np.asarray(ids, dtype=np.int64)
+    da = attribute_distances(store, ids, results, filters.model_dump())
+    if has_spatial:
+        ds = store.spatial_distances(ids, query_spatial_features)
+    else:
+        ds = np.zeros(len(ids))
     
-    fused.sort(key=lambda x: x[0])
-    sorted_results = [r for _, r in fused]
+    # Fuse scores (lower is better); strict mode drops any attribute mismatch
+    scores = fused_scores(w_eff, dv[:len(ids)], ds, da)
+    kept = np.flatnonzero(da <= 0.0) if strict else np.arange(len(ids))
+    order = kept[fused_order(scores[kept], limit)]
+    sorted_results = list(map(results.__getitem__, order.tolist()))
     
     # Compute debug information
     debug = {
@@ -302,14 +433,114 @@ def fuse_and_sort(results: List[dict], D: np.ndarray, weights: Weights, filters:
         "moved": 0
     }
     
-    # Calculate how many ranks changed vs baseline
-    if len(sorted_results) >= len(baseline_ranking):
-        new_ranking = [r["image_id"] for r in sorted_results[:len(baseline_ranking)]]
-        moved = sum(1 for i, (old, new) in enumerate(zip(baseline_ranking, new_ranking)) if old != new)
-        debug["moved"] = moved
+    # Calculate how many ranks changed vs baseline (only when nothing was dropped)
+    if len(kept) == len(ids):
+        debug["moved"] = int((ids[order] != ids[:len(order)]).sum())
     
     return sorted_results, debug
 
+def run_search(st, q: np.ndarray, top_k: int, f: Filters, w: Weights, strict: bool = False,
+               lens_ids: Optional[List[str]] = None, lens_projects: Optional[List[str]] = None,
+               query_spatial_features: Optional[List[float]] = None,
+               min_k: int = 0, image_id: Optional[str] = None,
+               query_plan: Optional[QueryPlan] = None) -> tuple[List[dict], List[dict], dict, int]:
+    """
+    Shared search -> hydrate -> fuse -> lens path with adaptive candidate depth.
+
+    The first depth comes from corpus statistics (see app.search_depth); if
+    fewer than top_k results survive strict filtering, the search is repeated
+    twice as deep until it fills up or runs out of eligible ids. Strict
+    filters and the lens are pushed into the index as one id bitmap (a lens
+    without corpus members is not pushed, so apply_lens falls back to the
+    unlensed results).
+    When ``image_id`` names a corpus image and neither strict filters nor a
+    lens apply, neighbours come from the precomputed kNN graph instead.
+    ``query_plan`` (see app.budget) scales the depth, caps the rounds and
+    overrides the index's search knob for this request.
+    Returns: (hydrated, lensed_results, debug_info, search_ms)
+    """
+    from app.search_depth import predict_depth
+
+    qp = query_plan or QueryPlan()
+    cost = get_cost_model()
+
+    pushed = pushdown_filters(f, strict)
+    has_lens = bool(lens_ids or lens_projects)
+    lens = st.lens_bitmap(lens_ids, lens_projects)
+    if lens is not None and not lens.any():
+        lens = None
+    eligible = st.filter_count(pushed, lens)
+    cap = st.ntotal if eligible is None else eligible
+    predicted = predict_depth(
+        st.stats, top_k, active_filters(f), strict, w.attr,
+        spatial=query_spatial_features is not None and w.spatial > 0, min_k=min_k,
+    )
+    k = max(1, min(int(predicted * qp.depth_scale), cap))
+    use_graph = image_id is not None and pushed is None and not has_lens
+    source = "index"
+    rounds = 0
+    ms = 0
+    search_stats: dict = {}
+    while True:
+        rounds += 1
+        t0 = time.time()
+        hit = st.neighbors_for_image(image_id, k) if use_graph else None
+        if hit is not None:
+            D, I = hit
+            source = "knn_graph"
+        elif cap > 0:
+            D, I = st.search(q, k, filters=pushed, overrides=qp.search_params, stats=search_stats,
+                             lens=lens)
+            cost.observe("search", (time.time() - t0) * 1000, knob_units(st.knob, qp.search_params))
+        else:
+            D, I = np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+        ms += int((time.time() - t0) * 1000)
+        t1 = time.time()
+        hydrated = st.results_payload(D, I)
+        fused_results, debug = fuse_and_sort(hydrated, D, w, f, strict=strict,
+                                             query_spatial_features=query_spatial_features, store=st, ids=I)
+        cost.observe("fuse", (time.time() - t1) * 1000, len(hydrated))
+        if len(fused_results) >= top_k or k >= cap or (qp.max_rounds and rounds >= qp.max_rounds):
+            break
+        k = min(cap, k * 2)
+
+    lensed_results = apply_lens(fused_results, lens_ids, lens_projects, top_k)
+    debug["lens"] = {"ids": len(lens_ids or []), "projects": len(lens_projects or [])}
+    debug["depth"] = {"predicted_k": predicted, "search_k": k, "rounds": rounds, "source": source}
+    if pushed or lens is not None:
+        debug["filter_pushdown"] = {"eligible": eligible}
+    if "refine" in search_stats:
+        refine = search_stats["refine"]
+        debug["refine"] = {**refine, "ms": round(refine["ms"], 3)}
+    return hydrated, lensed_results, debug, ms
+
+def spatial_debug(st, query_spatial_features: List[float], hydrated: List[dict]) -> dict:
+    """Query spatial features plus those of the top-3 visual candidates."""
+    debug_spatial = {
+        "query_features": {
+            "elongation": query_spatial_features[0],
+            "convexity": query_spatial_features[1],
+            "room_count": query_spatial_features[2],
+            "corridor_ratio": query_spatial_features[3]
+        },
+        "top_candidates": []
+    }
+    for i, result in enumerate(hydrated[:3]):
+        if result.get("project_id"):
+            candidate_features = st.get_spatial_features(result["project_id"])
+            if candidate_features is not None:
+                debug_spatial["top_candidates"].append({
+                    "rank": i + 1,
+                    "project_id": result["project_id"],
+                    "features": {
+                        "elongation": candidate_features[0],
+                        "convexity": candidate_features[1],
+                        "room_count": candidate_features[2],
+                        "corridor_ratio": candidate_features[3]
+                    }
+                })
+    return debug_spatial
+
 @app.get("/healthz")
 def healthz():
     # Lightweight health check; avoid loading heavy subsystems
@@ -327,17 +558,61 @@ def latent_points():
     df = df.fillna("")
     return {"results": df.to_dict(orient="records")}
 
+@app.get("/admin/stages")
+def stage_stats():
+    """Concurrency and queue-wait counters for the upload stage pools."""
+    return {name: stage.stats() for name, stage in list(_stages.items())}
+
+@app.get("/admin/budget")
+def budget_stats():
+    """Per-stage cost estimates behind budget_ms / quality plans."""
+    return get_cost_model().stats()
+
+@app.get("/admin/models")
+def list_models():
+    """Models held by the shared registry and their weight memory."""
+    registry = get_registry()
+    return {"models": registry.stats(), "memory_bytes": registry.memory_bytes()}
+
+def configured_models() -> List[str]:
+    """Registry entries this server uses: query model (or its ONNX session) and patch model."""
+    return list(dict.fromkeys([query_model_name(), query_embed_id(), patch_model_name()]))
+
+def require_configured_model(name: str):
+    if name not in configured_models():
+        raise HTTPException(status_code=404, detail=f"Model {name} is not configured")
+
+@app.post("/admin/models/{name}/preload")
+def preload_model(name: str, _: bool = Depends(require_token)):
+    require_configured_model(name)
+    try:
+        registry = get_registry()
+        if name != query_model_name() and name == query_embed_id():
+            get_query_encoder()  # ONNX session: needs its own loader
+            return {"ok": True, "model": name, **registry.stats()[name]}
+        return {"ok": True, "model": name, **registry.preload(name)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/models/{name}/evict")
+def evict_model(name: str, _: bool = Depends(require_token)):
+    require_configured_model(name)
+    if not get_registry().evict(name):
+        raise HTTPException(status_code=404, detail=f"Model {name} is not loaded")
+    return {"ok": True, "model": name}
+
 @app.post("/admin/reload-index")
 def reload_index():
     try:
-        get_store().reload()
-        return {"ok": True, "msg": "Index reloaded."}
+        store = get_store()
+        store.reload()
+        return {"ok": True, "msg": "Index reloaded.", "index": store.snapshot().index_meta}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/search/id")
 def search_id(body: SearchById, _: bool = Depends(require_token)):
-    st = get_store()
+    st = get_store().snapshot()  # pin one snapshot for the whole request
     try:
         q = st.vector_for_image(body.image_id)
     except FileNotFoundError as e:
@@ -346,14 +621,8 @@ def search_id(body: SearchById, _: bool = Depends(require_token)):
     # Generate query ID
     query_id = generate_query_id()
     
-    # Determine search k based on lens filtering
-    search_k = max(body.top_k * 5, len(body.lens_ids or []) * 2, len(body.lens_projects or []) * 6, 100)
-    
-    t0 = time.time()
-    D, I = st.search(q, search_k)
-    ms = int((time.time() - t0) * 1000)
-    hydrated = st.results_payload(D, I)
-    
+    qp = make_plan(st, body.quality, body.budget_ms, body.top_k, rerank_available=False)
+
     # Compute spatial features if in plan mode
     query_spatial_features = None
     if body.mode == "plan" or body.mode == "true":
@@ -361,19 +630,13 @@ def search_id(body: SearchById, _: bool = Depends(require_token)):
         # This is a simplified approach - in practice you might want to store pre-computed features
         pass
     
-    fused_results, debug = fuse_and_sort(hydrated, D, body.weights, body.filters, 
-                                        strict=body.strict, 
-                                        query_spatial_features=query_spatial_features, 
-                                        store=st)
-    
-    # Apply lens filtering
-    lensed_results = apply_lens(fused_results, body.lens_ids, body.lens_projects, body.top_k)
-    
-    # Add lens debug info
-    debug["lens"] = {
-        "ids": len(body.lens_ids or []),
-        "projects": len(body.lens_projects or [])
-    }
+    _, lensed_results, debug, ms = run_search(
+        st, q, body.top_k, body.filters, body.weights, strict=body.strict,
+        lens_ids=body.lens_ids, lens_projects=body.lens_projects,
+        query_spatial_features=query_spatial_features, image_id=body.image_id, query_plan=qp,
+    )
+    if body.quality or body.budget_ms:
+        debug["budget"] = qp.debug()
     
     return {
         "query_id": query_id,
@@ -388,22 +651,14 @@ def search_id(body: SearchById, _: bool = Depends(require_token)):
 @app.get("/projects")
 def list_projects(_: bool = Depends(require_token)):
     """Get all projects with their metadata"""
-    store = get_store()
-    if store._projects is None or store._projects.empty:
+    meta = get_store()._projects
+    if meta is None or meta.empty:
         return []
     
-    projects = []
-    for _, row in store._projects.iterrows():
-        projects.append({
-            "project_id": row.get("project_id"),
-            "title": row.get("title"),
-            "country": row.get("country"),
-            "typology": row.get("typology"),
-            "climate_bin": row.get("climate_bin"),
-            "massing_type": row.get("massing_type"),
-            "wwr_band": row.get("wwr_band")
-        })
-    return projects
+    rows = np.arange(meta.n)
+    cols = {c: meta.take(c, rows) for c in
+            ("project_id", "title", "country", "typology", "climate_bin", "massing_type", "wwr_band")}
+    return [{c: vals[r] for c, vals in cols.items()} for r in range(meta.n)]
 
 @app.get("/projects/{project_id}/images")
 def list_project_images(project_id: str, _: bool = Depends(require_token)):
@@ -426,7 +681,7 @@ def list_project_images(project_id: str, _: bool = Depends(require_token)):
 
 @app.post("/search/vector")
 def search_vector(body: SearchByVector, _: bool = Depends(require_token)):
-    st = get_store()
+    st = get_store().snapshot()
     q = np.array(body.vector, dtype="float32")
     if q.ndim != 1:
         raise HTTPException(status_code=400, detail="Vector must be 1-D")
@@ -435,6 +690,84 @@ def search_vector(body: SearchByVector, _: bool = Depends(require_token)):
     ms = int((time.time() - t0) * 1000)
     return {"latency_ms": ms, "results": st.results_payload(D, I)}
 
+@app.post("/search/batch")
+def search_batch(body: SearchBatch, _: bool = Depends(require_token)):
+    """Many queries (corpus image_ids and/or raw vectors) in one matrix search.
+
+    Fusion and hydration run over the whole batch; unknown image_ids are
+    reported per query instead of failing the request.
+    """
+    from app.search_depth import predict_depth
+
+    st = get_store().snapshot()
+    image_ids = body.image_ids or []
+    vectors = body.vectors or []
+    n_queries = len(image_ids) + len(vectors)
+    if n_queries == 0:
+        raise HTTPException(status_code=400, detail="Provide image_ids and/or vectors")
+    if n_queries > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+
+    queries: List[dict] = []
+    rows: List[np.ndarray] = []
+    for image_id in image_ids:
+        try:
+            rows.append(st.vector_for_image(image_id))
+            queries.append({"image_id": image_id})
+        except FileNotFoundError as e:
+            queries.append({"image_id": image_id, "error": str(e)})
+    for i, vec in enumerate(vectors):
+        if len(vec) != st.index.d:
+            queries.append({"vector_index": i, "error": f"Vector must have {st.index.d} dimensions"})
+            continue
+        rows.append(np.array(vec, dtype="float32"))
+        queries.append({"vector_index": i})
+
+    pushed = pushdown_filters(body.filters, body.strict)
+    eligible = st.filter_count(pushed)
+    cap = st.ntotal if eligible is None else eligible
+    search_k = min(cap, predict_depth(st.stats, body.top_k, active_filters(body.filters),
+                                      body.strict, body.weights.attr))
+    ms = 0
+    fused_rows: List[tuple] = []
+    search_stats: dict = {}
+    if rows and search_k > 0:
+        t0 = time.time()
+        D, I = st.search_batch(np.stack(rows), search_k, filters=pushed, stats=search_stats)
+        ms = int((time.time() - t0) * 1000)
+        fused_rows = [
+            fuse_and_sort(hydrated, d, body.weights, body.filters, strict=body.strict, store=st,
+                          limit=body.top_k)
+            for d, hydrated in st.results_payload_batch(D, I)
+        ]
+
+    out = []
+    it = iter(fused_rows)
+    for query in queries:
+        if "error" in query:
+            out.append({**query, "results": []})
+            continue
+        fused_results, debug = next(it, ([], {}))
+        debug.pop("weights_requested", None)
+        debug.pop("weights_effective", None)
+        out.append({**query, "results": fused_results[:body.top_k], "debug": debug})
+
+    w_eff = renorm_weights(body.weights.visual, body.weights.spatial, body.weights.attr, False)
+    debug_info = {"search_k": search_k, "queries": n_queries, "searched": len(rows)}
+    if pushed:
+        debug_info["filter_pushdown"] = {"eligible": eligible}
+    if "refine" in search_stats:
+        debug_info["refine"] = {**search_stats["refine"], "ms": round(search_stats["refine"]["ms"], 3)}
+    return {
+        "query_id": generate_query_id(),
+        "latency_ms": ms,
+        "weights": body.weights.model_dump(),
+        "weights_effective": {"visual": float(w_eff[0]), "spatial": float(w_eff[1]), "attr": float(w_eff[2])},
+        "filters": body.filters.model_dump(),
+        "queries": out,
+        "debug": debug_info,
+    }
+
 @app.post("/search/file")
 async def search_file(
     file: UploadFile = File(...),
@@ -452,13 +785,12 @@ async def search_file(
     mode: Optional[str] = None,
     lens_ids: Optional[str] = None,
     lens_projects: Optional[str] = None,
+    quality: Optional[str] = None,
+    budget_ms: Optional[float] = None,
     _: bool = Depends(require_token),
 ):
-    st = get_store()
-    try:
-        pil = Image.open(file.file)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid image file.")
+    st = get_store().snapshot()
+    upload = LazyUpload(await file.read(), lambda c: decode_image(c, "Invalid image file."))
     
     # Parse lens parameters
     lens_ids_list = None
@@ -468,76 +800,45 @@ async def search_file(
     if lens_projects:
         lens_projects_list = [x.strip() for x in lens_projects.split(",") if x.strip()]
     
-    # Determine search k based on reranking and lens filtering
-    search_k = max(top_k, re_topk) if rerank else top_k
-    search_k = max(search_k, top_k * 5, len(lens_ids_list or []) * 2, len(lens_projects_list or []) * 6, 100)
-    
-    q = embed_pil(pil)
-    t0 = time.time()
-    D, I = st.search(q, search_k)
-    ms = int((time.time() - t0) * 1000)
-    hydrated = st.results_payload(D, I)
     f = Filters(typology=typology, climate_bin=climate_bin, massing_type=massing_type)
     w = Weights(visual=w_visual, attr=w_attr, spatial=w_spatial)
+    plan = mode == "plan" or mode == "true"
+    # Quality tier / latency budget decide which stages run and how deep
+    qp = make_plan(st, quality, budget_ms, top_k, rerank=rerank, re_topk=re_topk, spatial=plan, embed=True)
+    plan, rerank = qp.spatial, qp.rerank
+    re_topk = qp.re_topk if rerank else re_topk
+    # CPU-bound stages run on bounded pools so the event loop stays free
+    stages: dict = {}
+    q, cache_status, query_patches = await run_stage(
+        "embed", stages, prepare_upload, upload, plan or rerank, rerank
+    )
     
     # Compute spatial features if in plan mode
     query_spatial_features = None
-    debug_spatial = None
-    if mode == "plan" or mode == "true":
-        query_spatial_features = compute_spatial_features(pil)
-        if query_spatial_features is not None:
-            # Create debug info with query features and top-3 candidates
-            debug_spatial = {
-                "query_features": {
-                    "elongation": query_spatial_features[0],
-                    "convexity": query_spatial_features[1],
-                    "room_count": query_spatial_features[2],
-                    "corridor_ratio": query_spatial_features[3]
-                },
-                "top_candidates": []
-            }
-            
-            # Add top-3 candidates' spatial features
-            for i, result in enumerate(hydrated[:3]):
-                if result.get("project_id"):
-                    candidate_features = st.get_spatial_features(result["project_id"])
-                    if candidate_features is not None:
-                        debug_spatial["top_candidates"].append({
-                            "rank": i + 1,
-                            "project_id": result["project_id"],
-                            "features": {
-                                "elongation": candidate_features[0],
-                                "convexity": candidate_features[1],
-                                "room_count": candidate_features[2],
-                                "corridor_ratio": candidate_features[3]
-                            }
-                        })
+    if plan:
+        query_spatial_features = await run_stage("spatial", stages, compute_spatial_features, upload.pil)
     
-    # Use new fusion function
-    fused_results, fusion_debug = fuse_and_sort(hydrated, D, w, f, strict=strict, 
-                                               query_spatial_features=query_spatial_features, store=st)
-    
-    # Apply lens filtering
-    lensed_results = apply_lens(fused_results, lens_ids_list, lens_projects_list, top_k)
+    # Search, fuse and lens; depth adapts to filters, lens and reranking
+    hydrated, lensed_results, fusion_debug, ms = await run_in_threadpool(
+        run_search, st, q, top_k, f, w, strict=strict, lens_ids=lens_ids_list,
+        lens_projects=lens_projects_list, query_spatial_features=query_spatial_features,
+        min_k=re_topk if rerank else 0, query_plan=qp,
+    )
+    debug_spatial = None
+    if query_spatial_features is not None:
+        # Query features and top-3 candidates' spatial features
+        debug_spatial = spatial_debug(st, query_spatial_features, hydrated)
     
     # Apply patch reranking if requested
     debug_info = fusion_debug.copy()
     if rerank:
-        from app.patches import compute_query_patches, rerank_by_patches
-        rerank_t0 = time.time()
-        
-        # Compute query patches
-        query_patches = compute_query_patches(pil, grid=4)
-        
-        # Rerank results
-        reranked_results, rerank_debug = rerank_by_patches(
-            lensed_results, query_patches, re_topk, top_k, patches, DATA_DIR
+        reranked_results, rerank_debug = await run_stage(
+            "rerank", stages, rerank_upload, upload, lensed_results, re_topk, top_k, patches,
+            query_patches, units=min(re_topk, len(lensed_results)),
         )
-        
-        rerank_ms = int((time.time() - rerank_t0) * 1000)
         debug_info.update({
             **rerank_debug,
-            "rerank_latency_ms": rerank_ms,
+            "rerank_latency_ms": int(stages["rerank"]["run_ms"]),
             "rerank": "patch_min"
         })
         
@@ -548,12 +849,10 @@ async def search_file(
     # Combine debug info
     if debug_spatial is not None:
         debug_info["spatial"] = debug_spatial
-    
-    # Add lens debug info
-    debug_info["lens"] = {
-        "ids": len(lens_ids_list or []),
-        "projects": len(lens_projects_list or [])
-    }
+    debug_info["embed_cache"] = cache_status
+    debug_info["stages"] = stages
+    if quality or budget_ms:
+        debug_info["budget"] = qp.debug()
     
     # Generate query ID
     query_id = generate_query_id()
@@ -593,6 +892,8 @@ async def upload_query_image(
     mode: Optional[str] = None,
     lens_ids: Optional[str] = None,
     lens_projects: Optional[str] = None,
+    quality: Optional[str] = None,
+    budget_ms: Optional[float] = None,
     session_id: Optional[str] = None,
     _: bool = Depends(require_token),
 ):
@@ -602,73 +903,47 @@ async def upload_query_image(
     content = await file.read()
     _validate_size(content)
 
-    # Open PIL from bytes; no persistence
-    try:
-        pil = Image.open(BytesIO(content))
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid image file")
+    # Decode lazily from bytes; no persistence
+    upload = LazyUpload(content, decode_image)
 
     # Delegate to search logic (same as /search/file)
-    st = get_store()
+    st = get_store().snapshot()
 
     # Parse lens parameters
     lens_ids_list = [x.strip() for x in (lens_ids or "").split(",") if x.strip()] or None
     lens_projects_list = [x.strip() for x in (lens_projects or "").split(",") if x.strip()] or None
 
-    search_k = max(top_k, re_topk) if rerank else top_k
-    search_k = max(search_k, top_k * 5, len(lens_ids_list or []) * 2, len(lens_projects_list or []) * 6, 100)
-
-    q = embed_pil(pil)
-    t0 = time.time()
-    D, I = st.search(q, search_k)
-    ms = int((time.time() - t0) * 1000)
-    hydrated = st.results_payload(D, I)
     f = Filters(typology=typology, climate_bin=climate_bin, massing_type=massing_type)
     w = Weights(visual=w_visual, attr=w_attr, spatial=w_spatial)
+    plan = mode == "plan" or mode == "true"
+    qp = make_plan(st, quality, budget_ms, top_k, rerank=rerank, re_topk=re_topk, spatial=plan, embed=True)
+    plan, rerank = qp.spatial, qp.rerank
+    re_topk = qp.re_topk if rerank else re_topk
+    stages: dict = {}
+    q, cache_status, query_patches = await run_stage(
+        "embed", stages, prepare_upload, upload, plan or rerank, rerank
+    )
 
     query_spatial_features = None
-    debug_spatial = None
-    if mode == "plan" or mode == "true":
-        query_spatial_features = compute_spatial_features(pil)
-        if query_spatial_features is not None:
-            debug_spatial = {
-                "query_features": {
-                    "elongation": query_spatial_features[0],
-                    "convexity": query_spatial_features[1],
-                    "room_count": query_spatial_features[2],
-                    "corridor_ratio": query_spatial_features[3],
-                },
-                "top_candidates": [],
-            }
-            for i, result in enumerate(hydrated[:3]):
-                if result.get("project_id"):
-                    candidate_features = st.get_spatial_features(result["project_id"])
-                    if candidate_features is not None:
-                        debug_spatial["top_candidates"].append({
-                            "rank": i + 1,
-                            "project_id": result["project_id"],
-                            "features": {
-                                "elongation": candidate_features[0],
-                                "convexity": candidate_features[1],
-                                "room_count": candidate_features[2],
-                                "corridor_ratio": candidate_features[3],
-                            },
-                        })
-
-    fused_results, fusion_debug = fuse_and_sort(
-        hydrated, D, w, f, strict=strict, query_spatial_features=query_spatial_features, store=st
+    if plan:
+        query_spatial_features = await run_stage("spatial", stages, compute_spatial_features, upload.pil)
+
+    hydrated, lensed_results, fusion_debug, ms = await run_in_threadpool(
+        run_search, st, q, top_k, f, w, strict=strict, lens_ids=lens_ids_list,
+        lens_projects=lens_projects_list, query_spatial_features=query_spatial_features,
+        min_k=re_topk if rerank else 0, query_plan=qp,
     )
-    lensed_results = apply_lens(fused_results, lens_ids_list, lens_projects_list, top_k)
+    debug_spatial = None
+    if query_spatial_features is not None:
+        debug_spatial = spatial_debug(st, query_spatial_features, hydrated)
 
     debug_info = fusion_debug.copy()
     if rerank:
-        from app.patches import compute_query_patches, rerank_by_patches
-        rerank_t0 = time.time()
-        query_patches = compute_query_patches(pil, grid=4)
-        reranked_results, rerank_debug = rerank_by_patches(
-            lensed_results, query_patches, re_topk, top_k, patches, DATA_DIR
+        reranked_results, rerank_debug = await run_stage(
+            "rerank", stages, rerank_upload, upload, lensed_results, re_topk, top_k, patches,
+            query_patches, units=min(re_topk, len(lensed_results)),
         )
-        rerank_ms = int((time.time() - rerank_t0) * 1000)
+        rerank_ms = int(stages["rerank"]["run_ms"])
         debug_info.update({**rerank_debug, "rerank_latency_ms": rerank_ms, "rerank": "patch_min"})
         final_results = reranked_results
     else:
@@ -676,7 +951,10 @@ async def upload_query_image(
 
     if debug_spatial is not None:
         debug_info["spatial"] = debug_spatial
-    debug_info["lens"] = {"ids": len(lens_ids_list or []), "projects": len(lens_projects_list or [])}
+    debug_info["embed_cache"] = cache_status
+    debug_info["stages"] = stages
+    if quality or budget_ms:
+        debug_info["budget"] = qp.debug()
 
     query_id = generate_query_id()
 
@@ -701,46 +979,58 @@ async def upload_explore(
     w_spatial: float = 0.6,
     mode: Optional[str] = None,
     session_id: Optional[str] = None,
+    quality: Optional[str] = None,
+    budget_ms: Optional[float] = None,
     _: bool = Depends(require_token),
 ):
     # Accept JPG/PNG/PDF; convert PDF first page to image
     content = await file.read()
     _validate_size(content)
 
-    pil: Image.Image | None = None
     if file.content_type in {"image/jpeg", "image/png", "image/jpg"}:
-        try:
-            pil = Image.open(BytesIO(content))
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid image file")
+        upload = LazyUpload(content, decode_image)
     elif file.content_type == "application/pdf":
         if not settings.allow_pdf:
             raise HTTPException(status_code=415, detail="PDF uploads are disabled")
-        try:
-            import pypdfium2 as pdfium  # type: ignore
-            pdf = pdfium.PdfDocument(BytesIO(content))
-            page = pdf[0]
-            pil = page.render(scale=2).to_pil()
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid PDF file")
+        upload = LazyUpload(content, decode_pdf)
     else:
         raise HTTPException(status_code=415, detail="Unsupported file type")
 
-    st = get_store()
-    q = embed_pil(pil)
-    t0 = time.time()
-    D, I = st.search(q, top_k)
-    ms = int((time.time() - t0) * 1000)
-    hydrated = st.results_payload(D, I)
+    st = get_store().snapshot()
+    plan = mode == "plan" or mode == "true"
+    qp = make_plan(st, quality, budget_ms, top_k, spatial=plan, embed=True, rerank_available=False)
+    plan = qp.spatial
+    stages: dict = {}
+    q, cache_status, _ = await run_stage("embed", stages, prepare_upload, upload, plan)
+    search_stats: dict = {}
+
+    def search_and_hydrate():
+        t0 = time.time()
+        D, I = st.search(q, top_k, overrides=qp.search_params, stats=search_stats)
+        search_ms = (time.time() - t0) * 1000
+        get_cost_model().observe("search", search_ms, knob_units(st.knob, qp.search_params))
+        return D, st.results_payload(D, I), search_ms
+
+    # FAISS search and hydration stay off the event loop, as in /upload
+    D, hydrated, search_ms = await run_in_threadpool(search_and_hydrate)
+    ms = int(search_ms)
     f = Filters()
     w = Weights(visual=w_visual, attr=w_attr, spatial=w_spatial)
 
     query_spatial_features = None
-    if mode == "plan" or mode == "true":
-        query_spatial_features = compute_spatial_features(pil)
+    if plan:
+        query_spatial_features = await run_stage("spatial", stages, compute_spatial_features, upload.pil)
 
-    final_results, debug_info = fuse_and_sort(hydrated, D, w, f, strict=False, 
-                                              query_spatial_features=query_spatial_features, store=st)
+    final_results, debug_info = await run_in_threadpool(
+        fuse_and_sort, hydrated, D, w, f, strict=False,
+        query_spatial_features=query_spatial_features, store=st,
+    )
+    debug_info["embed_cache"] = cache_status
+    debug_info["stages"] = stages
+    if "refine" in search_stats:
+        debug_info["refine"] = {**search_stats["refine"], "ms": round(search_stats["refine"]["ms"], 3)}
+    if quality or budget_ms:
+        debug_info["budget"] = qp.debug()
     query_id = generate_query_id()
     return {
         "query_id": query_id,
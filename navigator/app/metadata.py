@@ -0,0 +1,255 @@
+"""
+Columnar project metadata for Arch-Circare v2.
+
+``projects.csv`` used to be parsed with pandas by every consumer and then
+scanned with ``df[df.project_id == pid]`` per lookup. ``ProjectMetadata``
+holds it once per process:
+
+- scalar columns (title, country, typology, ...) as int32 codes into a small
+  per-column category array, -1 for a missing cell;
+- a project_id -> row hash index (first occurrence wins, as with ``iloc[0]``);
+- the ``|``-separated image_ids / plan_ids / tags columns pre-split into one
+  string table with per-row bounds.
+
+``scripts/convert_metadata.py`` writes the same columns as .npy files in
+``metadata/projects/`` for startup without pandas parsing; like the binary id
+map it records a fingerprint of the CSV and the CSV wins once it changes.
+``get_project_metadata`` hands every consumer the same instance.
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.idmap import StringTable, binary_dir, source_fingerprint
+
+# Columns stored as pre-split lists rather than categories
+LIST_COLUMNS = ("image_ids", "plan_ids", "tags")
+METADATA_META = "meta.json"
+
+
+def split_list(value: Any) -> List[str]:
+    """``"a|b| c"`` -> ``["a", "b", "c"]``; missing cells give []."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return []
+    return [x.strip() for x in str(value).split("|") if x.strip()]
+
+
+def _python(v: Any) -> Any:
+    return v.item() if isinstance(v, np.generic) else v
+
+
+class ListColumn:
+    """Per-row string lists: item codes into a string table plus row bounds."""
+
+    def __init__(self, strings: StringTable, items: np.ndarray, bounds: np.ndarray):
+        self.strings = strings
+        self.items = items
+        self.bounds = bounds
+
+    def __getitem__(self, row: int) -> List[str]:
+        if not 0 <= row < len(self.bounds) - 1:
+            return []
+        lo, hi = int(self.bounds[row]), int(self.bounds[row + 1])
+        return self.strings.take(self.items[lo:hi]).tolist()
+
+    @classmethod
+    def build(cls, lists: Sequence[List[str]]) -> "ListColumn":
+        table: Dict[str, int] = {}
+        items = np.array([table.setdefault(x, len(table)) for xs in lists for x in xs], dtype=np.int32)
+        bounds = np.zeros(len(lists) + 1, dtype=np.int64)
+        bounds[1:] = np.cumsum([len(xs) for xs in lists], dtype=np.int64)
+        return cls(StringTable(*StringTable.build(list(table))), items, bounds)
+
+
+class ProjectMetadata:
+    """Read-only, categorical-encoded projects.csv."""
+
+    def __init__(self, n: int, codes: Dict[str, np.ndarray], categories: Dict[str, np.ndarray],
+                 lists: Dict[str, ListColumn]):
+        self.n = n
+        self.columns = list(codes)
+        self.codes = codes
+        self.categories = categories
+        self.lists = lists
+        self._lookup = {col: {v: c for c, v in enumerate(cats.tolist())} for col, cats in categories.items()}
+        # project_id -> first row
+        self.index: Dict[Any, int] = {}
+        for r, pid in enumerate(self.take("project_id", np.arange(n)).tolist()):
+            if pid is not None:
+                self.index.setdefault(pid, r)
+
+    def __len__(self) -> int:
+        return self.n
+
+    @property
+    def empty(self) -> bool:
+        return self.n == 0
+
+    def row(self, project_id: Any) -> Optional[int]:
+        return self.index.get(project_id)
+
+    def rows(self, project_ids: Sequence[Any]) -> np.ndarray:
+        """Rows of ``project_ids``, -1 for unknown projects."""
+        get = self.index.get
+        return np.fromiter((get(p, -1) for p in project_ids), dtype=np.int64, count=len(project_ids))
+
+    def code_of(self, col: str, value: Any) -> int:
+        """Category code of ``value`` in ``col`` (-1 if it never occurs)."""
+        return self._lookup.get(col, {}).get(value, -1)
+
+    def take(self, col: str, rows) -> np.ndarray:
+        """Values of ``col`` at ``rows`` as an object array; rows outside
+        0..n-1, missing cells and missing columns give None."""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.full(len(rows), None, dtype=object)
+        if col not in self.codes:
+            return out
+        ok = (rows >= 0) & (rows < self.n)
+        codes = np.where(ok, np.asarray(self.codes[col])[np.where(ok, rows, 0)], -1)
+        has = codes >= 0
+        out[has] = self.categories[col][codes[has]]
+        return out
+
+    def value(self, col: str, row: int) -> Any:
+        return self.take(col, [row])[0]
+
+    def record(self, row: int) -> Dict[str, Any]:
+        """Scalar columns of one row (missing cells are None)."""
+        return {col: self.value(col, row) for col in self.columns}
+
+    def split(self, col: str, row: int) -> List[str]:
+        """Pre-split list column (image_ids, plan_ids, tags) of one row."""
+        lc = self.lists.get(col)
+        return lc[row] if lc is not None else []
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "ProjectMetadata":
+        codes: Dict[str, np.ndarray] = {}
+        categories: Dict[str, np.ndarray] = {}
+        for col in df.columns:
+            if col in LIST_COLUMNS:
+                continue
+            c, uniques = pd.factorize(df[col].to_numpy(dtype=object))
+            codes[col] = c.astype(np.int32)
+            cats = np.empty(len(uniques), dtype=object)
+            cats[:] = [_python(v) for v in uniques]
+            categories[col] = cats
+        lists = {col: ListColumn.build([split_list(v) for v in df[col].tolist()])
+                 for col in LIST_COLUMNS if col in df.columns}
+        return cls(len(df), codes, categories, lists)
+
+    @classmethod
+    def from_csv(cls, csv_path: str) -> "ProjectMetadata":
+        return cls.from_frame(pd.read_csv(csv_path))
+
+    @classmethod
+    def empty_table(cls) -> "ProjectMetadata":
+        return cls(0, {}, {}, {})
+
+    def save(self, out_dir: str, source: Optional[str] = None) -> str:
+        """Codes matrix and list arrays atomically, then ``meta.json`` last."""
+        os.makedirs(out_dir, exist_ok=True)
+        lc = [self.lists[c] for c in self.lists]
+        # One string table across the list columns; bounds of column j, row r
+        # are at j * (n + 1) + r
+        table: Dict[str, int] = {}
+        items, bounds = [], []
+        for col in lc:
+            strs = col.strings.take(np.arange(len(col.strings))).tolist()
+            remap = np.array([table.setdefault(s, len(table)) for s in strs] or [0], dtype=np.int32)
+            items.append(remap[np.asarray(col.items)] if len(col.items) else np.zeros(0, dtype=np.int32))
+            bounds.append(np.asarray(col.bounds) + sum(len(x) for x in items[:-1]))
+        strings, offsets = StringTable.build(list(table))
+        arrays = {
+            "codes": np.stack([self.codes[c] for c in self.columns], axis=1).astype(np.int32)
+            if self.columns else np.zeros((self.n, 0), dtype=np.int32),
+            "strings": strings, "offsets": offsets,
+            "list_items": np.concatenate(items) if items else np.zeros(0, dtype=np.int32),
+            "list_bounds": np.concatenate(bounds) if bounds else np.zeros(0, dtype=np.int64),
+        }
+        for name, arr in arrays.items():
+            path = os.path.join(out_dir, f"{name}.npy")
+            np.save(path + ".tmp.npy", np.ascontiguousarray(arr))
+            os.replace(path + ".tmp.npy", path)
+        meta = {"version": 1, "n": self.n, "source": source, "columns": self.columns,
+                "categories": {c: self.categories[c].tolist() for c in self.columns},
+                "list_columns": list(self.lists)}
+        path = os.path.join(out_dir, METADATA_META)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+        return out_dir
+
+    @classmethod
+    def load(cls, in_dir: str, mmap: bool = True) -> "ProjectMetadata":
+        with open(os.path.join(in_dir, METADATA_META), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        a = {name: np.load(os.path.join(in_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+             for name in ("codes", "strings", "offsets", "list_items", "list_bounds")}
+        n = meta["n"]
+        if a["codes"].shape != (n, len(meta["columns"])):
+            raise ValueError(f"{in_dir} is incomplete: codes {a['codes'].shape}, meta says {n} rows")
+        codes = {c: a["codes"][:, j] for j, c in enumerate(meta["columns"])}
+        categories = {}
+        for c in meta["columns"]:
+            cats = np.empty(len(meta["categories"][c]), dtype=object)
+            cats[:] = meta["categories"][c]
+            categories[c] = cats
+        strings = StringTable(a["strings"], a["offsets"])
+        lists = {c: ListColumn(strings, a["list_items"], a["list_bounds"][j * (n + 1):(j + 1) * (n + 1)])
+                 for j, c in enumerate(meta["list_columns"])}
+        return cls(n, codes, categories, lists)
+
+
+def convert_csv(csv_path: str) -> str:
+    """Write the binary form of ``csv_path``; returns its directory."""
+    source = source_fingerprint(csv_path)
+    return ProjectMetadata.from_csv(csv_path).save(binary_dir(csv_path), source)
+
+
+def load_project_metadata(csv_path: str, mmap: bool = True) -> ProjectMetadata:
+    """Binary metadata beside ``csv_path`` if it is current, else parse the CSV."""
+    bin_dir = binary_dir(csv_path)
+    meta_path = os.path.join(bin_dir, METADATA_META)
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                recorded = json.load(f).get("source")
+            current = source_fingerprint(csv_path)
+            if current is None or recorded == current:
+                return ProjectMetadata.load(bin_dir, mmap)
+            print(f"Warning: {bin_dir} does not match {csv_path}; "
+                  "reading the CSV (run scripts/convert_metadata.py)")
+        except Exception as e:
+            print(f"Warning: Failed to load binary metadata {bin_dir}: {e}")
+    if not os.path.exists(csv_path):
+        return ProjectMetadata.empty_table()
+    return ProjectMetadata.from_csv(csv_path)
+
+
+_shared: Dict[str, Tuple[Optional[str], ProjectMetadata]] = {}
+_shared_lock = threading.Lock()
+
+
+def get_project_metadata(csv_path: str, refresh: bool = False) -> ProjectMetadata:
+    """The process-wide instance for ``csv_path``.
+
+    ``refresh`` re-reads it if the CSV changed since it was loaded (index
+    reloads pass it); otherwise the cached instance is returned as is.
+    """
+    key = os.path.abspath(str(csv_path))
+    with _shared_lock:
+        cached = _shared.get(key)
+        if cached is not None and not refresh:
+            return cached[1]
+        source = source_fingerprint(key)
+        if cached is not None and cached[0] == source:
+            return cached[1]
+        meta = load_project_metadata(key)
+        _shared[key] = (source, meta)
+        return meta
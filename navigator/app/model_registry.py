@@ -0,0 +1,124 @@
+"""
+Process-wide model registry for Arch-Circare v2.
+
+The query endpoints, patch reranking and the legacy Embedder service each
+used to load their own timm model, so a worker serving reranked uploads
+could hold the same DINOv2 weights twice. Every code path now asks the
+registry, which loads each model name once and hands out the shared
+instance.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def default_model_name() -> str:
+    """Model used for query embeddings (``settings.model_name``, ``MODEL_NAME``)."""
+    return settings.model_name
+
+
+def patch_model_name() -> str:
+    """Model for patch embeddings (``PATCH_MODEL_NAME``), independent of the query model."""
+    return settings.patch_model_name
+
+
+def _load(name: str) -> Tuple[Any, Any]:
+    import timm  # defer heavy import
+    model = timm.create_model(name, pretrained=True)
+    model.eval()
+    model.reset_classifier(0)  # Remove classification head
+    cfg = timm.data.resolve_data_config({}, model=model)
+    transform = timm.data.create_transform(**cfg, is_training=False)
+    return model, transform
+
+
+def _model_bytes(model) -> int:
+    """Bytes held by parameters and buffers (or ``nbytes`` for non-torch models)."""
+    if hasattr(model, "nbytes"):
+        return int(model.nbytes)
+    total = 0
+    for t in list(model.parameters()) + list(model.buffers()):
+        total += t.numel() * t.element_size()
+    return total
+
+
+class ModelRegistry:
+    """Thread-safe ``name -> (model, transform)`` cache.
+
+    Loads of different models proceed in parallel; concurrent first requests
+    for the same model wait for a single load.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, Tuple[Any, Any]] = {}
+        self._info: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def get(self, name: str, loader: Optional[Callable[[], Tuple[Any, Any]]] = None) -> Tuple[Any, Any]:
+        """Return ``(model, transform)``, loading the weights on first use.
+
+        ``loader`` overrides the timm loader for non-torch entries (e.g. an
+        ONNX session registered under ``model@onnx``).
+        """
+        entry = self._models.get(name)
+        if entry is not None:
+            return entry
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            entry = self._models.get(name)
+            if entry is None:
+                logger.info(f"Loading model: {name}")
+                t0 = time.time()
+                entry = loader() if loader is not None else _load(name)
+                load_ms = (time.time() - t0) * 1000.0
+                with self._lock:
+                    self._models[name] = entry
+                    self._info[name] = {
+                        "bytes": _model_bytes(entry[0]),
+                        "load_ms": round(load_ms, 1),
+                        "loaded_at": time.time(),
+                    }
+                logger.info(f"Model {name} loaded in {load_ms:.0f} ms")
+        return entry
+
+    def preload(self, name: str) -> Dict[str, Any]:
+        self.get(name)
+        return self.stats()[name]
+
+    def evict(self, name: str) -> bool:
+        """Drop the registry's reference; memory is freed once callers release theirs."""
+        with self._lock:
+            self._info.pop(name, None)
+            return self._models.pop(name, None) is not None
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(info["bytes"] for info in self._info.values())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: dict(info) for name, info in self._info.items()}
+
+
+_registry = ModelRegistry()
+
+
+def get_registry() -> ModelRegistry:
+    return _registry
+
+
+def get_model(name: str) -> Tuple[Any, Any]:
+    """Shared ``(model, transform)`` for ``name``."""
+    return _registry.get(name)
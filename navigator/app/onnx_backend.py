@@ -0,0 +1,128 @@
+"""
+ONNX Runtime inference backend for query embeddings.
+
+``scripts/export_onnx.py`` exports a timm DINOv2 model to
+``{onnx_dir}/{model_name}.onnx`` (plus ``.int8.onnx`` when dynamically
+quantized) together with a ``{model_name}.json`` sidecar holding the
+preprocessing config, so the server can build the transform without
+loading the torch weights. onnxruntime is optional: when it or the exported
+file is missing the server keeps using torch.
+"""
+
+import importlib.util
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INPUT_NAME = "pixels"
+OUTPUT_NAME = "embedding"
+
+_warned = set()
+
+
+def onnx_paths(onnx_dir: str, model_name: str, quantized: bool = False) -> Tuple[str, str]:
+    """Paths of the exported graph and its preprocessing sidecar."""
+    suffix = ".int8.onnx" if quantized else ".onnx"
+    return (os.path.join(onnx_dir, f"{model_name}{suffix}"),
+            os.path.join(onnx_dir, f"{model_name}.json"))
+
+
+def onnx_available() -> bool:
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+def resolve_backend(requested: str, onnx_dir: str, model_name: str, quantized: bool) -> str:
+    """Backend that will actually serve: "onnx" only if runtime and export exist."""
+    if requested != "onnx":
+        return "torch"
+    model_path, meta_path = onnx_paths(onnx_dir, model_name, quantized)
+    reason = None
+    if not onnx_available():
+        reason = "onnxruntime is not installed"
+    elif not (os.path.exists(model_path) and os.path.exists(meta_path)):
+        reason = f"{model_path} not found (run scripts/export_onnx.py)"
+    if reason:
+        if model_path not in _warned:
+            _warned.add(model_path)
+            logger.warning(f"EMBED_BACKEND=onnx but {reason}; falling back to torch")
+        return "torch"
+    return "onnx"
+
+
+def backend_id(model_name: str, backend: str, quantized: bool) -> str:
+    """Identity of the vectors a backend produces (used in embedding-cache keys)."""
+    if backend != "onnx":
+        return model_name
+    return f"{model_name}@onnx-int8" if quantized else f"{model_name}@onnx"
+
+
+class OnnxEncoder:
+    """ONNX Runtime session mapping (B, C, H, W) float32 pixels to features."""
+
+    def __init__(self, path: str, intra_threads: int = 0, inter_threads: int = 1):
+        import onnxruntime as ort  # optional dependency
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_threads > 0:
+            opts.intra_op_num_threads = intra_threads
+        if inter_threads > 0:
+            opts.inter_op_num_threads = inter_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self.nbytes = os.path.getsize(path)
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        return self.session.run([OUTPUT_NAME], {INPUT_NAME: x})[0]
+
+
+def load_transform(meta_path: str):
+    """Rebuild the timm eval transform from the exported data config."""
+    import timm  # preprocessing only; no weights are loaded
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return timm.data.create_transform(**meta["data_config"], is_training=False)
+
+
+def load_onnx(onnx_dir: str, model_name: str, quantized: bool = False,
+              intra_threads: int = 0, inter_threads: int = 1) -> Tuple[OnnxEncoder, Any]:
+    """``(encoder, transform)`` for an exported model."""
+    model_path, meta_path = onnx_paths(onnx_dir, model_name, quantized)
+    return OnnxEncoder(model_path, intra_threads, inter_threads), load_transform(meta_path)
+
+
+def export_onnx(model, data_config: Dict[str, Any], onnx_dir: str, model_name: str,
+                opset: int = 17) -> str:
+    """Export a classifier-less timm model with a dynamic batch axis."""
+    import torch
+    os.makedirs(onnx_dir, exist_ok=True)
+    model_path, meta_path = onnx_paths(onnx_dir, model_name)
+    dummy = torch.randn(1, *data_config["input_size"])
+    tmp = model_path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            model, dummy, tmp, opset_version=opset,
+            input_names=[INPUT_NAME], output_names=[OUTPUT_NAME],
+            dynamic_axes={INPUT_NAME: {0: "batch"}, OUTPUT_NAME: {0: "batch"}},
+        )
+    os.replace(tmp, model_path)
+    meta = {"model_name": model_name, "opset": opset,
+            "data_config": {k: (list(v) if isinstance(v, tuple) else v) for k, v in data_config.items()}}
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return model_path
+
+
+def quantize_int8(onnx_dir: str, model_name: str) -> str:
+    """Dynamic int8 weight quantization of an exported fp32 graph."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    src, _ = onnx_paths(onnx_dir, model_name)
+    dst, _ = onnx_paths(onnx_dir, model_name, quantized=True)
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+    return dst
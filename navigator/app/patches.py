@@ -7,10 +7,9 @@ Handles loading patch embeddings and computing patch-based distances for reranki
 import os
 import sys
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 import numpy as np
 import torch
-import timm
 from PIL import Image
 import logging
 from functools import lru_cache
@@ -19,26 +18,16 @@ from functools import lru_cache
 sys.path.append(str(Path(__file__).parent.parent))
 
 from app.faiss_service import l2n
+from app.model_registry import get_model, patch_model_name
 
 logger = logging.getLogger(__name__)
 
-# Global model and transform for on-the-fly patch computation
-_model = None
-_transform = None
+# "crop": embed each grid tile separately; "token": pool the tokens of one forward
+PATCH_MODES = ("crop", "token")
 
 def get_model_and_transform():
-    """Get global model and transform for patch embedding."""
-    global _model, _transform
-    if _model is None:
-        model_name = "vit_small_patch14_dinov2"
-        _model = timm.create_model(model_name, pretrained=True)
-        _model.eval()
-        _model.reset_classifier(0)
-        
-        cfg = timm.data.resolve_data_config({}, model=_model)
-        _transform = timm.data.create_transform(**cfg, is_training=False)
-    
-    return _model, _transform
+    """Shared model and transform for patch embedding."""
+    return get_model(patch_model_name())
 
 def tile_image(pil: Image.Image, grid: int = 4):
     """Tile an image into non-overlapping patches."""
@@ -53,26 +42,68 @@ def tile_image(pil: Image.Image, grid: int = 4):
 def embed_patches_from_pil(pil: Image.Image, grid: int = 4) -> np.ndarray:
     """Embed patches from a PIL image on-the-fly."""
     model, transform = get_model_and_transform()
-    embeddings = []
     
+    # Transform every tile and run them through the model as one batch
+    batch = torch.stack([transform(patch.convert('RGB')) for _, _, patch in tile_image(pil, grid)])
     with torch.no_grad():
-        for gx, gy, patch in tile_image(pil, grid):
-            # Convert to RGB and apply transform
-            patch_rgb = patch.convert('RGB')
-            patch_tensor = transform(patch_rgb).unsqueeze(0)
-            
-            # Get embedding
-            embedding = model(patch_tensor)
-            embeddings.append(embedding.cpu().numpy().flatten())
+        embeddings = model(batch).cpu().numpy().astype(np.float32)
     
-    # Stack embeddings and L2-normalize
-    embeddings = np.array(embeddings, dtype=np.float32)
-    embeddings = l2n(embeddings)
+    # L2-normalize
+    return l2n(embeddings)
+
+def pool_patch_tokens(model, tokens: "torch.Tensor", grid: int = 4) -> np.ndarray:
+    """Average-pool ViT patch tokens into a grid x grid layout.
+    
+    Args:
+        model: timm ViT whose ``forward_features`` produced ``tokens``
+        tokens: Output of ``forward_features``, shape (B, prefix + h*w, d)
+        grid: Grid size; regions are row-major like ``tile_image``
     
-    return embeddings
+    Returns:
+        Array of shape (B, grid*grid, d) with L2-normalized embeddings
+    """
+    patch_tokens = tokens[:, getattr(model, "num_prefix_tokens", 1):]
+    B, N, d = patch_tokens.shape
+    side = int(round(N ** 0.5))
+    if side * side != N:
+        raise ValueError(f"Cannot lay out {N} patch tokens on a square grid")
+    fmap = patch_tokens.transpose(1, 2).reshape(B, d, side, side)
+    pooled = torch.nn.functional.adaptive_avg_pool2d(fmap, grid)  # (B, d, grid, grid)
+    pooled = pooled.flatten(2).transpose(1, 2).cpu().numpy().astype(np.float32)
+    return np.stack([l2n(p) for p in pooled])
+
+def embed_global_and_patches(model, transform, pil: Image.Image, grid: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Global vector and grid-region patch features from a single forward pass.
+    
+    The global vector equals ``model(x)`` (pooled head input); the patches
+    are the patch tokens of the same pass pooled per grid region.
+    
+    Returns:
+        Tuple of (global vector (d,), patches (grid*grid, d)), both L2-normalized
+    """
+    device = next(model.parameters()).device
+    x = transform(pil.convert('RGB')).unsqueeze(0).to(device)
+    with torch.no_grad():
+        tokens = model.forward_features(x)
+        global_vec = model.forward_head(tokens, pre_logits=True)
+        patches = pool_patch_tokens(model, tokens, grid)[0]
+    global_vec = l2n(global_vec.cpu().numpy().astype(np.float32))[0]
+    return global_vec, patches
+
+def patch_file_path(image_id: str, P: int = 16, data_dir: str = "data", mode: str = "crop") -> Path:
+    """Patch embedding file for an image.
+    
+    Crop-mode files keep the original ``{image_id}__p{P}.npy`` name; token-mode
+    files get a ``_tok`` suffix since the two live in different feature spaces.
+    """
+    if mode not in PATCH_MODES:
+        raise ValueError(f"Unknown patch mode: {mode}")
+    suffix = "" if mode == "crop" else "_tok"
+    return Path(data_dir) / "embeddings" / "patch" / f"{image_id}__p{P}{suffix}.npy"
 
 @lru_cache(maxsize=1024)
-def load_patches(image_id: str, P: int = 16, data_dir: str = "data") -> Optional[np.ndarray]:
+def load_patches(image_id: str, P: int = 16, data_dir: str = "data", mode: str = "crop") -> Optional[np.ndarray]:
     """
     Load patch embeddings for an image.
     
@@ -80,16 +111,18 @@ def load_patches(image_id: str, P: int = 16, data_dir: str = "data") -> Optional
         image_id: Image ID (e.g., "i_p_sanaa_rolex_hero")
         P: Number of patches (default 16 for 4x4 grid)
         data_dir: Data directory path
+        mode: "crop" (per-tile forwards) or "token" (pooled tokens)
     
     Returns:
         Array of shape (P, d) with L2-normalized embeddings, or None if not found
     """
-    patch_file = Path(data_dir) / "embeddings" / "patch" / f"{image_id}__p{P}.npy"
+    patch_file = patch_file_path(image_id, P, data_dir, mode)
     
     if patch_file.exists():
         try:
-            patches = np.load(patch_file)
-            return patches.astype(np.float32)
+            # Memory-mapped: cached entries share the OS page cache
+            patches = np.load(patch_file, mmap_mode="r")
+            return np.asarray(patches, dtype=np.float32)
         except Exception as e:
             logger.warning(f"Failed to load patches for {image_id}: {e}")
             return None
@@ -119,7 +152,8 @@ def min_patch_distance(Q: np.ndarray, C: np.ndarray) -> float:
     
     return d
 
-def compute_query_patches(pil: Image.Image, grid: int = 4, image_id: Optional[str] = None, data_dir: str = "data") -> np.ndarray:
+def compute_query_patches(pil: Image.Image, grid: int = 4, image_id: Optional[str] = None, data_dir: str = "data",
+                          mode: str = "crop") -> np.ndarray:
     """
     Compute patches for a query image.
     
@@ -128,17 +162,21 @@ def compute_query_patches(pil: Image.Image, grid: int = 4, image_id: Optional[st
         grid: Grid size for tiling
         image_id: Optional image ID to try loading precomputed patches
         data_dir: Data directory path
+        mode: "crop" or "token" (see ``PATCH_MODES``)
     
     Returns:
         Array of shape (grid*grid, d) with L2-normalized embeddings
     """
     # Try to load precomputed patches if image_id is provided
     if image_id:
-        patches = load_patches(image_id, grid * grid, data_dir)
+        patches = load_patches(image_id, grid * grid, data_dir, mode)
         if patches is not None:
             return patches
     
     # Fall back to on-the-fly computation
+    if mode == "token":
+        model, transform = get_model_and_transform()
+        return embed_global_and_patches(model, transform, pil, grid)[1]
     return embed_patches_from_pil(pil, grid)
 
 def get_image_id_from_path(file_path: str) -> Optional[str]:
@@ -165,7 +203,7 @@ def get_image_id_from_path(file_path: str) -> Optional[str]:
 
 def rerank_by_patches(results: list, query_patches: np.ndarray, 
                      re_topk: int, top_k: int, patches: int = 16, 
-                     data_dir: str = "data") -> tuple:
+                     data_dir: str = "data", mode: str = "crop") -> tuple:
     """
     Rerank results by patch similarity.
     
@@ -176,6 +214,7 @@ def rerank_by_patches(results: list, query_patches: np.ndarray,
         top_k: Number of results to return
         patches: Number of patches per image
         data_dir: Data directory path
+        mode: Patch mode of ``query_patches``; candidates are loaded in the same mode
     
     Returns:
         Tuple of (reranked_results, debug_info)
@@ -190,10 +229,16 @@ def rerank_by_patches(results: list, query_patches: np.ndarray,
             continue
         
         # Load candidate patches
-        candidate_patches = load_patches(image_id, patches, data_dir)
+        candidate_patches = load_patches(image_id, patches, data_dir, mode)
         if candidate_patches is None:
             # Skip if patches not available
             continue
+        if candidate_patches.shape[1] != query_patches.shape[1]:
+            # Stored patches come from another model: keep the search ranking
+            logger.warning(f"Stored patches are {candidate_patches.shape[1]}-d but the query's are "
+                           f"{query_patches.shape[1]}-d; check PATCH_MODEL_NAME. Skipping rerank")
+            return results[:top_k], {"rerank": "skipped", "reason": "patch dimension mismatch",
+                                     "re_topk": re_topk, "patches": patches, "patch_mode": mode, "moved": 0}
         
         # Compute patch distance
         d = min_patch_distance(query_patches, candidate_patches)
@@ -218,6 +263,7 @@ def rerank_by_patches(results: list, query_patches: np.ndarray,
         "rerank": "patch_min",
         "re_topk": re_topk,
         "patches": patches,
+        "patch_mode": mode,
         "moved": moved
     }
     
@@ -1,10 +1,10 @@
 from fastapi import APIRouter, HTTPException
-import pandas as pd
 import logging
 from typing import List
 
 from ..models import ProjectCard, ExplainResponse
 from ..config import settings
+from ..metadata import ProjectMetadata
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -12,15 +12,15 @@ router = APIRouter()
 # Global metadata (will be loaded in main.py)
 _metadata = None
 
-def get_metadata() -> pd.DataFrame:
-    """Get global metadata DataFrame."""
+def get_metadata() -> ProjectMetadata:
+    """Get global project metadata."""
     global _metadata
     if _metadata is None:
         raise RuntimeError("Metadata not loaded")
     return _metadata
 
-def set_metadata(metadata: pd.DataFrame):
-    """Set global metadata DataFrame."""
+def set_metadata(metadata: ProjectMetadata):
+    """Set global project metadata (the shared ``get_project_metadata`` instance)."""
     global _metadata
     _metadata = metadata
 
@@ -31,24 +31,16 @@ async def get_project(project_id: str):
         metadata = get_metadata()
         
         # Find project
-        project_row = metadata[metadata['project_id'] == project_id]
-        if project_row.empty:
+        r = metadata.row(project_id)
+        if r is None:
             raise HTTPException(status_code=404, detail="Project not found")
         
-        row = project_row.iloc[0]
+        row = metadata.record(r)
         
-        # Parse image_ids and plan_ids
-        image_ids = []
-        if pd.notna(row.get('image_ids')):
-            image_ids = [img_id.strip() for img_id in str(row['image_ids']).split('|') if img_id.strip()]
-        
-        plan_ids = []
-        if pd.notna(row.get('plan_ids')):
-            plan_ids = [plan_id.strip() for plan_id in str(row['plan_ids']).split('|') if plan_id.strip()]
-        
-        tags = []
-        if pd.notna(row.get('tags')):
-            tags = [tag.strip() for tag in str(row['tags']).split('|') if tag.strip()]
+        # image_ids, plan_ids and tags are pre-split at load
+        image_ids = metadata.split('image_ids', r)
+        plan_ids = metadata.split('plan_ids', r)
+        tags = metadata.split('tags', r)
         
         return ProjectCard(
             project_id=str(row['project_id']),
@@ -74,33 +66,33 @@ async def explain_project(project_id: str):
         metadata = get_metadata()
         
         # Find project
-        project_row = metadata[metadata['project_id'] == project_id]
-        if project_row.empty:
+        r = metadata.row(project_id)
+        if r is None:
             raise HTTPException(status_code=404, detail="Project not found")
         
-        row = project_row.iloc[0]
+        row = metadata.record(r)
         
         # Generate explanation based on attributes
         explanation_parts = []
         
         # Add typology
-        if pd.notna(row.get('typology')):
+        if row.get('typology') is not None:
             explanation_parts.append(f"This is a {row['typology']} project")
         
         # Add climate context
-        if pd.notna(row.get('climate_bin')):
+        if row.get('climate_bin') is not None:
             explanation_parts.append(f"designed for {row['climate_bin']} climate")
         
         # Add massing type
-        if pd.notna(row.get('massing_type')):
+        if row.get('massing_type') is not None:
             explanation_parts.append(f"with {row['massing_type']} massing")
         
         # Add window-to-wall ratio
-        if pd.notna(row.get('wwr_band')):
+        if row.get('wwr_band') is not None:
             explanation_parts.append(f"and {row['wwr_band']} window-to-wall ratio")
         
         # Add location
-        if pd.notna(row.get('country')):
+        if row.get('country') is not None:
             explanation_parts.append(f"located in {row['country']}")
         
         # Combine into explanation
@@ -126,15 +118,12 @@ async def list_projects(limit: int = 100, offset: int = 0):
         
         # Apply pagination
         total = len(metadata)
-        projects = metadata.iloc[offset:offset + limit]
         
         # Convert to list of project cards
         project_list = []
-        for _, row in projects.iterrows():
-            # Parse image_ids
-            image_ids = []
-            if pd.notna(row.get('image_ids')):
-                image_ids = [img_id.strip() for img_id in str(row['image_ids']).split('|') if img_id.strip()]
+        for r in range(max(0, offset), min(total, offset + limit)):
+            row = metadata.record(r)
+            image_ids = metadata.split('image_ids', r)
             
             project_card = ProjectCard(
                 project_id=str(row['project_id']),
@@ -0,0 +1,66 @@
+"""
+Selectivity-aware candidate depth for Arch-Circare v2.
+
+Instead of a fixed ``max(top_k*5, ..., 100)``, the search endpoints ask the
+corpus statistics how many neighbours they need to see ``top_k`` survivors:
+non-strict attribute filters can lift matching items from further down the
+visual ranking. Strict filters and lenses are pushed into the index as an
+id selector, so they cost no extra depth. If the prediction still comes up
+short the caller deepens iteratively.
+"""
+
+import math
+from typing import Any, Dict, List, Optional
+import numpy as np
+
+# Headroom over the independence estimate
+SAFETY = 1.5
+# Spatial fusion can reorder well beyond the visual top_k
+SPATIAL_FACTOR = 5
+# Soft filters only re-weight scores; never look more than this many times top_k deep
+SOFT_FILTER_FACTOR = 10
+
+
+class CorpusStats:
+    """Attribute value frequencies and images-per-project counts."""
+
+    def __init__(self, table):
+        self.n = table.n
+        self.value_counts: Dict[str, Dict[Any, int]] = {
+            col: {v: table.count(bits) for v, bits in maps.items()}
+            for col, maps in table.bitmaps.items()
+        }
+        codes = np.asarray(table.ids.project, dtype=np.int64)
+        counts = np.bincount(codes[codes >= 0], minlength=len(table.ids.project_names))
+        self.images_per_project: Dict[str, int] = {
+            pid: int(c) for pid, c in zip(table.ids.project_id_list(), counts.tolist()) if c > 0
+        }
+        counts = counts[counts > 0]
+        self.mean_images_per_project = float(counts.mean()) if len(counts) else 1.0
+
+    def match_fraction(self, filters: Dict[str, Any]) -> float:
+        """Estimated fraction of the corpus matching every filter (independence)."""
+        frac = 1.0
+        for col, value in filters.items():
+            if col in self.value_counts and value is not None:
+                frac *= self.value_counts[col].get(value, 0) / max(1, self.n)
+        return frac
+
+
+def predict_depth(stats: CorpusStats, top_k: int, filters: Dict[str, Any], strict: bool,
+                  w_attr: float, spatial: bool = False, min_k: int = 0) -> int:
+    """Predict how many neighbours to fetch so ``top_k`` results survive.
+
+    Strict filters and lenses are pushed into the index, so they cost no
+    extra depth. The result is clamped by callers to the eligible count.
+    """
+    k = max(top_k, min_k)
+    if filters and not strict and w_attr > 0:
+        # Look deep enough to see top_k items that the attr term can promote;
+        # a value nobody has cannot be promoted at all
+        frac = stats.match_fraction(filters)
+        if frac > 0:
+            k = max(k, min(math.ceil(top_k / frac * SAFETY), top_k * SOFT_FILTER_FACTOR))
+    if spatial:
+        k = max(k, top_k * SPATIAL_FACTOR)
+    return int(k)
@@ -1,11 +1,12 @@
 import torch
-import timm
 import numpy as np
 from PIL import Image
 from typing import Union, Optional
 import logging
 import io
 
+from app.model_registry import get_model
+
 logger = logging.getLogger(__name__)
 
 class Embedder:
@@ -18,19 +19,8 @@ class Embedder:
         self._load_model()
     
     def _load_model(self):
-        """Load the DINOv2 model and preprocessing transform."""
-        logger.info(f"Loading model: {self.model_name}")
-        
-        # Load model
-        self.model = timm.create_model(self.model_name, pretrained=True)
-        self.model.eval()
-        self.model.reset_classifier(0)  # Remove classification head
-        
-        # Get preprocessing transform
-        cfg = timm.data.resolve_data_config({}, model=self.model)
-        self.transform = timm.data.create_transform(**cfg, is_training=False)
-        
-        logger.info(f"Model loaded successfully")
+        """Fetch the DINOv2 model and preprocessing transform from the shared registry."""
+        self.model, self.transform = get_model(self.model_name)
     
     def _l2_normalize(self, x: np.ndarray) -> np.ndarray:
         """L2-normalize vectors."""
@@ -2,6 +2,8 @@ import pandas as pd
 from typing import List, Dict, Optional
 import logging
 
+from ...metadata import ProjectMetadata, get_project_metadata
+
 logger = logging.getLogger(__name__)
 
 class AttributeFeatures:
@@ -13,13 +15,13 @@ class AttributeFeatures:
         self._load_metadata()
     
     def _load_metadata(self):
-        """Load project metadata from CSV."""
+        """Load project metadata (the instance shared with the index and routers)."""
         try:
-            self.metadata = pd.read_csv(self.metadata_csv)
+            self.metadata = get_project_metadata(str(self.metadata_csv))
             logger.info(f"Loaded metadata for {len(self.metadata)} projects")
         except Exception as e:
             logger.error(f"Failed to load metadata: {e}")
-            self.metadata = pd.DataFrame()
+            self.metadata = ProjectMetadata.empty_table()
     
     def _categorical_distance(self, val1: str, val2: str) -> float:
         """Compute categorical distance (0 if match, 1 otherwise)."""
@@ -32,17 +34,15 @@ class AttributeFeatures:
         if self.metadata is None or self.metadata.empty:
             return {}
         
-        project_row = self.metadata[self.metadata['project_id'] == project_id]
-        if project_row.empty:
+        row = self.metadata.row(project_id)
+        if row is None:
             return {}
         
-        row = project_row.iloc[0]
-        return {
-            'typology': str(row.get('typology', '')),
-            'climate_bin': str(row.get('climate_bin', '')),
-            'massing_type': str(row.get('massing_type', '')),
-            'wwr_band': str(row.get('wwr_band', ''))
-        }
+        attrs = {}
+        for attr_name in ['typology', 'climate_bin', 'massing_type', 'wwr_band']:
+            value = self.metadata.value(attr_name, row)
+            attrs[attr_name] = '' if value is None else str(value)
+        return attrs
     
     def distances(self, project_ids: List[str], query_attributes: Optional[Dict[str, str]] = None) -> List[float]:
         """
@@ -1,10 +1,12 @@
 import faiss
 import numpy as np
-import json
 from pathlib import Path
 from typing import List, Tuple, Optional
 import logging
 
+from app.faiss_service import read_index
+from app.idmap import load_id_map
+
 logger = logging.getLogger(__name__)
 
 class IndexStore:
@@ -25,11 +27,11 @@ class IndexStore:
             raise RuntimeError(f"ID map not found: {self.idmap_path}")
         
         logger.info(f"Loading FAISS index from {self.index_path}")
-        self.index = faiss.read_index(str(self.index_path))
+        # Mapped read-only (FAISS_MMAP) so forked/sibling workers share the page cache
+        self.index = read_index(str(self.index_path))
         
         logger.info(f"Loading ID map from {self.idmap_path}")
-        with open(self.idmap_path, 'r') as f:
-            self.idmap = json.load(f)
+        self.idmap = load_id_map(str(self.idmap_path))
         
         logger.info(f"Loaded index with {self.index.ntotal} vectors and {len(self.idmap)} ID mappings")
     
@@ -66,7 +68,7 @@ class IndexStore:
         """Get image ID for a given index."""
         if self.idmap is None:
             return None
-        return self.idmap.get(str(index))
+        return self.idmap.image_ids([index])[0]
     
     def get_project_id(self, index: int) -> Optional[str]:
         """Get project ID for a given index (extract from image ID)."""
@@ -0,0 +1,80 @@
+"""
+Plan-image spatial features for Arch-Circare v2.
+
+Kept free of FastAPI and model imports so it can run in a worker process.
+"""
+
+from typing import List, Optional
+import numpy as np
+from PIL import Image
+
+# Spatial feature computation imports
+try:
+    from skimage import measure, morphology, filters, util
+    from skimage.measure import label, regionprops
+    from skimage.morphology import binary_closing, skeletonize
+    from skimage.filters import threshold_otsu
+    from scipy import ndimage
+    SPATIAL_AVAILABLE = True
+except ImportError:
+    SPATIAL_AVAILABLE = False
+    print("Warning: skimage/scipy not available, spatial features disabled")
+
+def compute_spatial_features(pil: Image.Image) -> Optional[List[float]]:
+    """Compute spatial features from a plan image."""
+    if not SPATIAL_AVAILABLE:
+        return None
+    
+    try:
+        # Convert to grayscale
+        gray = np.array(pil.convert("L"))
+        
+        # Extract floorplate mask
+        # Simple thresholding approach
+        threshold = threshold_otsu(gray)
+        binary = gray < threshold
+        
+        # Clean up the binary image
+        binary = binary_closing(binary)
+        
+        # Find largest connected component (assumed to be the floorplate)
+        labeled = label(binary)
+        if labeled.max() == 0:
+            return None
+        
+        props = regionprops(labeled)
+        largest_comp = max(props, key=lambda x: x.area)
+        floorplate = labeled == largest_comp.label
+        
+        # Compute spatial metrics
+        # Elongation = major_axis_length / minor_axis_length
+        elongation = largest_comp.major_axis_length / largest_comp.minor_axis_length
+        
+        # Convexity = area(floorplate) / area(convex_hull)
+        hull = morphology.convex_hull_image(floorplate)
+        convexity = largest_comp.area / np.sum(hull)
+        convexity = np.clip(convexity, 0.0, 1.0)
+        
+        # Extract space mask (floorplate minus thickened walls)
+        edges = morphology.binary_dilation(floorplate) & ~floorplate
+        thickened_edges = morphology.binary_dilation(edges, morphology.disk(3))
+        space_mask = floorplate & ~thickened_edges
+        
+        # Room count = connected components with sufficient area
+        min_area = 0.002 * largest_comp.area  # 0.2% of floorplate area
+        space_labeled = label(space_mask)
+        space_props = regionprops(space_labeled)
+        room_count = sum(1 for p in space_props if p.area >= min_area)
+        
+        # Corridor ratio = skeleton density
+        if np.sum(space_mask) > 0:
+            skeleton = skeletonize(space_mask)
+            corridor_ratio = np.sum(skeleton) / np.sum(space_mask)
+        else:
+            corridor_ratio = 0.0
+        
+        return [elongation, convexity, room_count, corridor_ratio]
+        
+    except Exception as e:
+        print(f"Error computing spatial features: {e}")
+        return None
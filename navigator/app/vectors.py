@@ -0,0 +1,93 @@
+"""
+Consolidated embedding matrix for Arch-Circare v2.
+
+All global image embeddings live in one contiguous array,
+``data/embeddings/vectors.npy``, whose row ``i`` is FAISS id ``i``. A small
+sidecar, ``vectors.json``, records the dtype, shape and a fingerprint of the
+row image_ids (``app.idmap.ids_fingerprint``) so the matrix can be checked
+against the id map without storing or comparing every id.
+The server, the index builder and the latent projector all read it
+memory-mapped instead of opening one .npy per image.
+"""
+
+import os
+import json
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from app.idmap import ids_fingerprint
+
+VECTORS_FILE = "vectors.npy"
+VECTORS_META = "vectors.json"
+
+
+def vectors_paths(emb_root: str) -> Tuple[str, str]:
+    """Paths of the matrix and its sidecar under ``data/embeddings``."""
+    return os.path.join(emb_root, VECTORS_FILE), os.path.join(emb_root, VECTORS_META)
+
+
+def write_vectors(emb_root: str, X: np.ndarray, image_ids: List[str], dtype: str = "float32") -> str:
+    """Write the matrix and sidecar atomically (temp file + rename).
+
+    Servers may have the previous file mapped, so it is never truncated in place.
+    """
+    if len(image_ids) != X.shape[0]:
+        raise ValueError(f"{len(image_ids)} ids for {X.shape[0]} rows")
+    vec_path, meta_path = vectors_paths(emb_root)
+    os.makedirs(emb_root, exist_ok=True)
+    X = np.ascontiguousarray(X, dtype=dtype)
+    tmp = vec_path + ".tmp.npy"
+    np.save(tmp, X)
+    os.replace(tmp, vec_path)
+    meta = {"dtype": str(X.dtype), "shape": list(X.shape), "ids": ids_fingerprint(image_ids)}
+    tmp = meta_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_path)
+    return vec_path
+
+
+def load_vectors(emb_root: str, mmap: bool = True) -> Optional[Tuple[np.ndarray, str]]:
+    """Load ``(matrix, ids fingerprint)``, or None if no consolidated matrix exists.
+
+    The matrix keeps its on-disk dtype (float32 or float16); use ``rows`` to
+    read float32 vectors out of it.
+    """
+    vec_path, meta_path = vectors_paths(emb_root)
+    if not (os.path.exists(vec_path) and os.path.exists(meta_path)):
+        return None
+    X = np.load(vec_path, mmap_mode="r" if mmap else None)
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if "ids" not in meta:  # sidecars that listed every image_id
+        meta["ids"] = ids_fingerprint(meta.get("image_ids", []))
+    n = int(meta["ids"].split(":", 1)[0])
+    if n != X.shape[0]:
+        raise ValueError(f"{meta_path} records {n} ids for {X.shape[0]} rows")
+    return X, meta["ids"]
+
+
+def rows(X: np.ndarray, idx) -> np.ndarray:
+    """Gather rows as float32 (only the touched pages are read from a memmap)."""
+    return np.asarray(X[idx], dtype="float32")
+
+
+def pack_from_npy(emb_root: str, id_map: Dict[str, Dict[str, str]], dtype: str = "float32") -> str:
+    """Stack per-image ``embeddings/image/{image_id}.npy`` files in faiss-id order.
+
+    Rows are aligned with ``id_map``; every id in the map must have a file.
+    """
+    emb_dir = os.path.join(emb_root, "image")
+    order = sorted(id_map, key=int)
+    if [int(k) for k in order] != list(range(len(order))):
+        raise ValueError("id_map keys must be the contiguous range 0..N-1")
+    image_ids = [id_map[k]["image_id"] for k in order]
+    X = None
+    for i, image_id in enumerate(image_ids):
+        v = np.load(os.path.join(emb_dir, f"{image_id}.npy")).astype("float32").ravel()
+        if X is None:
+            X = np.empty((len(image_ids), v.shape[0]), dtype=dtype)
+        X[i] = v
+    if X is None:
+        raise RuntimeError(f"No embeddings listed in id_map under {emb_dir}")
+    return write_vectors(emb_root, X, image_ids, dtype)
@@ -1,68 +1,391 @@
-import os, glob, argparse, math, json
+import os, sys, glob, argparse, math, json, time, zlib
 import numpy as np
 import faiss
 
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.faiss_service import (apply_search_params, write_index_meta,
+                               SHARDS_DIR, shards_manifest_path)
+from app.idmap import source_fingerprint
+from app.vectors import load_vectors, rows as vector_rows, VECTORS_FILE
+
 def l2n(X):
     n = np.linalg.norm(X, axis=1, keepdims=True) + 1e-12
     return X / n
 
-def main(data_dir: str):
-    """Build FAISS index from embeddings directory."""
-    data_dir = os.path.abspath(data_dir)
-    emb_dir = os.path.join(data_dir, "embeddings", "image")
-    out_path = os.path.join(data_dir, "embeddings", "index.faiss")
-    
-    vec_paths = sorted(glob.glob(os.path.join(emb_dir, "*.npy")))
-    if not vec_paths:
-        raise RuntimeError(f"No embeddings found under {emb_dir}")
+def write_index_atomic(index, out_path: str):
+    """Write to a temp file and rename, so servers that memory-map the old
+    index keep a valid mapping of the previous inode."""
+    tmp_path = out_path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, out_path)
 
-    print(f"[faiss] Loading {len(vec_paths)} embeddings...")
-    X = np.stack([np.load(p).astype("float32") for p in vec_paths], axis=0)
-    X = l2n(X)
-    N, d = X.shape
-    print(f"[faiss] vectors: N={N}, d={d}")
+def default_search_params(index) -> dict:
+    """Starting runtime knobs for a layout (scripts/tune_faiss.py can refine them)."""
+    params = {}
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        params["nprobe"] = max(1, min(ivf.nlist // 8, 32))
+        if isinstance(faiss.downcast_index(ivf.quantizer), faiss.IndexHNSW):
+            params["quantizer_efSearch"] = 64
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        params["efSearch"] = 64
+    if isinstance(index, faiss.IndexRefine):
+        params["k_factor"] = 4
+    return params
 
-    # Create output directory
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+def make_index(d: int, N: int, spec: str = None):
+    """Untrained index for N vectors: (index, spec, description, search params).
 
+    With ``spec`` the layout comes from ``faiss.index_factory`` (e.g.
+    "HNSW32,Flat", "IVF1024_HNSW32,Flat", "OPQ16,IVF1024,PQ16,RFlat",
+    "IVF256,SQ8"); otherwise it is picked adaptively from N.
+    """
+    if spec:
+        index = faiss.index_factory(d, spec, faiss.METRIC_L2)
+        return index, spec, f"spec {spec!r} → {type(index).__name__}", default_search_params(index)
     # Super small sets → FlatL2 (no training)
     if N < 64:
-        print("[faiss] N < 64 → using IndexFlatL2 (no training).")
-        index = faiss.IndexFlatL2(d)
-        index.add(X)
-        faiss.write_index(index, out_path)
-        print(f"[faiss] Wrote {out_path}")
+        return faiss.IndexFlatL2(d), "Flat", "N < 64 → using IndexFlatL2 (no training).", {}
     # Small/medium sets → IVF-Flat (light training)
-    elif N < 500:
+    if N < 500:
         nlist = min(max(16, int(math.sqrt(N))), N)  # ensure nlist <= N
-        print(f"[faiss] 64 ≤ N < 500 → using IndexIVFFlat with nlist={nlist}")
         quantizer = faiss.IndexFlatL2(d)
         index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_L2)
-        # Train on all points (since small)
-        index.train(X)
-        index.add(X)
-        index.nprobe = max(1, min(nlist // 8, 16))
-        faiss.write_index(index, out_path)
-        print(f"[faiss] Wrote {out_path}")
+        return (index, f"IVF{nlist},Flat", f"64 ≤ N < 500 → using IndexIVFFlat with nlist={nlist}",
+                {"nprobe": max(1, min(nlist // 8, 16))})
     # Larger sets → IVF+PQ
+    nlist = min(max(64, int(math.sqrt(N) * 8)), N)   # cap by N
+    m = 16 if d >= 256 else 8                        # PQ subvectors
+    quantizer = faiss.IndexFlatL2(d)
+    index = faiss.IndexIVFPQ(quantizer, d, nlist, m, 8)
+    return (index, f"IVF{nlist},PQ{m}x8", f"N ≥ 500 → using IndexIVFPQ with nlist={nlist}, m={m}",
+            {"nprobe": max(1, min(nlist // 8, 32))})
+
+def train_size_for(index, N: int, spec: str = None) -> int:
+    """Training points: a subset (≥ nlist) for IVF-PQ, all of them for IVF-Flat;
+    spec layouts get ~40 points per list (at least 10k, e.g. for PQ codebooks)."""
+    if spec:
+        ivf = faiss.try_extract_index_ivf(index)
+        return min(N, max(10000, 40 * (ivf.nlist if ivf is not None else 0)))
+    if isinstance(index, faiss.IndexIVFPQ):
+        return max(index.nlist, min(10000, N))
+    return N
+
+def parse_search_params(text: str) -> dict:
+    """"nprobe=16,efSearch=64" → {"nprobe": 16, "efSearch": 64}."""
+    params = {}
+    for item in filter(None, (t.strip() for t in (text or "").split(","))):
+        name, _, value = item.partition("=")
+        params[name.strip()] = float(value) if "." in value else int(value)
+    return params
+
+def finish_index(index, out_path: str, spec: str, params: dict):
+    """Apply search params, write the index and its index_meta.json."""
+    applied = apply_search_params(index, params)
+    write_index_atomic(index, out_path)
+    write_index_meta(out_path, {
+        "spec": spec,
+        "metric": "L2",
+        "d": int(index.d),
+        "ntotal": int(index.ntotal),
+        "search_params": applied,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    print(f"[faiss] Wrote {out_path} (search params {applied})")
+
+def load_matrix(data_dir: str) -> np.ndarray:
+    """All embeddings as one L2-normalized (N, d) matrix in faiss-id order."""
+    emb_dir = os.path.join(data_dir, "embeddings", "image")
+    loaded = load_vectors(os.path.join(data_dir, "embeddings"))
+    if loaded is not None:
+        # Consolidated matrix: rows are already in faiss-id order
+        M, _ = loaded
+        print(f"[faiss] Loading {M.shape[0]} embeddings from {VECTORS_FILE}...")
+        X = vector_rows(M, slice(None))
     else:
-        nlist = min(max(64, int(math.sqrt(N) * 8)), N)   # cap by N
-        m = 16 if d >= 256 else 8                        # PQ subvectors
-        print(f"[faiss] N ≥ 500 → using IndexIVFPQ with nlist={nlist}, m={m}")
-        quantizer = faiss.IndexFlatL2(d)
-        index = faiss.IndexIVFPQ(quantizer, d, nlist, m, 8)
+        vec_paths = sorted(glob.glob(os.path.join(emb_dir, "*.npy")))
+        if not vec_paths:
+            raise RuntimeError(f"No embeddings found under {emb_dir}")
+
+        print(f"[faiss] Loading {len(vec_paths)} embeddings...")
+        X = np.stack([np.load(p).astype("float32") for p in vec_paths], axis=0)
+    return l2n(X)
+
+def train_index(index, X: np.ndarray, spec: str = None):
+    N = X.shape[0]
+    train_size = train_size_for(index, N, spec)
+    if train_size < N or isinstance(index, faiss.IndexIVFPQ):
         # Train on a subset but ≥ nlist
-        train_size = max(nlist, min(10000, N))
         rs = np.random.RandomState(0)
-        train_idx = rs.choice(N, train_size, replace=False)
-        index.train(X[train_idx])
+        index.train(X[rs.choice(N, train_size, replace=False)])
+    else:
+        # Train on all points (since small)
+        index.train(X)
+
+def main(data_dir: str, spec: str = None, search_params: dict = None):
+    """Build FAISS index from embeddings directory."""
+    data_dir = os.path.abspath(data_dir)
+    out_path = os.path.join(data_dir, "embeddings", "index.faiss")
+    
+    X = load_matrix(data_dir)
+    N, d = X.shape
+    print(f"[faiss] vectors: N={N}, d={d}")
+
+    # Create output directory
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    index, spec, desc, params = make_index(d, N, spec)
+    print(f"[faiss] {desc}")
+    if not index.is_trained:
+        train_index(index, X, spec)
+    index.add(X)
+    finish_index(index, out_path, spec, {**params, **(search_params or {})})
+
+# ---- Sharded build ----
+
+PARTITIONS = ("hash", "project")
+
+def partition_ids(id_map: dict, N: int, shards: int, partition: str) -> np.ndarray:
+    """Shard number of every faiss id.
+
+    "hash" spreads images evenly by a stable CRC of image_id (an image stays
+    on its shard as the corpus grows); "project" keeps each project's images
+    together on one shard.
+    """
+    field = "project_id" if partition == "project" else "image_id"
+    keys = [id_map.get(str(i), {}).get(field) or str(i) for i in range(N)]
+    return np.array([zlib.crc32(k.encode("utf-8")) % shards for k in keys], dtype=np.int64)
+
+def build_shards(data_dir: str, shards: int, partition: str = "hash", spec: str = None,
+                 search_params: dict = None, chunk: int = 65536):
+    """Partition the corpus and write one index per shard plus a manifest.
+
+    Every shard shares one layout (picked for the smallest shard when no
+    spec is given) and is wrapped in an IndexIDMap holding global faiss ids.
+    Rows are streamed from the memory-mapped vectors.npy (or per-image
+    files) ``chunk`` at a time, so peak memory is one shard's index plus its
+    training sample and one chunk. The server still opens every shard in one
+    process (FAISS_SHARDS=true): shards parallelize search and bound build
+    memory, they do not shrink serving memory.
+    """
+    data_dir = os.path.abspath(data_dir)
+    emb_root = os.path.join(data_dir, "embeddings")
+    source = VectorSource(data_dir)
+    N, d = source.N, source.d
+    with open(os.path.join(emb_root, "id_map.json"), "r", encoding="utf-8") as f:
+        id_map = json.load(f)
+    assign = partition_ids(id_map, N, shards, partition)
+    sizes = np.bincount(assign, minlength=shards)
+    print(f"[faiss] vectors: N={N}, d={d}; {shards} shards by {partition}: sizes {sizes.tolist()}")
+    if (sizes == 0).any():
+        raise RuntimeError(f"{int((sizes == 0).sum())} shard(s) would be empty; use fewer shards")
+
+    _, spec, desc, params = make_index(d, int(sizes.min()), spec)
+    params = {**params, **(search_params or {})}
+    print(f"[faiss] {desc} (per shard)")
+    out_dir = os.path.join(emb_root, SHARDS_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    entries = []
+    rs = np.random.RandomState(0)
+    for s in range(shards):
+        ids = np.flatnonzero(assign == s).astype("int64")
+        index, _, _, _ = make_index(d, len(ids), spec)
+        if not index.is_trained:
+            k = train_size_for(index, len(ids), spec)
+            if k < len(ids) or isinstance(index, faiss.IndexIVFPQ):
+                index.train(source.take(ids[rs.choice(len(ids), k, replace=False)]))
+            else:
+                index.train(source.take(ids))
+        index = faiss.IndexIDMap(index)
+        for lo in range(0, len(ids), chunk):
+            index.add_with_ids(source.take(ids[lo:lo + chunk]), ids[lo:lo + chunk])
+        name = f"shard_{s:03d}.faiss"
+        write_index_atomic(index, os.path.join(out_dir, name))
+        entries.append({"file": name, "ntotal": int(len(ids)),
+                        "search_params": apply_search_params(index, params)})
+        del index
+        print(f"[faiss] Wrote {name} ({len(ids)} vectors)", flush=True)
+
+    # The server searches every shard with one parameter set: keep the
+    # params that applied identically on all of them
+    applied = {name: value for name, value in params.items()
+               if all(e["search_params"].get(name) == value for e in entries)}
+    for name in sorted(set(params) - set(applied)):
+        print(f"[faiss] Warning: search parameter {name!r} did not apply to every shard; dropped")
+
+    manifest_path = shards_manifest_path(emb_root)
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({
+            "spec": spec, "metric": "L2", "d": int(d), "ntotal": int(N),
+            "partition": partition, "search_params": applied, "shards": entries,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, f, indent=2)
+    os.replace(tmp, manifest_path)
+    # Shards left over from an earlier build with more of them
+    live = {e["file"] for e in entries}
+    for p in glob.glob(os.path.join(out_dir, "shard_*.faiss")):
+        if os.path.basename(p) not in live:
+            os.remove(p)
+    print(f"[faiss] Wrote {manifest_path}; serve with FAISS_SHARDS=true")
+
+# ---- Streaming (out-of-core) build ----
+
+CHECKPOINT_META = "index_build.json"
+
+class VectorSource:
+    """Chunked, L2-normalized reads from vectors.npy (memory-mapped) or per-image files."""
+
+    def __init__(self, data_dir: str):
+        emb_root = os.path.join(data_dir, "embeddings")
+        loaded = load_vectors(emb_root)
+        if loaded is not None:
+            self.M, _ = loaded
+            self.paths = None
+            self.N, self.d = self.M.shape
+            self.fingerprint = source_fingerprint(os.path.join(emb_root, VECTORS_FILE))
+        else:
+            emb_dir = os.path.join(emb_root, "image")
+            self.paths = sorted(glob.glob(os.path.join(emb_dir, "*.npy")))
+            if not self.paths:
+                raise RuntimeError(f"No embeddings found under {emb_dir}")
+            self.M = None
+            self.N, self.d = len(self.paths), int(np.load(self.paths[0]).size)
+            self.fingerprint = f"{self.N}:{os.path.basename(self.paths[0])}:{os.path.basename(self.paths[-1])}"
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        if self.M is not None:
+            X = vector_rows(self.M, slice(start, stop))
+        else:
+            X = np.stack([np.load(p).astype("float32").ravel() for p in self.paths[start:stop]])
+        return l2n(X).astype("float32")
+
+    def take(self, idxs: np.ndarray) -> np.ndarray:
+        """Rows at ``idxs`` (any order); only those pages/files are read."""
+        if self.M is not None:
+            X = vector_rows(self.M, np.asarray(idxs))
+        else:
+            X = np.stack([np.load(self.paths[i]).astype("float32").ravel() for i in idxs])
+        return l2n(X).astype("float32")
+
+    def chunks(self, chunk: int, start: int = 0):
+        for lo in range(start, self.N, chunk):
+            hi = min(lo + chunk, self.N)
+            yield lo, self.read(lo, hi)
+
+def reservoir_sample(source: VectorSource, k: int, chunk: int, seed: int = 0) -> np.ndarray:
+    """Uniform sample of k vectors in one streaming pass (Algorithm R, per chunk)."""
+    rs = np.random.RandomState(seed)
+    k = min(k, source.N)
+    sample = np.empty((k, source.d), dtype="float32")
+    for lo, X in source.chunks(chunk):
+        pos = np.arange(lo, lo + len(X))
+        fill = pos < k
+        sample[pos[fill]] = X[fill]
+        rest = ~fill
+        if rest.any():
+            j = (rs.random_sample(rest.sum()) * (pos[rest] + 1)).astype(np.int64)
+            keep = j < k
+            # Later rows overwrite earlier ones in the same slot, as in the sequential algorithm
+            sample[j[keep]] = X[rest][keep]
+    return sample
+
+def build_streaming(data_dir: str, chunk: int, checkpoint_every: int, seed: int = 0,
+                    spec: str = None, search_params: dict = None):
+    """Train on a reservoir sample, then add vectors chunk by chunk.
+
+    Peak memory is one chunk plus the training sample plus the index itself.
+    Every ``checkpoint_every`` chunks the partial index and the number of
+    vectors added are saved next to the output; rerunning with the same
+    source resumes from there.
+    """
+    data_dir = os.path.abspath(data_dir)
+    emb_root = os.path.join(data_dir, "embeddings")
+    out_path = os.path.join(emb_root, "index.faiss")
+    part_path = out_path + ".partial"
+    meta_path = os.path.join(emb_root, CHECKPOINT_META)
+    os.makedirs(emb_root, exist_ok=True)
+
+    source = VectorSource(data_dir)
+    N, d = source.N, source.d
+    print(f"[faiss] streaming vectors: N={N}, d={d}, chunk={chunk}")
+
+    index, added, params = None, 0, {}
+    if os.path.exists(meta_path) and os.path.exists(part_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            ckpt = json.load(f)
+        if (ckpt.get("source") == source.fingerprint and ckpt.get("N") == N and ckpt.get("d") == d
+                and (spec is None or ckpt.get("spec") == spec)):
+            index, added = faiss.read_index(part_path), int(ckpt["added"])
+            spec, params = ckpt.get("spec"), ckpt.get("search_params") or {}
+            print(f"[faiss] Resuming from checkpoint: {added}/{N} vectors added")
+        else:
+            print("[faiss] Checkpoint is for a different source or spec; starting over")
+
+    def checkpoint(idx, n_added):
+        write_index_atomic(idx, part_path)
+        tmp = meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"source": source.fingerprint, "N": N, "d": d, "added": n_added,
+                       "spec": spec, "search_params": params}, f)
+        os.replace(tmp, meta_path)
+
+    if index is None:
+        index, spec, desc, params = make_index(d, N, spec)
+        print(f"[faiss] {desc}")
+        if not index.is_trained:
+            k = train_size_for(index, N, spec)
+            t0 = time.time()
+            print(f"[faiss] Reservoir-sampling {k} training vectors...", flush=True)
+            sample = reservoir_sample(source, k, chunk, seed)
+            index.train(sample)
+            del sample
+            print(f"[faiss] Trained in {time.time() - t0:.1f}s", flush=True)
+            checkpoint(index, 0)
+
+    t0, start, since_ckpt = time.time(), added, 0
+    for lo, X in source.chunks(chunk, start=added):
         index.add(X)
-        index.nprobe = max(1, min(nlist // 8, 32))
-        faiss.write_index(index, out_path)
-        print(f"[faiss] Wrote {out_path}")
+        added = lo + len(X)
+        since_ckpt += 1
+        rate = (added - start) / max(time.time() - t0, 1e-9)
+        eta = (N - added) / max(rate, 1e-9)
+        print(f"[faiss] added {added}/{N} ({100.0 * added / N:.1f}%, eta {eta:.0f}s)", flush=True)
+        if checkpoint_every > 0 and since_ckpt >= checkpoint_every and added < N:
+            checkpoint(index, added)
+            since_ckpt = 0
+
+    finish_index(index, out_path, spec, {**params, **(search_params or {})})
+    for p in (part_path, meta_path):
+        if os.path.exists(p):
+            os.remove(p)
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser(description="Build adaptive FAISS index from embeddings")
     ap.add_argument("--data_dir", default="data", help="Path to data folder containing /embeddings/image")
+    ap.add_argument("--stream", action="store_true",
+                    help="Out-of-core build: train on a reservoir sample, add in chunks with checkpoints")
+    ap.add_argument("--chunk", type=int, default=65536, help="Vectors per read/add chunk (--stream, --shards)")
+    ap.add_argument("--checkpoint_every", type=int, default=16,
+                    help="Save a resumable checkpoint every N chunks (--stream; 0 disables)")
+    ap.add_argument("--spec", default=None,
+                    help='faiss.index_factory string, e.g. "HNSW32,Flat" or "OPQ16,IVF1024,PQ16,RFlat" '
+                         "(default: pick Flat / IVF-Flat / IVF-PQ from N)")
+    ap.add_argument("--search_params", default=None,
+                    help='Runtime knobs saved to index_meta.json, e.g. "nprobe=16" or "efSearch=128"')
+    ap.add_argument("--shards", type=int, default=0,
+                    help="Write this many index shards under embeddings/index_shards instead of one index")
+    ap.add_argument("--partition", choices=PARTITIONS, default="hash",
+                    help="Shard assignment: hash of image_id, or whole projects (--shards)")
     args = ap.parse_args()
-    main(args.data_dir)
+    params = parse_search_params(args.search_params)
+    if args.shards > 0:
+        # Sharded builds always stream rows; --stream adds nothing there
+        build_shards(args.data_dir, args.shards, args.partition, args.spec, params, args.chunk)
+    elif args.stream:
+        build_streaming(args.data_dir, args.chunk, args.checkpoint_every, spec=args.spec, search_params=params)
+    else:
+        main(args.data_dir, args.spec, params)
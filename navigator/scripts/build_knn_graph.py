@@ -0,0 +1,73 @@
+import os, sys, json, argparse, time
+import numpy as np
+
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.faiss_service import FaissStore, lossy_distances, KNN_IDS_FILE, KNN_DIST_FILE, KNN_META_FILE
+from app.vectors import rows as vector_rows
+
+
+def main(data_dir: str, k: int, batch: int):
+    """Precompute every corpus image's top-k neighbours with the served index.
+
+    Searches go through the serving snapshot (``search_batch``), so the graph
+    gets the same search params from index_meta.json and the same exact
+    re-scoring of lossy candidates (FAISS_REFINE_FACTOR) as /search.
+    Writes knn_ids.npy (int32) and knn_dist.npy (float32), both (N, k) with
+    the image itself excluded, plus knn_graph.json recording k, ntotal, d, a
+    full-content hash of the index files, search params and refine factor so
+    the server ignores a graph built under other settings.
+    """
+    data_dir = os.path.abspath(data_dir)
+    emb_root = os.path.join(data_dir, "embeddings")
+    store = FaissStore(data_dir)
+    snap = store.snapshot()
+    if snap.vectors is None:
+        raise RuntimeError(f"No vectors.npy under {emb_root} matching id_map.json; "
+                           "run scripts/pack_embeddings.py first")
+    if lossy_distances(snap.index) and snap.refine_factor <= 1:
+        raise RuntimeError("The index returns approximate distances; set FAISS_REFINE_FACTOR > 1 "
+                           "so the graph is re-scored exactly")
+    N = snap.ntotal
+    if snap.vectors.shape[0] != N:
+        raise RuntimeError(f"Index has {N} vectors but vectors.npy has {snap.vectors.shape[0]} rows")
+    k = max(1, min(k, N - 1))
+    print(f"[knn] N={N}, k={k}, search_params={snap.index_meta.get('search_params')}, "
+          f"refine_factor={snap.refine_factor}")
+
+    ids = np.full((N, k), -1, dtype=np.int32)
+    dist = np.full((N, k), np.finfo("float32").max, dtype=np.float32)
+    t0 = time.time()
+    for start in range(0, N, batch):
+        stop = min(N, start + batch)
+        # One extra neighbour: the query itself
+        D, I = snap.search_batch(vector_rows(snap.vectors, slice(start, stop)), k + 1)
+        for r in range(stop - start):
+            keep = (I[r] != start + r) & (I[r] >= 0)
+            row_i, row_d = I[r][keep][:k], D[r][keep][:k]
+            ids[start + r, :len(row_i)] = row_i
+            dist[start + r, :len(row_d)] = row_d
+        print(f"[knn] {stop}/{N} ({time.time() - t0:.1f}s)", flush=True)
+
+    for name, arr in ((KNN_IDS_FILE, ids), (KNN_DIST_FILE, dist)):
+        path = os.path.join(emb_root, name)
+        np.save(path + ".tmp.npy", arr)
+        os.replace(path + ".tmp.npy", path)
+    meta = {"k": k, "ntotal": N, "d": int(snap.index.d), "index": store.index_hash(),
+            "search_params": snap.index_meta.get("search_params", {}),
+            "refine_factor": snap.refine_factor}
+    meta_path = os.path.join(emb_root, KNN_META_FILE)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".tmp", meta_path)
+    print(f"[knn] Wrote {KNN_IDS_FILE}, {KNN_DIST_FILE}, {KNN_META_FILE} under {emb_root}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Precompute the corpus kNN graph for 'more like this'")
+    ap.add_argument("--data_dir", default="data", help="Path to data folder containing /embeddings")
+    ap.add_argument("--k", type=int, default=128, help="Neighbours stored per image (excluding itself)")
+    ap.add_argument("--batch", type=int, default=1024, help="Query rows per FAISS search call")
+    args = ap.parse_args()
+    main(args.data_dir, args.k, args.batch)
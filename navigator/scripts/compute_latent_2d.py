@@ -1,21 +1,33 @@
 # scripts/compute_latent_2d.py
-import os, json, argparse, numpy as np, pandas as pd
+import os, sys, json, argparse, numpy as np, pandas as pd
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).parent.parent))
+
+from app.idmap import load_id_map
+from app.metadata import get_project_metadata
+from app.vectors import load_vectors, rows as vector_rows
+
 def main(data_dir, method="umap", seed=42):
     E = Path(data_dir)/"embeddings"/"image"
-    idmap = json.load(open(Path(data_dir)/"embeddings"/"id_map.json","r",encoding="utf-8"))
-    vecs, ids = [], []
+    idmap = load_id_map(str(Path(data_dir)/"embeddings"/"id_map.json"))
+    present = np.flatnonzero(np.asarray(idmap.image_id_codes) >= 0)
+    loaded = load_vectors(str(Path(data_dir)/"embeddings"))
     
-    for k in sorted(idmap, key=lambda z:int(z)):
-        iid = idmap[k]["image_id"]
-        p = E/f"{iid}.npy"
-        if p.exists():
-            vecs.append(np.load(p).astype("float32"))
-            ids.append(int(k))
-    
-    X = np.stack(vecs,0)
-    print(f"Loaded {len(vecs)} embeddings with shape {X.shape}")
+    if loaded is not None:
+        # Consolidated matrix: row i is faiss id i
+        M, _ = loaded
+        ids = [int(k) for k in present if k < M.shape[0]]
+        X = vector_rows(M, ids)
+    else:
+        vecs, ids = [], []
+        for k, iid in zip(present.tolist(), idmap.image_ids(present).tolist()):
+            p = E/f"{iid}.npy"
+            if p.exists():
+                vecs.append(np.load(p).astype("float32"))
+                ids.append(k)
+        X = np.stack(vecs,0)
+    print(f"Loaded {len(ids)} embeddings with shape {X.shape}")
     
     # reduce
     if method=="umap":
@@ -32,22 +44,22 @@ def main(data_dir, method="umap", seed=42):
     Y = (Y*2.0) - 1.0
     
     # hydrate
-    proj = pd.read_csv(Path(data_dir)/"metadata"/"projects.csv")
+    proj = get_project_metadata(str(Path(data_dir)/"metadata"/"projects.csv"))
     rows = []
     
-    for faiss_id, (x,y) in zip(ids, Y):
-        m = idmap[str(faiss_id)]
-        pid = m["project_id"]
-        r = proj[proj.project_id==pid]
+    image_ids, project_ids, thumbs = idmap.image_ids(ids), idmap.project_ids(ids), idmap.thumbs(ids)
+    prow = proj.rows(project_ids)
+    titles, countries, typologies = (proj.take(c, prow) for c in ("title", "country", "typology"))
+    for j, (faiss_id, (x,y), iid, pid, thumb) in enumerate(zip(ids, Y, image_ids, project_ids, thumbs)):
         rows.append(dict(
             faiss_id=faiss_id,
-            image_id=m["image_id"],
+            image_id=iid,
             project_id=pid,
             x=float(x), y=float(y),
-            thumb_url=m.get("thumb",""),
-            title=(r.iloc[0]["title"] if not r.empty else ""),
-            country=(r.iloc[0]["country"] if not r.empty else ""),
-            typology=(r.iloc[0]["typology"] if not r.empty else ""),
+            thumb_url=thumb or "",
+            title=(titles[j] if titles[j] is not None else ""),
+            country=(countries[j] if countries[j] is not None else ""),
+            typology=(typologies[j] if typologies[j] is not None else ""),
         ))
     
     # Write CSV
@@ -0,0 +1,40 @@
+import os, sys, json, argparse, time
+
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.idmap import IDMAP_JSON, convert_json, load_id_map
+
+
+def main(data_dir: str, check: bool):
+    """Convert embeddings/id_map.json into the memory-mapped binary id map."""
+    json_path = os.path.join(os.path.abspath(data_dir), "embeddings", IDMAP_JSON)
+    if not os.path.exists(json_path):
+        raise RuntimeError(f"No {IDMAP_JSON} at {json_path}")
+    t0 = time.time()
+    out_dir = convert_json(json_path)
+    print(f"[idmap] Wrote {out_dir} in {time.time() - t0:.2f}s")
+
+    t0 = time.time()
+    ids = load_id_map(json_path)
+    print(f"[idmap] Loaded {len(ids)} ids, {len(ids.project_names)} projects, "
+          f"{len(ids.strings)} strings in {(time.time() - t0) * 1000:.1f} ms")
+    if check:
+        with open(json_path, "r", encoding="utf-8") as f:
+            ref = json.load(f)
+        bad = []
+        for k, v in ref.items():
+            entry = {key: v.get(key) for key in ("image_id", "project_id", "thumb")}
+            if ids.get(int(k)) != entry or ids.row_of(v.get("image_id")) != int(k):
+                bad.append(k)
+        if bad:
+            raise RuntimeError(f"{len(bad)} entries differ from {IDMAP_JSON}, e.g. {bad[:5]}")
+        print(f"[idmap] Verified {len(ref)} entries against {IDMAP_JSON}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Convert id_map.json to the binary id map")
+    ap.add_argument("--data_dir", default="data", help="Path to data folder containing /embeddings")
+    ap.add_argument("--check", action="store_true", help="Compare every entry with the JSON after converting")
+    args = ap.parse_args()
+    main(args.data_dir, args.check)
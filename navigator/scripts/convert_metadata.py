@@ -0,0 +1,47 @@
+import os, sys, argparse, time
+import pandas as pd
+
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.metadata import LIST_COLUMNS, convert_csv, load_project_metadata, split_list
+
+
+def main(data_dir: str, check: bool):
+    """Convert metadata/projects.csv into the binary columnar project metadata."""
+    csv_path = os.path.join(os.path.abspath(data_dir), "metadata", "projects.csv")
+    if not os.path.exists(csv_path):
+        raise RuntimeError(f"No projects.csv at {csv_path}")
+    t0 = time.time()
+    out_dir = convert_csv(csv_path)
+    print(f"[metadata] Wrote {out_dir} in {time.time() - t0:.2f}s")
+
+    t0 = time.time()
+    meta = load_project_metadata(csv_path)
+    print(f"[metadata] Loaded {len(meta)} projects, {len(meta.columns)} columns "
+          f"in {(time.time() - t0) * 1000:.1f} ms")
+    if check:
+        df = pd.read_csv(csv_path)
+        bad = []
+        for r, row in enumerate(df.to_dict(orient="records")):
+            for col, v in row.items():
+                if col in LIST_COLUMNS:
+                    ok = meta.split(col, r) == split_list(v)
+                else:
+                    got = meta.value(col, r)
+                    ok = got == v or (got is None and pd.isna(v))
+                if not ok:
+                    bad.append((r, col))
+            if meta.row(row.get("project_id")) is None:
+                bad.append((r, "project_id index"))
+        if bad:
+            raise RuntimeError(f"{len(bad)} cells differ from projects.csv, e.g. {bad[:5]}")
+        print(f"[metadata] Verified {len(df)} rows against projects.csv")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Convert projects.csv to binary columnar metadata")
+    ap.add_argument("--data_dir", default="data", help="Path to data folder containing /metadata")
+    ap.add_argument("--check", action="store_true", help="Compare every cell with the CSV after converting")
+    args = ap.parse_args()
+    main(args.data_dir, args.check)
@@ -1,15 +1,27 @@
 import os
+import sys
 import json
 import argparse
 import glob
+import hashlib
 import time
 import pathlib
 import numpy as np
 from PIL import Image
 import torch
-import timm
+from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 
+# Add the parent directory to the path so we can import from app
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+from app.idmap import convert_json
+from app.model_registry import default_model_name, get_model
+from app.vectors import write_vectors
+
+MANIFEST_FILE = "embed_manifest.json"
+SHARD_DIR = "shards"
+
 
 def l2n(x):
     """L2-normalize vectors along axis=1."""
@@ -21,21 +33,192 @@ def load_model(name: str):
     """Load a DINOv2 model + its preprocessing transform."""
     print(f"[embed] Loading model: {name} (downloading if needed)...", flush=True)
     t0 = time.time()
-    model = timm.create_model(name, pretrained=True)
-    model.eval()
-    model.reset_classifier(0)
-    cfg = timm.data.resolve_data_config({}, model=model)
-    tfm = timm.data.create_transform(**cfg, is_training=False)
+    model, tfm = get_model(name)
     print(f"[embed] Model ready in {time.time()-t0:.1f}s", flush=True)
     return model, tfm
 
 
-def main(data_dir: str, model_name: str):
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_json_atomic(path: str, obj):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def load_manifest(emb_root: str, model_name: str) -> dict:
+    """Previous run's manifest; entries from another model are discarded."""
+    path = os.path.join(emb_root, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("model") == model_name:
+            return manifest
+        print(f"[embed] Manifest was built with {manifest.get('model')}; re-embedding everything", flush=True)
+    return {"model": model_name, "entries": {}}
+
+
+class ImageDataset(Dataset):
+    """Decode + transform in DataLoader workers; unreadable files yield None."""
+
+    def __init__(self, items, tfm):
+        self.items = items  # [(image_id, path)]
+        self.tfm = tfm
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        image_id, path = self.items[i]
+        try:
+            return image_id, self.tfm(Image.open(path).convert("RGB"))
+        except Exception as e:
+            print(f"[embed] Skipping unreadable file: {path} ({e})", flush=True)
+            return None
+
+
+def collate(batch):
+    batch = [b for b in batch if b is not None]
+    if not batch:
+        return [], None
+    return [b[0] for b in batch], torch.stack([b[1] for b in batch])
+
+
+class ShardWriter:
+    """Buffers vectors and writes ``shards/shard_NNNNN.npy`` files atomically.
+
+    The manifest is saved after every shard, so an interrupted run resumes
+    from the last completed shard.
+    """
+
+    def __init__(self, emb_root: str, manifest: dict, shard_size: int, pending: dict):
+        self.emb_root = emb_root
+        self.shard_dir = os.path.join(emb_root, SHARD_DIR)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.manifest = manifest
+        self.shard_size = max(1, shard_size)
+        self.pending = pending  # image_id -> {sha256, project_id, thumb}
+        existing = [int(pathlib.Path(p).stem.split("_")[1]) for p in glob.glob(os.path.join(self.shard_dir, "shard_*.npy"))]
+        self.next_shard = max(existing, default=-1) + 1
+        self.ids, self.vecs = [], []
+
+    def add(self, image_ids, vecs: np.ndarray):
+        self.ids.extend(image_ids)
+        self.vecs.extend(vecs)
+        while len(self.ids) >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def close(self):
+        if self.ids:
+            self._flush(len(self.ids))
+
+    def _flush(self, n: int):
+        name = f"shard_{self.next_shard:05d}.npy"
+        self.next_shard += 1
+        path = os.path.join(self.shard_dir, name)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, np.stack(self.vecs[:n]).astype("float32"))
+        os.replace(tmp, path)
+        for row, image_id in enumerate(self.ids[:n]):
+            self.manifest["entries"][image_id] = {**self.pending[image_id], "shard": name, "row": row}
+        self.ids, self.vecs = self.ids[n:], self.vecs[n:]
+        write_json_atomic(os.path.join(self.emb_root, MANIFEST_FILE), self.manifest)
+
+
+def gather_vectors(emb_root: str, entries: dict, image_ids: list) -> np.ndarray:
+    """Stack manifest vectors in ``image_ids`` order, reading each shard once."""
+    shard_dir = os.path.join(emb_root, SHARD_DIR)
+    by_shard = {}
+    for i, image_id in enumerate(image_ids):
+        e = entries[image_id]
+        by_shard.setdefault(e["shard"], []).append((i, e["row"]))
+    X = None
+    for shard, pairs in by_shard.items():
+        S = np.load(os.path.join(shard_dir, shard), mmap_mode="r")
+        if X is None:
+            X = np.empty((len(image_ids), S.shape[1]), dtype="float32")
+        dst, src = zip(*pairs)
+        X[list(dst)] = S[list(src)]
+    return X
+
+
+def prune_shards(emb_root: str, entries: dict):
+    """Delete shards that no manifest entry references any more."""
+    live = {e["shard"] for e in entries.values()}
+    for p in glob.glob(os.path.join(emb_root, SHARD_DIR, "shard_*.npy")):
+        if os.path.basename(p) not in live:
+            os.remove(p)
+
+
+def compact_shards(emb_root: str, manifest: dict, shard_size: int, min_live: float):
+    """Rewrite the live rows of shards whose live fraction fell below ``min_live``.
+
+    Shards keep the rows of removed or re-embedded images until nothing
+    references them; this moves the survivors of sparse shards into new
+    shards (the manifest is saved per shard) so ``prune_shards`` can drop them.
+    """
+    entries = manifest["entries"]
+    live = {}
+    for image_id, e in entries.items():
+        live.setdefault(e["shard"], []).append(image_id)
+    sparse = []
+    for shard, ids in sorted(live.items()):
+        rows = np.load(os.path.join(emb_root, SHARD_DIR, shard), mmap_mode="r").shape[0]
+        if len(ids) < min_live * rows:
+            sparse.extend(ids)
+    if not sparse:
+        return
+    print(f"[embed] Compacting {len(sparse)} vectors out of sparse shards", flush=True)
+    X = gather_vectors(emb_root, entries, sparse)
+    writer = ShardWriter(emb_root, manifest, shard_size, {i: entries[i] for i in sparse})
+    writer.add(sparse, X)
+    writer.close()
+
+
+def sync_per_image(emb_dir: str, image_ids: list, X: np.ndarray, changed: set):
+    """Keep legacy embeddings/image/{image_id}.npy files in step with vectors.npy.
+
+    The server falls back to them when vectors.npy is missing or stale, so
+    new or re-embedded images are (re)written and removed ones deleted.
+    """
+    os.makedirs(emb_dir, exist_ok=True)
+    for i, image_id in enumerate(image_ids):
+        path = os.path.join(emb_dir, f"{image_id}.npy")
+        if image_id in changed or not os.path.exists(path):
+            np.save(path, X[i])
+    keep = {f"{image_id}.npy" for image_id in image_ids}
+    for p in glob.glob(os.path.join(emb_dir, "*.npy")):
+        if os.path.basename(p) not in keep:
+            os.remove(p)
+
+
+def main(data_dir: str, model_name: str, dtype: str = "float32", batch_size: int = 32,
+         workers: int = 4, shard_size: int = 4096, device: str = "auto", per_image: bool = False,
+         compact_below: float = 0.5):
+    """Embed every image under data/images, reusing vectors of unchanged files.
+
+    Images are identified by content hash in embeddings/embed_manifest.json;
+    only new or modified files are decoded (in DataLoader workers) and run
+    through the model in batches. New vectors go to embeddings/shards/, and
+    id_map.json plus the consolidated vectors.npy are regenerated atomically
+    from the manifest at the end. Legacy per-image files are kept in sync
+    when requested or already present, and shards less than
+    ``compact_below`` live are rewritten.
+    """
     data_dir = os.path.abspath(data_dir)
     img_root = os.path.join(data_dir, "images")
-    emb_dir = os.path.join(data_dir, "embeddings", "image")
-    os.makedirs(emb_dir, exist_ok=True)
-    os.makedirs(os.path.join(data_dir, "embeddings"), exist_ok=True)
+    emb_root = os.path.join(data_dir, "embeddings")
+    emb_dir = os.path.join(emb_root, "image")
+    os.makedirs(emb_root, exist_ok=True)
+    idmap_path = os.path.join(emb_root, "id_map.json")
 
     # Collect all image paths deterministically
     projects = sorted([p for p in glob.glob(os.path.join(img_root, "*")) if os.path.isdir(p)])
@@ -49,68 +232,99 @@ def main(data_dir: str, model_name: str):
 
     print(f"[embed] Using data_dir: {data_dir}")
     print(f"[embed] Found {len(image_paths)} images in {len(projects)} project folders.", flush=True)
-    # Track metadata by image_id while embedding
-    image_meta = {}
 
     if len(image_paths) == 0:
         # Still write empty id_map so downstream steps don't crash
-        idmap_path = os.path.join(data_dir, "embeddings", "id_map.json")
-        with open(idmap_path, "w") as f:
-            json.dump(id_map, f)
+        write_json_atomic(idmap_path, {})
         print("[embed] No images found. Wrote empty id_map.json. "
               "Expected layout: data/images/<project_id>/*.jpg|*.jpeg|*.png", flush=True)
         return
 
-    model, tfm = load_model(model_name)
-
-    for img_path in tqdm(image_paths, desc="[embed] Embedding", unit="img"):
+    # Content hashes decide what needs embedding
+    manifest = load_manifest(emb_root, model_name)
+    entries = manifest["entries"]
+    shard_dir = os.path.join(emb_root, SHARD_DIR)
+    current, todo = {}, []
+    for img_path in tqdm(image_paths, desc="[embed] Hashing", unit="img"):
         project_id = pathlib.Path(img_path).parent.name
-        base = pathlib.Path(img_path).stem
-        image_id = f"i_{project_id}_{base}"
-        try:
-            pil = Image.open(img_path).convert("RGB")
-        except Exception as e:
-            print(f"[embed] Skipping unreadable file: {img_path} ({e})", flush=True)
-            continue
-
-        with torch.no_grad():
-            x = tfm(pil).unsqueeze(0)
-            feat = model(x)
-            vec = feat.cpu().numpy().astype("float32")
-            vec = l2n(vec)[0]
-
-        np.save(os.path.join(emb_dir, f"{image_id}.npy"), vec)
-        image_meta[image_id] = {
+        image_id = f"i_{project_id}_{pathlib.Path(img_path).stem}"
+        current[image_id] = {
+            "sha256": file_sha256(img_path),
             "project_id": project_id,
-            "thumb": f"/images/{project_id}/{os.path.basename(img_path)}"
+            "thumb": f"/images/{project_id}/{os.path.basename(img_path)}",
         }
+        prev = entries.get(image_id)
+        if (prev is None or prev.get("sha256") != current[image_id]["sha256"]
+                or not os.path.isfile(os.path.join(shard_dir, prev.get("shard", "")))):
+            todo.append((image_id, img_path))
+    print(f"[embed] {len(current) - len(todo)} unchanged, {len(todo)} to embed", flush=True)
 
-    # Build id_map in the SAME ORDER that build_faiss.py will load vectors
-    # i.e., sorted by embedding file path under emb_dir
-    vec_paths = sorted(glob.glob(os.path.join(emb_dir, "*.npy")))
-    id_map = {}
-    for idx, vec_path in enumerate(vec_paths):
-        image_id = pathlib.Path(vec_path).stem
-        meta = image_meta.get(image_id)
-        if meta is None:
-            # Skip stray embeddings without known metadata
-            continue
-        id_map[str(idx)] = {
-            "image_id": image_id,
-            "project_id": meta["project_id"],
-            "thumb": meta["thumb"],
-        }
+    if todo:
+        model, tfm = load_model(model_name)
+        dev = torch.device("cuda" if device == "auto" and torch.cuda.is_available()
+                           else ("cpu" if device == "auto" else device))
+        model = model.to(dev)
+        loader = DataLoader(ImageDataset(todo, tfm), batch_size=batch_size, num_workers=workers,
+                            collate_fn=collate, pin_memory=dev.type == "cuda")
+        writer = ShardWriter(emb_root, manifest, shard_size, current)
+        with tqdm(total=len(todo), desc="[embed] Embedding", unit="img") as bar:
+            for ids, x in loader:
+                if ids:
+                    with torch.no_grad():
+                        feat = model(x.to(dev, non_blocking=True))
+                    vecs = l2n(feat.cpu().numpy().astype("float32"))
+                    writer.add(ids, vecs)
+                bar.update(len(ids))
+        writer.close()
+
+    # Keep only images still in the corpus whose vector matches the current bytes
+    manifest["entries"] = entries = {
+        k: v for k, v in manifest["entries"].items()
+        if k in current and v["sha256"] == current[k]["sha256"]
+    }
+    write_json_atomic(os.path.join(emb_root, MANIFEST_FILE), manifest)
+    if compact_below > 0:
+        compact_shards(emb_root, manifest, shard_size, compact_below)
+    prune_shards(emb_root, entries)
 
-    idmap_path = os.path.join(data_dir, "embeddings", "id_map.json")
-    with open(idmap_path, "w") as f:
-        json.dump(id_map, f)
-    print(f"[embed] Saved {len(id_map)} embeddings; wrote {idmap_path}", flush=True)
+    # id_map and vectors.npy share one order: the sorted embeddings/image/*.npy
+    # paths build_faiss.py used to load, so faiss ids keep their numbering
+    image_ids = sorted(entries, key=lambda image_id: f"{image_id}.npy")
+    id_map = {
+        str(idx): {"image_id": image_id, "project_id": entries[image_id]["project_id"],
+                   "thumb": entries[image_id]["thumb"]}
+        for idx, image_id in enumerate(image_ids)
+    }
+    if image_ids:
+        X = gather_vectors(emb_root, entries, image_ids)
+        vec_path = write_vectors(emb_root, X, image_ids, dtype)
+        print(f"[embed] Wrote {vec_path} ({dtype})", flush=True)
+        if per_image or os.path.isdir(emb_dir):
+            sync_per_image(emb_dir, image_ids, X, {image_id for image_id, _ in todo})
+            print(f"[embed] Synced legacy per-image files under {emb_dir}", flush=True)
+    write_json_atomic(idmap_path, id_map)
+    convert_json(idmap_path)
+    print(f"[embed] Saved {len(id_map)} embeddings; wrote {idmap_path} and its binary id map", flush=True)
 
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--data_dir", default="data", help="Path to data folder containing /images and /embeddings")
-    ap.add_argument("--model", default="vit_base_patch14_dinov2",
-                    help="Model name: vit_base_patch14_dinov2 or vit_small_patch14_dinov2 for faster/lighter runs")
+    ap.add_argument("--model", default=default_model_name(),
+                    help="Model name (default MODEL_NAME, the query model): vit_small_patch14_dinov2 "
+                         "or vit_base_patch14_dinov2")
+    ap.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                    help="Storage dtype of the consolidated vectors.npy matrix")
+    ap.add_argument("--batch_size", type=int, default=32, help="Images per model forward")
+    ap.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                    help="DataLoader worker processes for decode/resize")
+    ap.add_argument("--shard_size", type=int, default=4096, help="Vectors per output shard")
+    ap.add_argument("--device", default="auto", help="Device to use (auto, cpu, cuda)")
+    ap.add_argument("--per_image", action="store_true",
+                    help="Also write legacy embeddings/image/{image_id}.npy files "
+                         "(kept in sync whenever that folder exists)")
+    ap.add_argument("--compact_below", type=float, default=0.5,
+                    help="Rewrite shards whose live fraction is below this (0 disables)")
     args = ap.parse_args()
-    main(args.data_dir, args.model)
+    main(args.data_dir, args.model, args.dtype, args.batch_size, args.workers,
+         args.shard_size, args.device, args.per_image, args.compact_below)
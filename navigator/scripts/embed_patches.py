@@ -12,7 +12,6 @@ from pathlib import Path
 from typing import Iterator, Tuple
 import numpy as np
 import torch
-import timm
 from PIL import Image
 import logging
 
@@ -20,6 +19,8 @@ import logging
 sys.path.append(str(Path(__file__).parent.parent))
 
 from app.faiss_service import l2n
+from app.model_registry import get_model, patch_model_name
+from app.patches import PATCH_MODES, embed_global_and_patches, patch_file_path
 
 def setup_logging():
     """Setup logging configuration."""
@@ -33,15 +34,7 @@ def setup_logging():
 
 def get_model_and_transform(model_name: str = "vit_small_patch14_dinov2"):
     """Get the model and transform for embedding."""
-    model = timm.create_model(model_name, pretrained=True)
-    model.eval()
-    model.reset_classifier(0)  # Remove classification head
-    
-    # Get transform
-    cfg = timm.data.resolve_data_config({}, model=model)
-    transform = timm.data.create_transform(**cfg, is_training=False)
-    
-    return model, transform
+    return get_model(model_name)
 
 def tile_image(pil: Image.Image, grid: int = 4) -> Iterator[Tuple[int, int, Image.Image]]:
     """
@@ -101,23 +94,15 @@ def embed_patches(model: torch.nn.Module, transform, pil: Image.Image, grid: int
         Array of shape (grid*grid, d) with L2-normalized embeddings
     """
     model.eval()
-    embeddings = []
+    device = next(model.parameters()).device
     
+    # Transform every tile into one (grid*grid, C, H, W) batch for a single forward
+    batch = torch.stack([transform(patch.convert('RGB')) for _, _, patch in tile_image(pil, grid)])
     with torch.no_grad():
-        for gx, gy, patch in tile_image(pil, grid):
-            # Convert to RGB and apply transform
-            patch_rgb = patch.convert('RGB')
-            patch_tensor = transform(patch_rgb).unsqueeze(0)
-            
-            # Get embedding
-            embedding = model(patch_tensor)
-            embeddings.append(embedding.cpu().numpy().flatten())
-    
-    # Stack embeddings and L2-normalize
-    embeddings = np.array(embeddings, dtype=np.float32)
-    embeddings = l2n(embeddings)
+        embeddings = model(batch.to(device)).cpu().numpy().astype(np.float32)
     
-    return embeddings
+    # L2-normalize
+    return l2n(embeddings)
 
 def find_images(data_dir: str) -> list:
     """
@@ -153,10 +138,13 @@ def find_images(data_dir: str) -> list:
 def main():
     parser = argparse.ArgumentParser(description="Embed patches for all images")
     parser.add_argument("--data_dir", type=str, required=True, help="Path to data directory")
-    parser.add_argument("--model", type=str, default="vit_small_patch14_dinov2", help="Model name")
+    parser.add_argument("--model", type=str, default=patch_model_name(),
+                        help="Model name (default PATCH_MODEL_NAME; the server embeds query patches with it)")
     parser.add_argument("--grid", type=int, default=4, help="Grid size for tiling")
     parser.add_argument("--max_side", type=int, default=1024, help="Maximum side length for resizing")
     parser.add_argument("--device", type=str, default="auto", help="Device to use (auto, cpu, cuda)")
+    parser.add_argument("--mode", type=str, default="crop", choices=PATCH_MODES,
+                        help="crop: embed each tile; token: pool tokens of one full-image forward")
     
     args = parser.parse_args()
     
@@ -173,6 +161,7 @@ def main():
     logger.info(f"Using device: {device}")
     logger.info(f"Model: {args.model}")
     logger.info(f"Grid size: {args.grid}")
+    logger.info(f"Patch mode: {args.mode}")
     logger.info(f"Max side: {args.max_side}")
     
     # Get model and transform
@@ -195,7 +184,7 @@ def main():
     skipped_count = 0
     
     for image_path, image_id in images:
-        output_file = output_dir / f"{image_id}__p{args.grid * args.grid}.npy"
+        output_file = patch_file_path(image_id, args.grid * args.grid, args.data_dir, args.mode)
         
         # Skip if already exists
         if output_file.exists():
@@ -211,7 +200,10 @@ def main():
             pil = resize_image(pil, args.max_side)
             
             # Embed patches
-            embeddings = embed_patches(model, transform, pil, args.grid)
+            if args.mode == "token":
+                _, embeddings = embed_global_and_patches(model, transform, pil, args.grid)
+            else:
+                embeddings = embed_patches(model, transform, pil, args.grid)
             
             # Save embeddings
             np.save(output_file, embeddings)
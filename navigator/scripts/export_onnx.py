@@ -0,0 +1,125 @@
+import os, sys, argparse, time
+import numpy as np
+from PIL import Image
+
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.faiss_service import l2n
+from app.idmap import load_id_map
+from app.model_registry import default_model_name, get_model
+from app.onnx_backend import OnnxEncoder, export_onnx, quantize_int8
+from app.vectors import load_vectors, rows as vector_rows
+
+
+def corpus_images(data_dir: str, limit: int):
+    """``(row, image path)`` pairs of the packed corpus, via id_map thumbs."""
+    emb_root = os.path.join(data_dir, "embeddings")
+    loaded = load_vectors(emb_root)
+    if loaded is None:
+        raise RuntimeError(f"No vectors.npy under {emb_root}; run scripts/pack_embeddings.py first")
+    M, ids = loaded
+    idmap = load_id_map(os.path.join(emb_root, "id_map.json"))
+    if idmap.image_ids_fingerprint() != ids:
+        raise RuntimeError(f"vectors.npy under {emb_root} is out of sync with id_map.json")
+    pairs = []
+    for row in range(M.shape[0]):
+        thumb = idmap.thumbs([row])[0]
+        path = os.path.join(data_dir, (thumb or "").lstrip("/"))
+        if os.path.isfile(path):
+            pairs.append((row, path))
+        if limit and len(pairs) >= limit:
+            break
+    return M, pairs
+
+
+def timed(fn, x, runs: int):
+    fn(x)  # warm-up
+    ts = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn(x)
+        ts.append((time.perf_counter() - t0) * 1000.0)
+    return float(np.percentile(ts, 50)), float(np.percentile(ts, 95))
+
+
+def main(data_dir: str, model_name: str, out_dir: str, quantize: bool, opset: int,
+         parity: int, bench: int, intra: int, inter: int, batch: int = 16):
+    """Export the query model to ONNX, then check parity and compare latency.
+
+    Parity embeds corpus images with each ONNX variant and reports cosine
+    agreement with the torch vectors in vectors.npy, ``batch`` images at a
+    time so memory stays flat on the full corpus; latency is p50/p95 of a
+    batch-1 forward for torch and each ONNX variant.
+    """
+    import torch  # defer heavy imports
+    import timm
+    data_dir = os.path.abspath(data_dir)
+    out_dir = os.path.abspath(out_dir or os.path.join(data_dir, "models"))
+    model, tfm = get_model(model_name)
+    data_config = timm.data.resolve_data_config({}, model=model)
+
+    print(f"[onnx] Exporting {model_name} (opset {opset}) -> {out_dir}", flush=True)
+    path = export_onnx(model, data_config, out_dir, model_name, opset)
+    print(f"[onnx] Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+    variants = {"onnx": path}
+    if quantize:
+        qpath = quantize_int8(out_dir, model_name)
+        print(f"[onnx] Wrote {qpath} ({os.path.getsize(qpath) / 1e6:.1f} MB)")
+        variants["onnx-int8"] = qpath
+    encoders = {name: OnnxEncoder(p, intra, inter) for name, p in variants.items()}
+
+    # Parity against the torch-built corpus vectors
+    if parity:
+        M, pairs = corpus_images(data_dir, parity if parity > 0 else 0)
+        if not pairs:
+            print("[onnx] No corpus images found for the parity check")
+        else:
+            cosines = {name: [] for name in encoders}
+            # Decode and compare one batch at a time; only cosines are kept
+            for lo in range(0, len(pairs), batch):
+                part = pairs[lo:lo + batch]
+                X = np.stack([tfm(Image.open(p).convert("RGB")).numpy() for _, p in part])
+                ref = vector_rows(M, [r for r, _ in part])
+                for name, enc in encoders.items():
+                    cosines[name].append((l2n(enc(X).astype("float32")) * ref).sum(axis=1))
+            for name, parts in cosines.items():
+                cos = np.concatenate(parts)
+                print(f"[onnx] parity {name}: n={len(cos)} cos mean={cos.mean():.5f} "
+                      f"min={cos.min():.5f} p01={np.percentile(cos, 1):.5f}")
+
+    # Batch-1 latency: torch eager vs ONNX Runtime
+    if bench > 0:
+        x = torch.randn(1, *data_config["input_size"])
+
+        def torch_fwd(t):
+            with torch.no_grad():
+                return model(t)
+        p50, p95 = timed(torch_fwd, x, bench)
+        print(f"[onnx] latency torch: p50={p50:.1f} ms p95={p95:.1f} ms")
+        xn = x.numpy()
+        for name, enc in encoders.items():
+            q50, q95 = timed(enc, xn, bench)
+            print(f"[onnx] latency {name}: p50={q50:.1f} ms p95={q95:.1f} ms "
+                  f"(x{p50 / max(q50, 1e-6):.2f} vs torch)")
+
+    print(f"[onnx] Serve with EMBED_BACKEND=onnx ONNX_DIR={out_dir}"
+          + (" ONNX_QUANTIZED=true" if quantize else ""))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Export the query embedder to ONNX Runtime")
+    ap.add_argument("--data_dir", default="data", help="Path to data directory")
+    ap.add_argument("--model", default=default_model_name())
+    ap.add_argument("--out_dir", default=None, help="Output directory (default: <data_dir>/models)")
+    ap.add_argument("--quantize", action="store_true", help="Also write an int8 dynamically quantized graph")
+    ap.add_argument("--opset", type=int, default=17)
+    ap.add_argument("--parity", type=int, default=-1,
+                    help="Corpus images for the parity check (-1 = all, 0 = skip)")
+    ap.add_argument("--batch", type=int, default=16, help="Images per parity batch")
+    ap.add_argument("--bench", type=int, default=30, help="Timed forwards per backend (0 = skip)")
+    ap.add_argument("--intra_threads", type=int, default=0)
+    ap.add_argument("--inter_threads", type=int, default=1)
+    args = ap.parse_args()
+    main(args.data_dir, args.model, args.out_dir, args.quantize, args.opset,
+         args.parity, args.bench, args.intra_threads, args.inter_threads, args.batch)
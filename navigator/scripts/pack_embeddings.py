@@ -0,0 +1,26 @@
+import os, sys, json, argparse
+
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.vectors import pack_from_npy
+
+
+def main(data_dir: str, dtype: str):
+    """Pack per-image embeddings into the consolidated vectors.npy matrix."""
+    emb_root = os.path.join(os.path.abspath(data_dir), "embeddings")
+    idmap_path = os.path.join(emb_root, "id_map.json")
+    with open(idmap_path, "r", encoding="utf-8") as f:
+        id_map = json.load(f)
+    print(f"[pack] Packing {len(id_map)} embeddings in faiss-id order ({dtype})...")
+    out = pack_from_npy(emb_root, id_map, dtype)
+    print(f"[pack] Wrote {out}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Consolidate per-image .npy embeddings into one matrix")
+    ap.add_argument("--data_dir", default="data", help="Path to data folder containing /embeddings")
+    ap.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                    help="Storage dtype; float16 halves the file, vectors are read back as float32")
+    args = ap.parse_args()
+    main(args.data_dir, args.dtype)
@@ -0,0 +1,172 @@
+import os, sys, argparse, json, time
+import numpy as np
+import faiss
+
+# Add the parent directory to the path so we can import from app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.faiss_service import (FaissStore, first_shard, l2n, read_index_meta, write_index_meta,
+                               shards_manifest_path)
+from app.vectors import rows as vector_rows
+
+
+def served_index(index):
+    """The index doing the search, unwrapped from shards and the id map."""
+    index = first_shard(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def tuning_knob(index):
+    """(parameter name, candidate values) for the index's main speed/recall knob.
+
+    Shards share one layout, so the first shard stands for all of them.
+    """
+    index = served_index(index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        values, v = [], 1
+        while v < ivf.nlist:
+            values.append(v)
+            v *= 2
+        return "nprobe", values + [int(ivf.nlist)]
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return "efSearch", [16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512]
+    return None, []
+
+
+def drop_self(I: np.ndarray, qidx: np.ndarray, k: int) -> np.ndarray:
+    """First k ids of each row other than the query's own (held-out evaluation)."""
+    out = np.full((len(I), k), -1, dtype=np.int64)
+    for i, row in enumerate(I):
+        row = row[(row != qidx[i]) & (row >= 0)][:k]
+        out[i, :len(row)] = row
+    return out
+
+
+def measure(search, Q: np.ndarray, qidx: np.ndarray, gt: np.ndarray, k: int):
+    """recall@k against ``gt`` and per-query latency (one query per call, as served).
+
+    ``search(Q, k)`` returns (D, I) like ``index.search``.
+    """
+    I = np.empty((len(Q), k + 1), dtype=np.int64)
+    lat = np.empty(len(Q))
+    for i in range(len(Q)):
+        t0 = time.perf_counter()
+        _, I[i:i + 1] = search(Q[i:i + 1], k + 1)
+        lat[i] = (time.perf_counter() - t0) * 1000.0
+    I = drop_self(I, qidx, k)
+    hits = sum(len(np.intersect1d(I[i], gt[i][gt[i] >= 0])) for i in range(len(Q)))
+    return hits / float(max(1, (gt >= 0).sum())), float(np.percentile(lat, 50)), float(np.percentile(lat, 99))
+
+
+def main(data_dir: str, k: int, queries: int, target_recall: float, p99_ms: float,
+         threads: int, seed: int, dry_run: bool):
+    """Sweep the served index's search knob against exact ground truth.
+
+    The index is loaded the way the server loads it (``FaissStore``: the
+    single file or the shards under FAISS_SHARDS, FAISS_REFINE_FACTOR
+    re-scoring), and every query goes through the snapshot's
+    ``search_batch`` with the knob as a per-call override. Ground truth comes
+    from an exact IndexFlatL2 over the same normalized vectors. The chosen
+    operating point is the cheapest setting that reaches ``target_recall``
+    (and ``p99_ms``, if given); it is written into index_meta.json, or the
+    shard manifest when sharded, which FaissStore applies on reload.
+    """
+    data_dir = os.path.abspath(data_dir)
+    emb_root = os.path.join(data_dir, "embeddings")
+    index_path = os.path.join(emb_root, "index.faiss")
+    if threads > 0:
+        faiss.omp_set_num_threads(threads)
+
+    store = FaissStore(data_dir)
+    snap = store.snapshot()
+    if snap.vectors is None:
+        raise RuntimeError(f"No vectors.npy under {emb_root} matching id_map.json; "
+                           "run scripts/pack_embeddings.py first")
+    M = snap.vectors
+    index = snap.index
+    knob, values = tuning_knob(index)
+    if knob is None:
+        print(f"[tune] {type(served_index(index)).__name__} has no search knob to tune (exact search)")
+        return
+    N = M.shape[0]
+    if index.ntotal != N:
+        raise RuntimeError(f"Index has {index.ntotal} vectors but vectors.npy has {N} rows")
+    k = min(k, N - 1)
+
+    # Query sample and exact ground truth
+    rs = np.random.RandomState(seed)
+    qidx = np.sort(rs.choice(N, min(queries, N), replace=False))
+    Q = l2n(vector_rows(M, qidx)).astype("float32")
+    flat = faiss.IndexFlatL2(M.shape[1])
+    for lo in range(0, N, 65536):
+        flat.add(l2n(vector_rows(M, slice(lo, min(lo + 65536, N)))).astype("float32"))
+    # Queries are corpus vectors; their own id is dropped from truth and results
+    _, gt = flat.search(Q, k + 1)
+    gt = drop_self(gt, qidx, k)
+    _, exact_p50, exact_p99 = measure(flat.search, Q, qidx, gt, k)
+    layout = f"{len(snap.index_meta['shards'])} shards" if store.sharded else "single index"
+    print(f"[tune] {type(served_index(index)).__name__} ({layout}, refine_factor={snap.refine_factor}): "
+          f"N={N}, {len(Q)} queries, recall@{k}, knob={knob}")
+    print(f"[tune] exact flat baseline: p50={exact_p50:.3f} ms p99={exact_p99:.3f} ms")
+
+    sweep = []
+    print(f"[tune] {knob:>10} {'recall':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for v in values:
+        recall, p50, p99 = measure(lambda q, kk: snap.search_batch(q, kk, overrides={knob: v}), Q, qidx, gt, k)
+        sweep.append({knob: v, "recall": round(recall, 4), "p50_ms": round(p50, 3), "p99_ms": round(p99, 3)})
+        print(f"[tune] {v:>10} {recall:>8.4f} {p50:>8.3f} {p99:>8.3f}")
+
+    ok = [r for r in sweep if r["recall"] >= target_recall and (p99_ms <= 0 or r["p99_ms"] <= p99_ms)]
+    if ok:
+        chosen = ok[0]
+    else:
+        chosen = max(sweep, key=lambda r: (r["recall"], -r["p99_ms"]))
+        print(f"[tune] No setting meets recall ≥ {target_recall}"
+              + (f" and p99 ≤ {p99_ms} ms" if p99_ms > 0 else "") + "; using the highest recall")
+    print(f"[tune] chosen {knob}={chosen[knob]}: recall@{k}={chosen['recall']:.4f} "
+          f"p50={chosen['p50_ms']:.3f} ms p99={chosen['p99_ms']:.3f} ms")
+
+    if dry_run:
+        return
+    tuning = {
+        "k": k, "queries": len(Q), "target_recall": target_recall, "p99_ms_slo": p99_ms or None,
+        "refine_factor": snap.refine_factor, "chosen": chosen,
+        "exact": {"p50_ms": round(exact_p50, 3), "p99_ms": round(exact_p99, 3)},
+        "sweep": sweep, "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if store.sharded:
+        # Sharded serving reads its search params from the manifest
+        path = shards_manifest_path(emb_root)
+        with open(path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        meta.setdefault("search_params", {})[knob] = chosen[knob]
+        meta["tuning"] = tuning
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(path + ".tmp", path)
+    else:
+        meta = read_index_meta(index_path)
+        meta.setdefault("search_params", {})[knob] = chosen[knob]
+        meta["tuning"] = tuning
+        path = write_index_meta(index_path, meta)
+    print(f"[tune] Wrote {path}; POST /admin/reload-index to apply "
+          f"(FAISS_NPROBE / FAISS_EFSEARCH still override when set)")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Tune FAISS search parameters for recall vs latency")
+    ap.add_argument("--data_dir", default="data", help="Path to data folder containing /embeddings")
+    ap.add_argument("--k", type=int, default=50, help="Recall depth (recall@k)")
+    ap.add_argument("--queries", type=int, default=500, help="Sampled query vectors")
+    ap.add_argument("--target_recall", type=float, default=0.95)
+    ap.add_argument("--p99_ms", type=float, default=0.0, help="Latency SLO for the chosen point (0 = none)")
+    ap.add_argument("--threads", type=int, default=0, help="FAISS OpenMP threads (0 = default)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--dry_run", action="store_true", help="Report only; do not update index_meta.json")
+    args = ap.parse_args()
+    main(args.data_dir, args.k, args.queries, args.target_recall, args.p99_ms,
+         args.threads, args.seed, args.dry_run)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Golden ranking check and latency benchmark for fuse_and_sort.
+
+Builds a synthetic serving snapshot (seeded, no FAISS search involved, so the
+candidates are identical on every machine), fuses a fixed grid of weight /
+filter / strict / spatial cases and compares each ranking with
+tools/fusion_golden.json. Then times fusion at a few thousand candidates.
+Fusion casts every operand to float32, so the pinned rankings hold under
+NumPy 1 and NumPy 2 promotion rules alike. A manual tool, not a test.
+
+    python tools/check_fusion.py            # check rankings + latency
+    python tools/check_fusion.py --write    # re-pin after an intended change
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import faiss
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.faiss_service import ServingSnapshot
+from app.idmap import IdMap
+from app.metadata import ProjectMetadata
+from app.main import Filters, Weights, fuse_and_sort
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fusion_golden.json")
+
+TYPOLOGIES = ["housing", "museum", "school", "office", "library"]
+CLIMATES = ["temperate", "arid", "tropical", "cold"]
+MASSINGS = ["bar", "tower", "courtyard", "pavilion"]
+
+
+def synthetic_snapshot(n_images: int = 6000, n_projects: int = 300, seed: int = 0) -> ServingSnapshot:
+    """Corpus with the awkward cases: projects missing from projects.csv,
+    missing attribute cells, images without a project and projects without
+    spatial features."""
+    rs = np.random.RandomState(seed)
+    pids = [f"p_{i:04d}" for i in range(n_projects)]
+    owner = rs.randint(0, n_projects, n_images)
+    id_map = {}
+    for i in range(n_images):
+        entry = {"image_id": f"i_{i:05d}", "thumb": f"/images/{i}.jpg"}
+        if i % 97:
+            entry["project_id"] = pids[owner[i]]
+        id_map[str(i)] = entry
+    idmap = IdMap.from_json(id_map)
+
+    listed = [p for j, p in enumerate(pids) if j % 23]  # some projects lack metadata
+    df = pd.DataFrame({
+        "project_id": listed,
+        "title": [f"Project {p}" for p in listed],
+        "country": rs.choice(["DK", "NL", "JP"], len(listed)),
+        "typology": rs.choice(TYPOLOGIES, len(listed)).astype(object),
+        "climate_bin": rs.choice(CLIMATES, len(listed)).astype(object),
+        "massing_type": rs.choice(MASSINGS, len(listed)).astype(object),
+    })
+    df.loc[rs.rand(len(df)) < 0.05, "typology"] = np.nan
+    df.loc[rs.rand(len(df)) < 0.05, "massing_type"] = np.nan
+    projects = ProjectMetadata.from_frame(df)
+
+    spatial = {p: [float(rs.uniform(1, 6)), float(rs.uniform(0.3, 1.0)), float(rs.randint(1, 40)),
+                   float(rs.uniform(0, 0.4))]
+               for j, p in enumerate(pids) if j % 7}
+    raw = np.array(list(spatial.values()))
+    normalizers = {
+        "elongation": (np.log1p(raw[:, 0]).min(), np.log1p(raw[:, 0]).max()),
+        "convexity": (0.0, 1.0),
+        "room_count": (np.log1p(raw[:, 2]).min(), np.log1p(raw[:, 2]).max()),
+        "corridor_ratio": (raw[:, 3].min(), raw[:, 3].max()),
+    }
+    index = faiss.IndexFlatL2(8)
+    index.add(np.zeros((n_images, 8), dtype="float32"))
+    return ServingSnapshot(index, idmap, projects, spatial, normalizers, "")
+
+
+def candidates(snap: ServingSnapshot, k: int, seed: int, pad: int = 0, ties: bool = False):
+    """(D, I, hydrated) as a depth-k search and ``results_payload`` return them."""
+    rs = np.random.RandomState(seed)
+    D = np.sort(rs.gamma(2.0, 0.3, k)).astype("float32")
+    if ties:
+        D = np.round(D, 1)  # coarse distances: many exact ties
+    I = rs.choice(snap.ntotal, k, replace=False).astype("int64")
+    if pad:
+        D[-pad:] = np.finfo("float32").max
+        I[-pad:] = -1
+    return D, I, snap.results_payload(D, I)
+
+
+def cases():
+    weights = [(1.0, 0.0, 0.0), (0.6, 0.2, 0.2), (0.3, 0.0, 0.7), (0.4, 0.5, 0.1), (0.0, 0.0, 0.0)]
+    filters = [{}, {"typology": "museum"}, {"typology": "housing", "climate_bin": "arid", "massing_type": "bar"},
+               {"climate_bin": "nowhere"}]
+    spatial = [None, [0.5, 0.7, 0.4, 0.2]]
+    out = []
+    for wi, w in enumerate(weights):
+        for fi, f in enumerate(filters):
+            for strict in (False, True):
+                for si, q in enumerate(spatial):
+                    out.append({"name": f"w{wi}-f{fi}-{'strict' if strict else 'soft'}-s{si}",
+                                "weights": w, "filters": f, "strict": strict, "spatial": q})
+    return out
+
+
+def ranking(results):
+    ids = [int(r["faiss_id"]) for r in results]
+    return hashlib.sha1(np.asarray(ids, dtype=np.int64).tobytes()).hexdigest(), ids
+
+
+def run_cases(snap: ServingSnapshot):
+    out = {}
+    pools = {"k60": candidates(snap, 60, 1), "k2000": candidates(snap, 2000, 2),
+             "ties": candidates(snap, 500, 3, ties=True), "padded": candidates(snap, 80, 4, pad=15)}
+    for pool, (D, I, hydrated) in pools.items():
+        for c in cases():
+            w = Weights(visual=c["weights"][0], spatial=c["weights"][1], attr=c["weights"][2])
+            f = Filters(**c["filters"])
+            # Serving path (ids passed, as run_search does) and ids read from the results
+            fused, debug = fuse_and_sort(hydrated, D, w, f, strict=c["strict"],
+                                         query_spatial_features=c["spatial"], store=snap, ids=I)
+            again, _ = fuse_and_sort(hydrated, D, w, f, strict=c["strict"],
+                                     query_spatial_features=c["spatial"], store=snap)
+            sha, ids = ranking(fused)
+            if ranking(again)[0] != sha:
+                sha = "ids/results paths disagree"
+            out[f"{pool}/{c['name']}"] = {"n": len(ids), "sha1": sha, "head": ids[:10], "moved": debug["moved"]}
+            # A limited fusion must return the prefix of the full ranking
+            for limit in (1, 12):
+                top, _ = fuse_and_sort(hydrated, D, w, f, strict=c["strict"],
+                                       query_spatial_features=c["spatial"], store=snap, ids=I, limit=limit)
+                if ranking(top)[1] != ids[:limit]:
+                    out[f"{pool}/{c['name']}"]["sha1"] = f"limit={limit} is not a prefix"
+    return out
+
+
+def bench(snap: ServingSnapshot, k: int, repeats: int):
+    D, I, hydrated = candidates(snap, k, 5)
+    w = Weights(visual=0.5, spatial=0.3, attr=0.2)
+    f = Filters(typology="museum", climate_bin="arid")
+    q = [0.5, 0.7, 0.4, 0.2]
+    fuse_and_sort(hydrated, D, w, f, query_spatial_features=q, store=snap, ids=I)  # warm-up
+    ts = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fuse_and_sort(hydrated, D, w, f, query_spatial_features=q, store=snap, ids=I)
+        ts.append((time.perf_counter() - t0) * 1000.0)
+    return float(np.percentile(ts, 50)), float(np.percentile(ts, 95))
+
+
+def main(write: bool, bench_k: int, repeats: int, max_ms: float) -> int:
+    snap = synthetic_snapshot()
+    got = run_cases(snap)
+    if write:
+        with open(GOLDEN, "w", encoding="utf-8") as f:
+            json.dump(got, f, indent=1, sort_keys=True)
+        print(f"[fusion] Pinned {len(got)} rankings in {GOLDEN}")
+    else:
+        with open(GOLDEN, "r", encoding="utf-8") as f:
+            want = json.load(f)
+        bad = [name for name in want if got.get(name) != want[name]]
+        if bad or set(got) != set(want):
+            for name in bad[:5]:
+                print(f"[fusion] MISMATCH {name}: want {want[name]} got {got.get(name)}")
+            print(f"[fusion] {len(bad)} of {len(want)} rankings differ from the golden file")
+            return 1
+        print(f"[fusion] {len(want)} rankings match {os.path.basename(GOLDEN)}")
+
+    status = 0
+    if bench_k > 0:
+        p50, p95 = bench(snap, bench_k, repeats)
+        print(f"[fusion] search_k={bench_k}: p50={p50:.3f} ms p95={p95:.3f} ms")
+        if max_ms > 0 and p50 > max_ms:
+            print(f"[fusion] p50 exceeds {max_ms} ms")
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Pin fuse_and_sort rankings and time fusion")
+    ap.add_argument("--write", action="store_true", help="Re-pin the golden rankings")
+    ap.add_argument("--bench_k", type=int, default=4000, help="Candidates for the latency check (0 = skip)")
+    ap.add_argument("--repeats", type=int, default=200)
+    ap.add_argument("--max_ms", type=float, default=1.0, help="Fail if p50 fusion exceeds this (0 = report only)")
+    args = ap.parse_args()
+    sys.exit(main(args.write, args.bench_k, args.repeats, args.max_ms))